@@ -13,15 +13,64 @@ def create_app():
     db.init_app(app)
     CORS(app)
     
+    # 请求追踪（每个请求一个 span，/metrics 输出聚合指标）
+    from .services.tracing import tracer
+    tracer.init_app(app)
+    
     # 注册蓝图
-    from .routes import auth, workflow, cases, admin
+    from .routes import auth, workflow, cases, admin, metrics
     app.register_blueprint(auth.bp)
     app.register_blueprint(workflow.bp)
     app.register_blueprint(cases.bp)
     app.register_blueprint(admin.bp)
+    app.register_blueprint(metrics.bp)
     
     # 创建数据库表
     with app.app_context():
         db.create_all()
+        _upgrade_schema()
+    
+    # 启动API使用记录的后台批量写入
+    from .services.usage_recorder import usage_recorder
+    usage_recorder.init_app(app)
+    
+    # 用户请求配额（根据当日用量重建计数）
+    from .services.quota import quota_manager
+    quota_manager.init_app(app)
+    
+    # 统计数据库提交耗时与锁等待
+    from .services.db_metrics import db_metrics
+    db_metrics.init_app(app, db)
+    
+    # 案例库BM25索引（加载快照并补充索引变更的案例）
+    from .services.case_index import case_index
+    case_index.init_app(app, db)
+    
+    # 近似工作流输入查找（按输入字段索引已有案例）
+    from .services.similar_input import similar_input_cache
+    similar_input_cache.init_app(app, db)
+    
+    # 无参考材料时的案例搜索服务
+    from .services.search import search_service
+    search_service.init_app(app)
+    
+    # 启动后台任务工作线程（恢复上次未完成的任务）
+    from .services.job_manager import job_manager
+    job_manager.init_app(app)
+    
+    return app
+
+def _upgrade_schema():
+    """为已存在的表补充模型中新增的列（create_all 不会修改已有表结构）"""
+    from sqlalchemy import inspect, text
     
-    return app 
\ No newline at end of file
+    inspector = inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=db.engine.dialect)
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}')) 
\ No newline at end of file
@@ -15,6 +15,7 @@ class Config:
     # 数据库配置
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///case_creator.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    DB_SLOW_COMMIT_MS = float(os.environ.get('DB_SLOW_COMMIT_MS', 100))  # 提交耗时超过该值记为一次锁等待
     
     # 服务器配置
     HOST = '0.0.0.0'
@@ -26,10 +27,103 @@ class Config:
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(hours=24)
     
     # OpenRouter API配置
-    OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+    OPENROUTER_BASE_URL = os.environ.get('OPENROUTER_BASE_URL') or "https://openrouter.ai/api/v1"
     OPENROUTER_API_KEY = os.environ.get('OPENROUTER_API_KEY')
     DEFAULT_MODEL = os.environ.get('DEFAULT_MODEL', 'gpt-4o-mini')
     
+    # OpenRouter连接池配置
+    OPENROUTER_POOL_CONNECTIONS = int(os.environ.get('OPENROUTER_POOL_CONNECTIONS', 4))
+    OPENROUTER_POOL_MAXSIZE = int(os.environ.get('OPENROUTER_POOL_MAXSIZE', 16))
+    OPENROUTER_POOL_BLOCK = os.environ.get('OPENROUTER_POOL_BLOCK', 'false').lower() == 'true'
+    OPENROUTER_POOL_IDLE_TIMEOUT = float(os.environ.get('OPENROUTER_POOL_IDLE_TIMEOUT', 90))
+    OPENROUTER_HTTP2 = os.environ.get('OPENROUTER_HTTP2', 'false').lower() == 'true'
+    OPENROUTER_ASYNC_CONCURRENCY = int(os.environ.get('OPENROUTER_ASYNC_CONCURRENCY', 8))
+    
+    # OpenRouter重试与熔断配置（请求超时读取系统配置 openrouter_timeout）
+    OPENROUTER_MAX_RETRIES = int(os.environ.get('OPENROUTER_MAX_RETRIES', 2))
+    OPENROUTER_RETRY_BASE_DELAY = float(os.environ.get('OPENROUTER_RETRY_BASE_DELAY', 0.5))
+    OPENROUTER_RETRY_MAX_DELAY = float(os.environ.get('OPENROUTER_RETRY_MAX_DELAY', 8))
+    OPENROUTER_BREAKER_THRESHOLD = int(os.environ.get('OPENROUTER_BREAKER_THRESHOLD', 5))
+    OPENROUTER_BREAKER_RECOVERY = float(os.environ.get('OPENROUTER_BREAKER_RECOVERY', 30))
+    
+    # 按API密钥的上游并发调度（0 表示不限制）：同一密钥的请求按用户公平排队，交互请求优先于批量任务
+    LLM_KEY_CONCURRENCY = int(os.environ.get('LLM_KEY_CONCURRENCY', 8))
+    LLM_QUEUE_TIMEOUT = float(os.environ.get('LLM_QUEUE_TIMEOUT', 120))
+    LLM_BULK_STARVATION_SECONDS = float(os.environ.get('LLM_BULK_STARVATION_SECONDS', 30))
+    
+    # 模型路由配置: fixed(仅使用指定模型) / fallback(按回退链切换) / fastest(最快) / cheapest(p95阈值内最便宜)
+    MODEL_ROUTING_POLICY = os.environ.get('MODEL_ROUTING_POLICY', 'fixed')
+    MODEL_FALLBACK_CHAIN = os.environ.get('MODEL_FALLBACK_CHAIN', 'gpt-4o-mini,claude-3-haiku,gpt-4o')
+    MODEL_ROUTING_MAX_P95_MS = float(os.environ.get('MODEL_ROUTING_MAX_P95_MS', 20000))
+    MODEL_ROUTING_MAX_ERROR_RATE = float(os.environ.get('MODEL_ROUTING_MAX_ERROR_RATE', 0.5))
+    
+    # 提示词预算配置: 超出上下文窗口时 trim(裁剪参考材料) 或 reject(直接拒绝)
+    LLM_MAX_OUTPUT_TOKENS = int(os.environ.get('LLM_MAX_OUTPUT_TOKENS', 2000))
+    LLM_MIN_OUTPUT_TOKENS = int(os.environ.get('LLM_MIN_OUTPUT_TOKENS', 512))
+    LLM_CONTEXT_SAFETY_MARGIN = int(os.environ.get('LLM_CONTEXT_SAFETY_MARGIN', 256))
+    PROMPT_OVERFLOW_POLICY = os.environ.get('PROMPT_OVERFLOW_POLICY', 'trim')
+    
+    # 提示词布局: prefix(静态指令在前、变量输入在后，便于命中服务端前缀缓存) / legacy(变量填入单条系统消息)
+    PROMPT_LAYOUT = os.environ.get('PROMPT_LAYOUT', 'prefix')
+    
+    # 题目生成方式: single(一次调用生成全部题目) / parallel(按题型拆分并发生成，题号连续合并)
+    QUESTION_GENERATION_MODE = os.environ.get('QUESTION_GENERATION_MODE', 'single')
+    # 题目难度处理: single_pass(出题时直接按难度生成) / two_pass(出题后再调用一次模型改写难度)
+    DIFFICULTY_MODE = os.environ.get('DIFFICULTY_MODE', 'single_pass')
+    
+    # 工作流引擎: builtin(内置流程) / dsl(按 Dify 导出的 案例改编.yml 执行，互不依赖的节点并发)
+    WORKFLOW_ENGINE = os.environ.get('WORKFLOW_ENGINE', 'builtin')
+    DSL_WORKFLOW_PATH = os.environ.get('DSL_WORKFLOW_PATH') or os.path.join(project_root, '案例改编.yml')
+    DSL_MAX_PARALLEL = int(os.environ.get('DSL_MAX_PARALLEL', 4))
+    DSL_NODE_TIMEOUT = float(os.environ.get('DSL_NODE_TIMEOUT', 180))
+    DSL_TOOL_CACHE_TTL = float(os.environ.get('DSL_TOOL_CACHE_TTL', 3600))
+    DSL_USE_NODE_MODELS = os.environ.get('DSL_USE_NODE_MODELS', 'false').lower() == 'true'  # false 时使用用户偏好模型
+    DSL_NOTIFY_ENABLED = os.environ.get('DSL_NOTIFY_ENABLED', 'false').lower() == 'true'  # 企业微信群消息节点
+    WECOM_HOOK_KEY = os.environ.get('WECOM_HOOK_KEY')  # 覆盖DSL中配置的机器人key
+    
+    # 无参考材料时的案例搜索: 逗号分隔的搜索服务 brave / google / local(本地模拟)，为空时不搜索
+    SEARCH_PROVIDERS = os.environ.get('SEARCH_PROVIDERS', '')
+    BRAVE_SEARCH_API_KEY = os.environ.get('BRAVE_SEARCH_API_KEY')
+    BRAVE_SEARCH_URL = os.environ.get('BRAVE_SEARCH_URL')  # 兼容接口地址，默认官方API
+    GOOGLE_SEARCH_API_KEY = os.environ.get('GOOGLE_SEARCH_API_KEY')
+    GOOGLE_SEARCH_CX = os.environ.get('GOOGLE_SEARCH_CX')  # 可编程搜索引擎ID
+    GOOGLE_SEARCH_URL = os.environ.get('GOOGLE_SEARCH_URL')
+    SEARCH_TIMEOUT = float(os.environ.get('SEARCH_TIMEOUT', 5))  # 每个搜索服务的截止时间(秒)
+    SEARCH_MERGE_WINDOW = float(os.environ.get('SEARCH_MERGE_WINDOW', 0.2))  # 最快结果到达后等待其他服务的时间(秒)
+    SEARCH_MAX_RESULTS = int(os.environ.get('SEARCH_MAX_RESULTS', 5))
+    SEARCH_CACHE_TTL = float(os.environ.get('SEARCH_CACHE_TTL', 3600))
+    SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE', 256))
+    SEARCH_LOCAL_LATENCY = float(os.environ.get('SEARCH_LOCAL_LATENCY', 0))  # 本地模拟搜索的响应时间(秒)
+    
+    # 案例库检索: 无参考材料时从已有案例(BM25索引)中取最相关的案例作为生成依据
+    CASE_INDEX_ENABLED = os.environ.get('CASE_INDEX_ENABLED', 'true').lower() == 'true'
+    CASE_INDEX_PATH = os.environ.get('CASE_INDEX_PATH')  # 索引快照，默认 instance/case_index.json
+    CASE_INDEX_TOP_K = int(os.environ.get('CASE_INDEX_TOP_K', 3))
+    CASE_INDEX_MIN_SCORE = float(os.environ.get('CASE_INDEX_MIN_SCORE', 0))
+    CASE_INDEX_EXCERPT_CHARS = int(os.environ.get('CASE_INDEX_EXCERPT_CHARS', 400))
+    
+    # 近似输入复用: 输入与已有案例近似时 suggest(提示已有案例) / reuse(直接复用，不调用模型) / off(不查找)
+    SIMILAR_INPUT_POLICY = os.environ.get('SIMILAR_INPUT_POLICY', 'suggest')
+    SIMILAR_INPUT_THRESHOLD = float(os.environ.get('SIMILAR_INPUT_THRESHOLD', 0.85))
+    
+    # 请求追踪: 请求、工作流步骤与模型调用的耗时汇总到 /metrics（Prometheus 文本格式）
+    TRACING_ENABLED = os.environ.get('TRACING_ENABLED', 'true').lower() == 'true'
+    TRACE_EXPORT_PATH = os.environ.get('TRACE_EXPORT_PATH')  # 设置后每个 span 写入一行 JSON，供离线分析
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # 设置后 /metrics 需携带 Authorization: Bearer <token>
+    
+    # API使用记录批量写入配置
+    USAGE_ASYNC_WRITE = os.environ.get('USAGE_ASYNC_WRITE', 'true').lower() == 'true'
+    USAGE_BATCH_SIZE = int(os.environ.get('USAGE_BATCH_SIZE', 50))
+    USAGE_FLUSH_INTERVAL = float(os.environ.get('USAGE_FLUSH_INTERVAL', 1.0))
+    USAGE_QUEUE_MAX = int(os.environ.get('USAGE_QUEUE_MAX', 10000))
+    USAGE_SPILL_PATH = os.environ.get('USAGE_SPILL_PATH')  # 默认 instance/usage_spill.jsonl
+    
+    # 模型目录配置（模型、上下文长度与定价来自 OpenRouter 模型接口）
+    MODEL_CATALOG_TTL = int(os.environ.get('MODEL_CATALOG_TTL', 3600))
+    MODEL_CATALOG_FEATURED = os.environ.get('MODEL_CATALOG_FEATURED', 'gpt-4o,gpt-4o-mini,claude-3-opus,claude-3-sonnet,claude-3-haiku')
+    MODEL_CATALOG_SNAPSHOT = os.environ.get('MODEL_CATALOG_SNAPSHOT')  # 默认 instance/model_catalog.json
+    KEY_VALIDATION_TTL = int(os.environ.get('KEY_VALIDATION_TTL', 600))
+    
     # 用户配置
     DEFAULT_USER_UUID = os.environ.get('DEFAULT_USER_UUID')
     DEFAULT_USER_NICKNAME = os.environ.get('DEFAULT_USER_NICKNAME', '案例改编用户')
@@ -42,6 +136,16 @@ class Config:
     CACHE_TYPE = "simple"
     CACHE_DEFAULT_TIMEOUT = 300
     
+    # LLM响应缓存配置（内存LRU + SQLite持久化）
+    LLM_CACHE_PATH = os.environ.get('LLM_CACHE_PATH')  # 默认为 instance/llm_cache.db
+    LLM_CACHE_MAX_ENTRIES = int(os.environ.get('LLM_CACHE_MAX_ENTRIES', 512))
+    LLM_CACHE_TTL = int(os.environ.get('LLM_CACHE_TTL', 86400))
+    LLM_CACHE_MAX_DISK_MB = float(os.environ.get('LLM_CACHE_MAX_DISK_MB', 256))
+    
+    # 相同进行中请求合并配置（等待超时为0时不限制，以上游请求超时为准）
+    LLM_COALESCE_ENABLED = os.environ.get('LLM_COALESCE_ENABLED', 'true').lower() == 'true'
+    LLM_COALESCE_WAIT_TIMEOUT = float(os.environ.get('LLM_COALESCE_WAIT_TIMEOUT', 0))
+    
     # 安全配置
     FRONTEND_PORT = int(os.environ.get('FRONTEND_PORT', 8866))
     CORS_ORIGINS = [
@@ -54,7 +158,23 @@ class Config:
     ]
     
     # 系统配置
-    MAX_DAILY_REQUESTS = int(os.environ.get('MAX_DAILY_REQUESTS', 100))
+    MAX_DAILY_REQUESTS = int(os.environ.get('MAX_DAILY_REQUESTS', 100))  # 系统配置 max_daily_requests 优先
+    
+    # 用户请求配额（工作流执行前检查，超限返回429）: memory(进程内计数) / redis(多进程共享计数)
+    QUOTA_ENABLED = os.environ.get('QUOTA_ENABLED', 'true').lower() == 'true'
+    RATE_LIMIT_PER_MINUTE = int(os.environ.get('RATE_LIMIT_PER_MINUTE', 10))
+    QUOTA_BACKEND = os.environ.get('QUOTA_BACKEND', 'memory')
+    QUOTA_REDIS_URL = os.environ.get('QUOTA_REDIS_URL', 'redis://localhost:6379/0')
+    
+    # 后台任务（/api/workflow/jobs）：工作线程数、队列上限、退出时等待任务完成的最长秒数
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+    JOB_QUEUE_MAX = int(os.environ.get('JOB_QUEUE_MAX', 1000))
+    JOB_DRAIN_TIMEOUT = float(os.environ.get('JOB_DRAIN_TIMEOUT', 30))
+    # 运行中任务的心跳间隔；心跳超过 JOB_STALE_AFTER 秒未更新的任务视为执行进程已退出，重新排队
+    JOB_HEARTBEAT_INTERVAL = float(os.environ.get('JOB_HEARTBEAT_INTERVAL', 15))
+    JOB_STALE_AFTER = float(os.environ.get('JOB_STALE_AFTER', 60))
+    # 批量任务（/api/workflow/batches）单次提交的最大行数
+    BATCH_MAX_ROWS = int(os.environ.get('BATCH_MAX_ROWS', 200))
     ENABLE_REGISTRATION = os.environ.get('ENABLE_REGISTRATION', 'true').lower() == 'true'
     MAINTENANCE_MODE = os.environ.get('MAINTENANCE_MODE', 'false').lower() == 'true'
     LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
@@ -3,5 +3,7 @@ from .conversation import Conversation, Message
 from .case import Case
 from .api_usage import APIUsage
 from .system_config import SystemConfig
+from .workflow_job import WorkflowJob
+from .step_output import StepOutput
 
-__all__ = ['User', 'Conversation', 'Message', 'Case', 'APIUsage', 'SystemConfig'] 
\ No newline at end of file
+__all__ = ['User', 'Conversation', 'Message', 'Case', 'APIUsage', 'SystemConfig', 'WorkflowJob', 'StepOutput'] 
\ No newline at end of file
@@ -13,10 +13,17 @@ class APIUsage(db.Model):
     request_type = db.Column(db.String(50))  # 请求类型: 案例改编/题目生成/etc
     workflow_step = db.Column(db.String(100))  # 具体的工作流步骤
     session_id = db.Column(db.String(36))  # 会话ID，便于关联
+    cache_status = db.Column(db.String(20))  # 缓存状态: cached表示命中响应缓存，为空表示实际调用
+    prompt_tokens = db.Column(db.Integer)  # 接口返回的提示词token数
+    completion_tokens = db.Column(db.Integer)  # 接口返回的输出token数
+    cached_tokens = db.Column(db.Integer)  # 提示词中命中服务端前缀缓存的token数
+    estimated_prompt_tokens = db.Column(db.Integer)  # 调用前本地估算的提示词token数
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     def __init__(self, user_uuid, model_name, tokens_used=0, cost=0.0, 
-                 request_type=None, workflow_step=None, session_id=None):
+                 request_type=None, workflow_step=None, session_id=None, cache_status=None,
+                 prompt_tokens=None, completion_tokens=None, cached_tokens=None,
+                 estimated_prompt_tokens=None):
         self.user_uuid = user_uuid
         self.model_name = model_name
         self.tokens_used = tokens_used
@@ -24,6 +31,11 @@ class APIUsage(db.Model):
         self.request_type = request_type
         self.workflow_step = workflow_step
         self.session_id = session_id
+        self.cache_status = cache_status
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.cached_tokens = cached_tokens
+        self.estimated_prompt_tokens = estimated_prompt_tokens
     
     def to_dict(self):
         """转换为字典格式"""
@@ -36,6 +48,11 @@ class APIUsage(db.Model):
             'request_type': self.request_type,
             'workflow_step': self.workflow_step,
             'session_id': self.session_id,
+            'cache_status': self.cache_status,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'cached_tokens': self.cached_tokens,
+            'estimated_prompt_tokens': self.estimated_prompt_tokens,
             'created_at': self.created_at.isoformat() if self.created_at else None
         }
     
@@ -76,7 +93,9 @@ class APIUsage(db.Model):
             func.sum(cls.tokens_used).label('total_tokens'),
             func.sum(cls.cost).label('total_cost'),
             func.count(cls.id).label('total_requests'),
-            func.count(func.distinct(cls.user_uuid)).label('active_users')
+            func.count(func.distinct(cls.user_uuid)).label('active_users'),
+            func.sum(cls.prompt_tokens).label('prompt_tokens'),
+            func.sum(cls.cached_tokens).label('cached_tokens')
         ).first()
         
         # 按模型统计
@@ -100,7 +119,9 @@ class APIUsage(db.Model):
                 'tokens': int(total_stats.total_tokens or 0),
                 'cost': float(total_stats.total_cost or 0),
                 'requests': int(total_stats.total_requests or 0),
-                'active_users': int(total_stats.active_users or 0)
+                'active_users': int(total_stats.active_users or 0),
+                'prompt_tokens': int(total_stats.prompt_tokens or 0),
+                'cached_tokens': int(total_stats.cached_tokens or 0)
             },
             'by_model': [
                 {
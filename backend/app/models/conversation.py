@@ -14,6 +14,7 @@ class Conversation(db.Model):
     
     # 关系
     messages = db.relationship('Message', backref='conversation', lazy='dynamic', cascade='all, delete-orphan')
+    step_outputs = db.relationship('StepOutput', backref='conversation', lazy='dynamic', cascade='all, delete-orphan')
     
     def __init__(self, user_uuid, title=None):
         self.user_uuid = user_uuid
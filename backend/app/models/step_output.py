@@ -0,0 +1,47 @@
+from datetime import datetime
+from .. import db
+
+class StepOutput(db.Model):
+    __tablename__ = 'step_outputs'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversations.id'), nullable=False, index=True)
+    step = db.Column(db.String(100), nullable=False)  # 工作流步骤，如 case_generation
+    input_hash = db.Column(db.String(64), nullable=False)  # 步骤输入的哈希，输入不变时复用输出
+    content = db.Column(db.Text, nullable=False)
+    model_used = db.Column(db.String(100))
+    tokens_used = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __init__(self, conversation_id, step, input_hash, content, model_used=None, tokens_used=0):
+        self.conversation_id = conversation_id
+        self.step = step
+        self.input_hash = input_hash
+        self.content = content
+        self.model_used = model_used
+        self.tokens_used = tokens_used
+    
+    def to_memo(self):
+        """转换为工作流引擎使用的步骤记录"""
+        return {
+            'input_hash': self.input_hash,
+            'content': self.content,
+            'model_used': self.model_used
+        }
+    
+    def to_dict(self, include_content=True):
+        """转换为字典格式"""
+        data = {
+            'id': self.id,
+            'step': self.step,
+            'input_hash': self.input_hash,
+            'model_used': self.model_used,
+            'tokens_used': self.tokens_used,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+        if include_content:
+            data['content'] = self.content
+        return data
+    
+    def __repr__(self):
+        return f'<StepOutput {self.conversation_id}: {self.step}>'
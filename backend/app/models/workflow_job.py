@@ -0,0 +1,102 @@
+from datetime import datetime
+from .. import db
+import json
+import uuid
+
+class WorkflowJob(db.Model):
+    __tablename__ = 'workflow_jobs'
+
+    # 任务状态
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    FINISHED_STATUSES = (SUCCEEDED, FAILED, CANCELLED)
+
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.String(36), unique=True, nullable=False, index=True)
+    kind = db.Column(db.String(50), nullable=False, default='workflow')  # 任务类型，对应注册的处理函数
+    user_uuid = db.Column(db.String(36), db.ForeignKey('users.uuid'), nullable=False)
+    session_id = db.Column(db.String(36))  # 关联的对话会话
+    batch_id = db.Column(db.String(36), index=True)  # 所属批量任务
+    row_index = db.Column(db.Integer)  # 在批量输入中的行号(从1开始)
+    status = db.Column(db.String(20), nullable=False, default=QUEUED, index=True)
+    input_data = db.Column(db.Text)  # 任务输入(JSON格式，不含API密钥)
+    progress = db.Column(db.Text)  # 已完成的步骤事件(JSON格式)
+    result = db.Column(db.Text)  # 任务结果(JSON格式)
+    error = db.Column(db.Text)
+    attempts = db.Column(db.Integer, default=0)  # 执行次数（服务重启后未完成的任务会重新执行）
+    owner = db.Column(db.String(100))  # 正在执行任务的进程标识
+    heartbeat_at = db.Column(db.DateTime)  # 执行进程最近一次心跳时间，超时未更新的运行中任务可被其他进程接管
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def __init__(self, user_uuid, input_data, kind='workflow', session_id=None, batch_id=None, row_index=None):
+        self.job_id = str(uuid.uuid4())
+        self.kind = kind
+        self.user_uuid = user_uuid
+        self.session_id = session_id
+        self.batch_id = batch_id
+        self.row_index = row_index
+        self.status = self.QUEUED
+        self.input_data = json.dumps(input_data, ensure_ascii=False)
+        self.progress = json.dumps([])
+        self.attempts = 0
+
+    def get_input(self):
+        """获取任务输入"""
+        return json.loads(self.input_data) if self.input_data else {}
+
+    def get_progress(self):
+        """获取步骤事件列表"""
+        if self.progress:
+            try:
+                return json.loads(self.progress)
+            except ValueError:
+                return []
+        return []
+
+    def set_progress(self, events):
+        self.progress = json.dumps(events, ensure_ascii=False)
+
+    def get_result(self):
+        """获取任务结果"""
+        if self.result:
+            try:
+                return json.loads(self.result)
+            except ValueError:
+                return None
+        return None
+
+    def set_result(self, result):
+        self.result = json.dumps(result, ensure_ascii=False) if result is not None else None
+
+    @property
+    def is_finished(self):
+        return self.status in self.FINISHED_STATUSES
+
+    def to_dict(self, include_progress=True):
+        """转换为字典格式"""
+        data = {
+            'job_id': self.job_id,
+            'kind': self.kind,
+            'user_uuid': self.user_uuid,
+            'session_id': self.session_id,
+            'batch_id': self.batch_id,
+            'row_index': self.row_index,
+            'status': self.status,
+            'result': self.get_result(),
+            'error': self.error,
+            'attempts': self.attempts,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+        if include_progress:
+            data['progress'] = self.get_progress()
+        return data
+
+    def __repr__(self):
+        return f'<WorkflowJob {self.job_id}: {self.status}>'
@@ -106,4 +106,44 @@ def get_system_overview():
         }), 200
         
     except Exception as e:
-        return jsonify({'error': f'获取系统统计失败: {str(e)}'}), 500 
\ No newline at end of file
+        return jsonify({'error': f'获取系统统计失败: {str(e)}'}), 500 
+
+@bp.route('/stats/runtime', methods=['GET'])
+@admin_required
+def get_runtime_stats():
+    """获取运行时指标（连接池等）"""
+    try:
+        from .workflow import openrouter_service, workflow_engine
+        from ..services.usage_recorder import usage_recorder
+        from ..services.db_metrics import db_metrics
+        from ..services.quota import quota_manager
+        from ..services.job_manager import job_manager
+        from ..services.search import search_service
+        from ..services.case_index import case_index
+        from ..services.similar_input import similar_input_cache
+        from ..services.tracing import tracer
+        
+        return jsonify({
+            'openrouter': {
+                'transport': openrouter_service.get_transport_stats(),
+                'response_cache': openrouter_service.get_cache_stats(),
+                'coalescing': openrouter_service.get_coalescing_stats(),
+                'scheduler': openrouter_service.get_scheduler_stats(),
+                'resilience': openrouter_service.get_resilience_stats(),
+                'routing': openrouter_service.get_routing_stats(),
+                'token_budget': openrouter_service.get_token_budget_stats(),
+                'model_catalog': openrouter_service.get_catalog_stats()
+            },
+            'usage_recorder': usage_recorder.get_stats(),
+            'quota': quota_manager.get_stats(),
+            'jobs': job_manager.get_stats(),
+            'dsl_workflow': workflow_engine.get_dsl_stats(),
+            'search': search_service.get_stats(),
+            'case_index': case_index.get_stats(),
+            'similar_input': similar_input_cache.get_stats(),
+            'tracing': tracer.get_stats(),
+            'database': db_metrics.get_stats()
+        }), 200
+        
+    except Exception as e:
+        return jsonify({'error': f'获取运行时指标失败: {str(e)}'}), 500
\ No newline at end of file
@@ -0,0 +1,19 @@
+from flask import Blueprint, Response, current_app, request, jsonify
+from ..services.tracing import tracer
+import hmac
+
+bp = Blueprint('metrics', __name__)
+
+@bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """以 Prometheus 文本格式输出请求、工作流步骤、模型调用与数据库提交的耗时直方图和计数"""
+    token = current_app.config.get('METRICS_TOKEN')
+    if token:
+        provided = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(provided, f'Bearer {token}'):
+            return jsonify({'error': '需要有效的指标访问令牌'}), 401
+    
+    if not tracer.enabled:
+        return jsonify({'error': '请求追踪未启用'}), 404
+    
+    return Response(tracer.render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
@@ -1,8 +1,17 @@
-from flask import Blueprint, request, jsonify
-from ..models import User, Conversation, Message, Case, APIUsage
+from flask import Blueprint, Response, current_app, request, jsonify, stream_with_context
+from ..models import User, Conversation, Message, Case, APIUsage, WorkflowJob, StepOutput
 from ..services.workflow_engine import WorkflowEngine
 from ..services.openrouter_service import OpenRouterService
+from ..services.quota import quota_manager
+from ..services.job_manager import job_manager, JobQueueFullError
+from ..services.similar_input import similar_input_cache
 from .. import db
+import ast
+import csv
+import io
+import json
+import time
+import uuid
 
 bp = Blueprint('workflow', __name__, url_prefix='/api/workflow')
 
@@ -10,91 +19,148 @@ bp = Blueprint('workflow', __name__, url_prefix='/api/workflow')
 openrouter_service = OpenRouterService()
 workflow_engine = WorkflowEngine(openrouter_service)
 
-@bp.route('/execute', methods=['POST'])
-def execute_workflow():
-    """执行案例改编工作流"""
-    try:
-        data = request.get_json()
-        
-        # 验证必需字段
-        required_fields = ['user_uuid', 'knowledgePoints', 'learningObjectives', 'caseScenario']
-        for field in required_fields:
-            if not data.get(field):
-                return jsonify({'error': f'缺少必需字段: {field}'}), 400
+def _get_or_create_user(user_uuid):
+    """获取用户，不存在时使用默认API密钥和模型自动创建（不提交）"""
+    user = User.query.filter_by(uuid=user_uuid).first()
+    if not user:
+        # 如果用户不存在，自动创建
+        user = User(
+            uuid=user_uuid,
+            nickname=f"用户_{user_uuid[:8]}"
+        )
         
-        # 获取或创建用户
-        user = User.query.filter_by(uuid=data['user_uuid']).first()
-        if not user:
-            # 如果用户不存在，自动创建
-            from flask import current_app
-            user = User(
-                uuid=data['user_uuid'],
-                nickname=f"用户_{data['user_uuid'][:8]}"
-            )
-            
-            # 如果配置了默认API密钥，设置给新用户
-            default_api_key = current_app.config.get('OPENROUTER_API_KEY')
-            if default_api_key:
-                user.set_api_key(default_api_key)
-                
-            # 如果配置了默认模型，设置给新用户
-            default_model = current_app.config.get('DEFAULT_MODEL')
-            if default_model:
-                user.preferred_model = default_model
+        # 如果配置了默认API密钥，设置给新用户
+        default_api_key = current_app.config.get('OPENROUTER_API_KEY')
+        if default_api_key:
+            user.set_api_key(default_api_key)
             
-            db.session.add(user)
-            db.session.flush()  # 获取用户ID但不提交
-        
-        if not user.is_active:
-            return jsonify({'error': '用户账户已被禁用'}), 403
+        # 如果配置了默认模型，设置给新用户
+        default_model = current_app.config.get('DEFAULT_MODEL')
+        if default_model:
+            user.preferred_model = default_model
         
-        if not user.get_api_key():
-            return jsonify({'error': '未配置API密钥，请在环境变量中设置OPENROUTER_API_KEY'}), 400
-        
-        # 创建新对话会话
-        conversation = Conversation(
-            user_uuid=user.uuid,
-            title=f"案例改编: {data.get('caseScenario', '')[:50]}"
-        )
-        db.session.add(conversation)
-        db.session.flush()  # 获取ID但不提交
-        
-        # 保存用户输入
-        user_message = Message(
-            conversation_id=conversation.id,
-            role='user',
-            content=str(data),
-            workflow_step='user_input'
+        db.session.add(user)
+        db.session.flush()  # 获取用户ID但不提交
+    return user
+
+def _check_user(user):
+    """检查用户能否执行工作流，返回错误响应或 None"""
+    if not user.is_active:
+        return jsonify({'error': '用户账户已被禁用'}), 403
+    
+    if not user.get_api_key():
+        return jsonify({'error': '未配置API密钥，请在环境变量中设置OPENROUTER_API_KEY'}), 400
+    return None
+
+def _check_quota(user, count=1, rate=True):
+    """检查用户配额（计入 count 次请求），返回429错误响应或 None"""
+    quota_error = quota_manager.check(user, count=count, rate=rate)
+    if quota_error:
+        return (
+            jsonify({'error': quota_error['error'], 'retry_after': quota_error['retry_after']}),
+            429,
+            {'Retry-After': str(quota_error['retry_after'])}
         )
-        db.session.add(user_message)
-        
-        # 准备工作流输入
-        workflow_input = {
-            'user_uuid': user.uuid,
-            'api_key': user.get_api_key(),
-            'model_name': user.get_preferred_model(),
-            'conversation_id': conversation.id,
-            'session_id': conversation.session_id,
-            **data
-        }
-        
-        # 执行工作流
-        print(f"DEBUG: 准备执行工作流，输入参数: {workflow_input}")
-        result = workflow_engine.execute_workflow(workflow_input)
-        print(f"DEBUG: 工作流执行结果: {result}")
-        
-        # 保存结果到数据库
-        if result.get('case_content'):
+    return None
+
+def _create_conversation(user, data):
+    """创建对话会话并保存用户输入（不提交）"""
+    conversation = Conversation(
+        user_uuid=user.uuid,
+        title=f"案例改编: {data.get('caseScenario', '')[:50]}"
+    )
+    db.session.add(conversation)
+    db.session.flush()  # 获取ID但不提交
+    
+    # 保存用户输入
+    user_message = Message(
+        conversation_id=conversation.id,
+        role='user',
+        content=json.dumps(data, ensure_ascii=False),
+        workflow_step='user_input'
+    )
+    db.session.add(user_message)
+    return conversation
+
+def _prepare_workflow(data):
+    """
+    校验输入、获取或创建用户并创建对话会话
+    
+    Returns:
+        (user, conversation, workflow_input, None) 或 (None, None, None, 错误响应)
+    """
+    # 验证必需字段
+    required_fields = ['user_uuid', 'knowledgePoints', 'learningObjectives', 'caseScenario']
+    for field in required_fields:
+        if not data.get(field):
+            return None, None, None, (jsonify({'error': f'缺少必需字段: {field}'}), 400)
+    
+    # 获取或创建用户
+    user = _get_or_create_user(data['user_uuid'])
+    user_error = _check_user(user)
+    if user_error:
+        return None, None, None, user_error
+    
+    # 调用模型前检查输入长度，避免超长材料在网络往返后才失败
+    budget_error = workflow_engine.check_prompt_budget({**data, 'model_name': user.get_preferred_model()})
+    if budget_error:
+        return None, None, None, (jsonify({'error': budget_error}), 413)
+    
+    # 检查用户配额（在开始任何模型调用之前）
+    quota_error = _check_quota(user)
+    if quota_error:
+        return None, None, None, quota_error
+    
+    # 创建新对话会话
+    conversation = _create_conversation(user, data)
+    # 调用模型前提交，避免在整个工作流期间持有数据库写锁
+    db.session.commit()
+    
+    return user, conversation, _build_workflow_input(user, conversation, data), None
+
+def _build_workflow_input(user, conversation, data):
+    """准备工作流输入（API密钥在执行时从用户记录读取，不随任务持久化）"""
+    return {
+        'user_uuid': user.uuid,
+        'api_key': user.get_api_key(),
+        'model_name': user.get_preferred_model(),
+        'conversation_id': conversation.id,
+        'session_id': conversation.session_id,
+        **data
+    }
+
+def _save_workflow_result(user, conversation, data, result):
+    """
+    保存工作流结果到数据库，返回保存的案例（如果有）
+    
+    从检查点恢复执行时，复用的步骤不重复保存消息，本次对话已入库的案例只补充题目；
+    复用其他对话的案例（近似输入）时为本次对话另存一个案例，不修改原案例
+    """
+    case = None
+    models_used = result.get('models_used') or {}
+    reused = set(result.get('steps_reused') or [])
+    
+    if result.get('case_content'):
+        if 'case_generation' in reused:
+            case = Case.query.filter(
+                Case.creator_uuid == user.uuid,
+                Case.content == result['case_content'],
+                Case.created_at >= conversation.created_at
+            ).order_by(Case.id.desc()).first()
+        else:
             assistant_message = Message(
                 conversation_id=conversation.id,
                 role='assistant',
                 content=result['case_content'],
                 workflow_step='case_generation',
-                model_used=user.get_preferred_model(),
+                model_used=models_used.get('case_generation') or user.get_preferred_model(),
                 tokens_used=result.get('tokens_used', 0)
             )
             db.session.add(assistant_message)
-            
+        
+        if case:
+            case.questions = result.get('questions') or case.questions
+        else:
             # 保存案例到案例库
             case = Case(
                 title=result.get('case_title', f"案例: {data['caseScenario']}"),
@@ -107,33 +173,716 @@ def execute_workflow():
                 questions=result.get('questions')
             )
             db.session.add(case)
+    
+    question_steps = [step for step in result.get('steps_completed') or [] if step.startswith('question_')]
+    if result.get('questions') and any(step not in reused for step in question_steps):
+        questions_message = Message(
+            conversation_id=conversation.id,
+            role='assistant',
+            content=str(result['questions']),
+            workflow_step='question_generation',
+            model_used=models_used.get('question_generation') or user.get_preferred_model(),
+            tokens_used=result.get('questions_tokens_used', 0)
+        )
+        db.session.add(questions_message)
+    
+    db.session.commit()
+    return case
+
+def _checkpoint_events(conversation, events):
+    """
+    转发工作流事件，每个步骤完成时立即提交步骤输出作为检查点
+    
+    后续步骤失败或进程中断时，已完成步骤的结果不会丢失，恢复执行时按输入哈希直接复用
+    """
+    for event in events:
+        if (event['event'] == 'step_finished' and event.get('input_hash')
+                and not event.get('memoized') and not event.get('degraded')):
+            try:
+                db.session.add(StepOutput(
+                    conversation_id=conversation.id,
+                    step=event['step'],
+                    input_hash=event['input_hash'],
+                    content=event['content'],
+                    model_used=event.get('model_used'),
+                    tokens_used=event.get('tokens_used', 0)
+                ))
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"保存步骤检查点失败: {str(e)}")
+        yield event
+
+def _load_conversation_input(conversation):
+    """读取对话最近一次保存的工作流输入"""
+    message = conversation.messages.filter_by(workflow_step='user_input').order_by(Message.id.desc()).first()
+    if not message:
+        return None
+    try:
+        return json.loads(message.content)
+    except ValueError:
+        # 早期版本以 str(dict) 格式保存
+        try:
+            return ast.literal_eval(message.content)
+        except (ValueError, SyntaxError):
+            return None
+
+def _load_step_memo(conversation, workflow_input):
+    """
+    读取对话已保存的步骤输出，供工作流按输入哈希复用
+    
+    早期对话没有步骤输出记录，以案例消息作为原始输入对应的案例生成结果
+    """
+    memo = {}
+    for output in conversation.step_outputs.order_by(StepOutput.id.asc()).all():
+        memo[output.step] = output.to_memo()
+    
+    if 'case_generation' not in memo:
+        message = conversation.messages.filter(
+            Message.workflow_step.in_(['case_generation', 'case_regeneration'])
+        ).order_by(Message.id.desc()).first()
+        if message:
+            memo['case_generation'] = {
+                'input_hash': workflow_engine.step_input_hash('case_generation', workflow_input),
+                'content': message.content,
+                'model_used': message.model_used
+            }
+    return memo
+
+def _find_similar_case(user, data):
+    """
+    按近似输入策略查找已有案例，返回带策略的匹配结果或 None
+    
+    提供了参考材料的请求按材料生成，不查找近似输入
+    """
+    policy = similar_input_cache.resolve_policy(data.get('similarCase'))
+    if policy == 'off' or data.get('caseMaterials'):
+        return None
+    try:
+        matches = similar_input_cache.lookup(data, user_uuid=user.uuid)
+    except Exception as e:
+        print(f"查找近似输入失败: {str(e)}")
+        return None
+    if not matches:
+        return None
+    return {**matches[0], 'policy': policy}
+
+def _reuse_similar_case(user, conversation, workflow_input, match):
+    """
+    复用近似输入已生成的案例
+    
+    只复用案例正文：案例写入本次对话并保存为案例生成检查点。已有案例的题目按原请求的
+    题型与考核目标生成，不复用；需要题目时返回 None，调用方按检查点继续执行（只按本次输入生成题目），
+    否则不调用模型，直接返回结果摘要。案例已不存在时返回 None 并按正常流程生成。
+    """
+    case = Case.query.get(match['case_id'])
+    if not case:
+        return None
+    
+    db.session.add(Message(
+        conversation_id=conversation.id,
+        role='assistant',
+        content=case.content,
+        workflow_step='case_generation',
+        tokens_used=0
+    ))
+    db.session.add(StepOutput(
+        conversation_id=conversation.id,
+        step='case_generation',
+        input_hash=workflow_engine.step_input_hash('case_generation', workflow_input),
+        content=case.content
+    ))
+    db.session.commit()
+    
+    similar_input_cache.record_reuse(
+        openrouter_service.token_budget.estimate_text(case.content, workflow_input.get('model_name'))
+    )
+    if workflow_input.get('yes_or_no') == '是':
+        return None
+    
+    return {
+        'success': True,
+        'error': None,
+        'session_id': conversation.session_id,
+        'case_content': case.content,
+        'questions': None,
+        'case_id': case.id,
+        'tokens_used': 0,
+        'models_used': {},
+        'steps_completed': [],
+        'steps_reused': ['case_generation'],
+        'similar_case': match
+    }
+
+@bp.route('/execute', methods=['POST'])
+def execute_workflow():
+    """执行案例改编工作流"""
+    try:
+        data = request.get_json()
         
-        if result.get('questions'):
-            questions_message = Message(
-                conversation_id=conversation.id,
-                role='assistant',
-                content=str(result['questions']),
-                workflow_step='question_generation',
-                model_used=user.get_preferred_model(),
-                tokens_used=result.get('questions_tokens_used', 0)
-            )
-            db.session.add(questions_message)
+        user, conversation, workflow_input, error_response = _prepare_workflow(data)
+        if error_response:
+            return error_response
         
-        db.session.commit()
+        # 输入与已有案例近似时按策略提示或直接复用
+        similar_case = _find_similar_case(user, data)
+        if similar_case and similar_case['policy'] == 'reuse':
+            summary = _reuse_similar_case(user, conversation, workflow_input, similar_case)
+            if summary:
+                return jsonify(summary), 200
+        
+        # 执行工作流
+        # 每个步骤完成时保存检查点，后续步骤失败可通过 /resume 继续执行
+        # （复用近似案例但需要补充题目时，案例生成按检查点复用）
+        memo = _load_step_memo(conversation, workflow_input) if similar_case else None
+        result = None
+        events = workflow_engine.iter_workflow_events(workflow_input, stream=False, memo=memo)
+        for event in _checkpoint_events(conversation, events):
+            if event['event'] == 'workflow_finished':
+                result = event['result']
+        
+        # 保存结果到数据库
+        case = _save_workflow_result(user, conversation, data, result)
         
         return jsonify({
             'success': True,
             'session_id': conversation.session_id,
             'case_content': result.get('case_content'),
             'questions': result.get('questions'),
-            'case_id': case.id if 'case' in locals() else None,
-            'tokens_used': result.get('total_tokens_used', 0)
+            'case_id': case.id if case else None,
+            'tokens_used': result.get('total_tokens_used', 0),
+            'models_used': result.get('models_used', {}),
+            'steps_completed': result.get('steps_completed', []),
+            'similar_case': similar_case
         }), 200
         
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': f'工作流执行失败: {str(e)}'}), 500
 
+@bp.route('/similar', methods=['POST'])
+def find_similar_cases():
+    """查找与工作流输入近似的已有案例（不创建对话、不调用模型），供客户端在生成前提示用户"""
+    try:
+        data = request.get_json() or {}
+        
+        required_fields = ['user_uuid', 'knowledgePoints', 'caseScenario']
+        for field in required_fields:
+            if not data.get(field):
+                return jsonify({'error': f'缺少必需字段: {field}'}), 400
+        
+        if similar_input_cache.resolve_policy(None) == 'off':
+            return jsonify({'success': True, 'matches': []}), 200
+        
+        limit = min(max(int(data.get('limit', 3)), 1), 10)
+        matches = similar_input_cache.lookup(data, user_uuid=data['user_uuid'], limit=limit)
+        return jsonify({'success': True, 'matches': matches}), 200
+        
+    except (TypeError, ValueError):
+        return jsonify({'error': 'limit 必须是整数'}), 400
+    except Exception as e:
+        return jsonify({'error': f'查找近似案例失败: {str(e)}'}), 500
+
+def _summarize_result(conversation, result, case):
+    """工作流结束时返回给客户端的结果摘要"""
+    return {
+        'success': result.get('success', False),
+        'error': result.get('error'),
+        'session_id': conversation.session_id,
+        'case_content': result.get('case_content'),
+        'questions': result.get('questions'),
+        'case_id': case.id if case else None,
+        'tokens_used': result.get('total_tokens_used', 0),
+        'models_used': result.get('models_used', {}),
+        'steps_completed': result.get('steps_completed', [])
+    }
+
+def _format_sse(event_name, payload):
+    """格式化为 text/event-stream 消息"""
+    return f"event: {event_name}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+@bp.route('/execute/stream', methods=['POST'])
+def execute_workflow_stream():
+    """以SSE流式方式执行案例改编工作流，逐步推送步骤事件与模型增量输出"""
+    try:
+        data = request.get_json()
+        
+        user, conversation, workflow_input, error_response = _prepare_workflow(data)
+        if error_response:
+            return error_response
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'工作流执行失败: {str(e)}'}), 500
+    
+    def generate():
+        try:
+            yield _format_sse('workflow_started', {'session_id': conversation.session_id})
+            
+            similar_case = _find_similar_case(user, data)
+            if similar_case:
+                yield _format_sse('similar_case_found', {'event': 'similar_case_found', **similar_case})
+                if similar_case['policy'] == 'reuse':
+                    summary = _reuse_similar_case(user, conversation, workflow_input, similar_case)
+                    if summary:
+                        yield _format_sse('workflow_finished', summary)
+                        return
+            
+            memo = _load_step_memo(conversation, workflow_input) if similar_case else None
+            result = None
+            events = workflow_engine.iter_workflow_events(workflow_input, stream=True, memo=memo)
+            for event in _checkpoint_events(conversation, events):
+                if event['event'] == 'workflow_finished':
+                    result = event['result']
+                    continue
+                yield _format_sse(event['event'], event)
+            
+            case = _save_workflow_result(user, conversation, data, result)
+            
+            yield _format_sse('workflow_finished', _summarize_result(conversation, result, case))
+            
+        except Exception as e:
+            db.session.rollback()
+            yield _format_sse('error', {'error': f'工作流执行失败: {str(e)}'})
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+def _wait_for_rate_quota(user, context):
+    """等待每分钟配额，任务被取消时返回 False"""
+    while not context.cancelled:
+        quota_error = quota_manager.check(user, daily=False)
+        if not quota_error:
+            return True
+        context.wait(quota_error['retry_after'])
+    return False
+
+def _run_workflow_job(data, context):
+    """后台任务处理函数：在工作线程中执行工作流，步骤事件写入任务进度"""
+    user = User.query.filter_by(uuid=context.user_uuid).first()
+    conversation = Conversation.query.filter_by(session_id=context.session_id).first()
+    if not user or not conversation:
+        return {'success': False, 'error': '用户或对话不存在'}
+    if not user.get_api_key():
+        return {'success': False, 'error': '未配置API密钥，请在环境变量中设置OPENROUTER_API_KEY'}
+    
+    # 批量任务的每一行在执行前占用一次每分钟配额（每日配额已在提交时计入），超限时等待
+    if context.job.batch_id and not _wait_for_rate_quota(user, context):
+        return {'success': False, 'error': '任务已取消'}
+    
+    workflow_input = _build_workflow_input(user, conversation, data)
+    workflow_input.setdefault('priority', 'bulk')
+    
+    # 重新执行的任务（服务重启或批量任务恢复）复用已完成步骤的检查点
+    memo = _load_step_memo(conversation, workflow_input)
+    if not memo:
+        similar_case = _find_similar_case(user, data)
+        if similar_case:
+            context.emit({'event': 'similar_case_found', **similar_case})
+            if similar_case['policy'] == 'reuse':
+                summary = _reuse_similar_case(user, conversation, workflow_input, similar_case)
+                if summary:
+                    return summary
+                memo = _load_step_memo(conversation, workflow_input)
+    result = None
+    events = workflow_engine.iter_workflow_events(workflow_input, stream=True, memo=memo)
+    try:
+        for event in _checkpoint_events(conversation, events):
+            if context.cancelled:
+                return {'success': False, 'error': '任务已取消'}
+            if event['event'] == 'workflow_finished':
+                result = event['result']
+                continue
+            # 模型增量输出只推送给在线订阅者，步骤事件写入任务进度
+            context.emit(event, persist=event['event'] != 'token')
+    finally:
+        events.close()
+    
+    case = _save_workflow_result(user, conversation, data, result)
+    return _summarize_result(conversation, result, case)
+
+job_manager.register('workflow', _run_workflow_job)
+
+@bp.route('/jobs', methods=['POST'])
+def submit_workflow_job():
+    """提交后台执行的案例改编任务，立即返回任务ID"""
+    try:
+        data = request.get_json()
+        
+        user, conversation, workflow_input, error_response = _prepare_workflow(data)
+        if error_response:
+            return error_response
+        
+        job = job_manager.submit('workflow', user.uuid, data, session_id=conversation.session_id)
+        
+        return jsonify({
+            'success': True,
+            'job_id': job.job_id,
+            'session_id': conversation.session_id,
+            'status': job.status,
+            'status_url': f'/api/workflow/jobs/{job.job_id}',
+            'events_url': f'/api/workflow/jobs/{job.job_id}/events'
+        }), 202
+        
+    except JobQueueFullError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '30'}
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'提交任务失败: {str(e)}'}), 500
+
+@bp.route('/jobs/<job_id>', methods=['GET'])
+def get_workflow_job(job_id):
+    """查询后台任务状态、已完成的步骤与结果"""
+    try:
+        job = WorkflowJob.query.filter_by(job_id=job_id).first()
+        if not job:
+            return jsonify({'error': '任务不存在'}), 404
+        
+        include_progress = request.args.get('progress', 'true').lower() == 'true'
+        return jsonify({'job': job.to_dict(include_progress=include_progress)}), 200
+        
+    except Exception as e:
+        return jsonify({'error': f'获取任务状态失败: {str(e)}'}), 500
+
+def _iter_live_events(live_events, skip_persisted=0):
+    """转发运行中任务的事件，跳过已从任务记录中回放过的步骤事件"""
+    for event in live_events:
+        if event is None:
+            yield ': keep-alive\n\n'
+            continue
+        if skip_persisted and event['event'] != 'token':
+            skip_persisted -= 1
+            continue
+        yield _format_sse(event['event'], event)
+
+@bp.route('/jobs/<job_id>/events', methods=['GET'])
+def stream_workflow_job_events(job_id):
+    """
+    以SSE方式推送后台任务事件
+    
+    任务在本进程运行时推送全部事件（含模型增量输出）；否则回放已保存的步骤事件，
+    并轮询任务记录直至任务结束。
+    """
+    job = WorkflowJob.query.filter_by(job_id=job_id).first()
+    if not job:
+        return jsonify({'error': '任务不存在'}), 404
+    
+    def generate():
+        live_events = job_manager.subscribe(job_id)
+        if live_events is not None:
+            yield from _iter_live_events(live_events)
+            return
+        
+        sent = 0
+        while True:
+            # 结束当前事务，读取任务的最新状态
+            db.session.rollback()
+            current = WorkflowJob.query.filter_by(job_id=job_id).first()
+            progress = current.get_progress()
+            for event in progress[sent:]:
+                yield _format_sse(event['event'], event)
+            sent = len(progress)
+            
+            if current.is_finished:
+                yield _format_sse('job_finished', {
+                    'event': 'job_finished',
+                    'job_id': job_id,
+                    'status': current.status,
+                    'error': current.error,
+                    'result': current.get_result()
+                })
+                return
+            
+            live_events = job_manager.subscribe(job_id)
+            if live_events is not None:
+                yield from _iter_live_events(live_events, skip_persisted=sent)
+                return
+            time.sleep(1.0)
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@bp.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_workflow_job(job_id):
+    """取消后台任务"""
+    try:
+        status = job_manager.cancel(job_id)
+        if status is None:
+            return jsonify({'error': '任务不存在'}), 404
+        
+        return jsonify({'success': True, 'job_id': job_id, 'status': status}), 200
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'取消任务失败: {str(e)}'}), 500
+
+def _parse_batch_rows(text, fmt):
+    """解析JSONL或CSV格式的批量输入，返回行字典列表"""
+    if fmt == 'csv':
+        reader = csv.DictReader(io.StringIO(text))
+        return [
+            {key.strip(): (value or '').strip() for key, value in row.items() if key}
+            for row in reader
+        ]
+    rows = []
+    for line_number, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            raise ValueError(f'第{line_number}行不是有效的JSON')
+        if not isinstance(row, dict):
+            raise ValueError(f'第{line_number}行不是JSON对象')
+        rows.append(row)
+    return rows
+
+def _read_batch_request():
+    """
+    读取批量请求：支持上传文件(file字段)、JSONL/CSV请求体，或 {"user_uuid", "rows"} JSON
+    
+    Returns:
+        (user_uuid, 行字典列表)
+    """
+    upload = request.files.get('file')
+    if upload is not None:
+        fmt = 'csv' if (upload.filename or '').lower().endswith('.csv') else 'jsonl'
+        text = upload.read().decode('utf-8-sig')
+        user_uuid = request.form.get('user_uuid') or request.args.get('user_uuid')
+        return user_uuid, _parse_batch_rows(text, fmt)
+    
+    if request.is_json:
+        data = request.get_json() or {}
+        rows = data.get('rows') or []
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise ValueError('rows 必须是对象数组')
+        return data.get('user_uuid'), rows
+    
+    fmt = 'csv' if 'csv' in (request.content_type or '') else 'jsonl'
+    text = request.get_data().decode('utf-8-sig')
+    return request.args.get('user_uuid'), _parse_batch_rows(text, fmt)
+
+def _prepare_batch_row(user, row):
+    """校验一行输入并为其创建对话会话，返回 job_manager.submit_batch 的行描述"""
+    data = {key: value for key, value in row.items() if value not in (None, '')}
+    data['user_uuid'] = user.uuid
+    # 提供了题目类型时默认生成题目
+    if data.get('questionType') and not data.get('yes_or_no'):
+        data['yes_or_no'] = '是'
+    
+    for field in ('knowledgePoints', 'learningObjectives', 'caseScenario'):
+        if not data.get(field):
+            return {'input': data, 'error': f'缺少必需字段: {field}'}
+    
+    budget_error = workflow_engine.check_prompt_budget({**data, 'model_name': user.get_preferred_model()})
+    if budget_error:
+        return {'input': data, 'error': budget_error}
+    
+    conversation = _create_conversation(user, data)
+    return {'input': data, 'session_id': conversation.session_id}
+
+def _batch_row(job):
+    """批量任务中一行的执行结果"""
+    return {
+        'row': job.row_index,
+        'job_id': job.job_id,
+        'status': job.status,
+        'session_id': job.session_id,
+        'error': job.error,
+        'result': job.get_result()
+    }
+
+def _batch_summary(batch_id, jobs):
+    counts = {status: 0 for status in (WorkflowJob.QUEUED, WorkflowJob.RUNNING) + WorkflowJob.FINISHED_STATUSES}
+    for job in jobs:
+        counts[job.status] = counts.get(job.status, 0) + 1
+    return {
+        'batch_id': batch_id,
+        'total': len(jobs),
+        'finished': all(job.is_finished for job in jobs),
+        'counts': counts
+    }
+
+def _get_batch_jobs(batch_id):
+    return WorkflowJob.query.filter_by(batch_id=batch_id).order_by(WorkflowJob.row_index.asc()).all()
+
+@bp.route('/batches', methods=['POST'])
+def submit_workflow_batch():
+    """
+    提交批量案例改编任务
+    
+    每行输入对应一个后台任务（各自保存结果），由后台工作线程以批量优先级执行，
+    上游并发受每个API密钥的并发上限约束。校验失败的行直接记为失败，不影响其他行。
+    """
+    try:
+        try:
+            user_uuid, rows = _read_batch_request()
+        except (ValueError, UnicodeDecodeError, csv.Error) as e:
+            return jsonify({'error': f'批量输入格式错误: {str(e)}'}), 400
+        
+        if not user_uuid:
+            return jsonify({'error': '缺少必需字段: user_uuid'}), 400
+        if not rows:
+            return jsonify({'error': '批量输入为空'}), 400
+        max_rows = current_app.config.get('BATCH_MAX_ROWS', 200)
+        if len(rows) > max_rows:
+            return jsonify({'error': f'单个批量任务最多{max_rows}行，当前{len(rows)}行'}), 413
+        
+        user = _get_or_create_user(user_uuid)
+        user_error = _check_user(user)
+        if user_error:
+            return user_error
+        
+        batch_id = str(uuid.uuid4())
+        prepared = [_prepare_batch_row(user, row) for row in rows]
+        
+        # 每个待执行的行计入一次每日配额，超出剩余次数时整个批量任务不提交；
+        # 每分钟配额在各行执行前占用
+        accepted = sum(1 for row in prepared if not row.get('error'))
+        if accepted:
+            quota_error = _check_quota(user, count=accepted, rate=False)
+            if quota_error:
+                db.session.rollback()
+                return quota_error
+        
+        jobs = job_manager.submit_batch('workflow', user.uuid, prepared, batch_id)
+        
+        return jsonify({
+            'success': True,
+            'batch_id': batch_id,
+            'total': len(jobs),
+            'accepted': sum(1 for job in jobs if job.status == WorkflowJob.QUEUED),
+            'rejected': sum(1 for job in jobs if job.status == WorkflowJob.FAILED),
+            'rows': [
+                {'row': job.row_index, 'job_id': job.job_id, 'status': job.status, 'error': job.error}
+                for job in jobs
+            ],
+            'status_url': f'/api/workflow/batches/{batch_id}',
+            'results_url': f'/api/workflow/batches/{batch_id}/results'
+        }), 202
+        
+    except JobQueueFullError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '30'}
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'提交批量任务失败: {str(e)}'}), 500
+
+@bp.route('/batches/<batch_id>', methods=['GET'])
+def get_workflow_batch(batch_id):
+    """查询批量任务进度与各行状态"""
+    try:
+        jobs = _get_batch_jobs(batch_id)
+        if not jobs:
+            return jsonify({'error': '批量任务不存在'}), 404
+        
+        summary = _batch_summary(batch_id, jobs)
+        summary['rows'] = [
+            {'row': job.row_index, 'job_id': job.job_id, 'status': job.status,
+             'session_id': job.session_id, 'error': job.error, 'attempts': job.attempts}
+            for job in jobs
+        ]
+        return jsonify(summary), 200
+        
+    except Exception as e:
+        return jsonify({'error': f'获取批量任务状态失败: {str(e)}'}), 500
+
+@bp.route('/batches/<batch_id>/results', methods=['GET'])
+def stream_workflow_batch_results(batch_id):
+    """
+    以NDJSON方式返回批量任务结果
+    
+    先输出已完成的行，再按完成顺序逐行输出，全部结束后输出一行 batch_finished 汇总；
+    wait=false 时只输出当前已完成的行。
+    """
+    if not _get_batch_jobs(batch_id):
+        return jsonify({'error': '批量任务不存在'}), 404
+    wait = request.args.get('wait', 'true').lower() == 'true'
+    
+    def generate():
+        sent = set()
+        while True:
+            # 结束当前事务，读取各行的最新状态
+            db.session.rollback()
+            jobs = _get_batch_jobs(batch_id)
+            for job in jobs:
+                if job.is_finished and job.job_id not in sent:
+                    sent.add(job.job_id)
+                    yield json.dumps(_batch_row(job), ensure_ascii=False) + '\n'
+            
+            summary = _batch_summary(batch_id, jobs)
+            if summary['finished'] or not wait:
+                yield json.dumps({'event': 'batch_finished' if summary['finished'] else 'batch_pending',
+                                  **summary}, ensure_ascii=False) + '\n'
+                return
+            time.sleep(1.0)
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@bp.route('/batches/<batch_id>/resume', methods=['POST'])
+def resume_workflow_batch(batch_id):
+    """重新执行批量任务中失败或已取消的行，已成功的行不会重复执行"""
+    try:
+        jobs = _get_batch_jobs(batch_id)
+        if not jobs:
+            return jsonify({'error': '批量任务不存在'}), 404
+        
+        # 输入校验失败的行没有对话会话，需修正输入后重新提交
+        retryable = [job for job in jobs if job.session_id]
+        # 与提交时相同，每个重新执行的行计入一次每日配额
+        retry_count = sum(1 for job in retryable if job.status in (WorkflowJob.FAILED, WorkflowJob.CANCELLED))
+        if retry_count:
+            user = User.query.filter_by(uuid=jobs[0].user_uuid).first()
+            quota_error = _check_quota(user, count=retry_count, rate=False)
+            if quota_error:
+                return quota_error
+        
+        requeued = job_manager.requeue(retryable)
+        
+        return jsonify({
+            'success': True,
+            'batch_id': batch_id,
+            'requeued': [job.row_index for job in requeued],
+            'results_url': f'/api/workflow/batches/{batch_id}/results'
+        }), 202
+        
+    except JobQueueFullError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '30'}
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'恢复批量任务失败: {str(e)}'}), 500
+
+@bp.route('/batches/<batch_id>', methods=['DELETE'])
+def cancel_workflow_batch(batch_id):
+    """取消批量任务中尚未完成的行"""
+    try:
+        jobs = _get_batch_jobs(batch_id)
+        if not jobs:
+            return jsonify({'error': '批量任务不存在'}), 404
+        
+        pending = [job.job_id for job in jobs if not job.is_finished]
+        for job_id in pending:
+            job_manager.cancel(job_id)
+        
+        return jsonify({'success': True, 'batch_id': batch_id, 'cancelled': len(pending)}), 200
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'取消批量任务失败: {str(e)}'}), 500
+
 @bp.route('/conversations/<user_uuid>', methods=['GET'])
 def get_user_conversations(user_uuid):
     """获取用户的对话历史"""
@@ -175,9 +924,13 @@ def get_conversation_details(session_id):
         messages = Message.query.filter_by(conversation_id=conversation.id)\
             .order_by(Message.created_at.asc()).all()
         
+        # 已完成步骤的检查点
+        checkpoints = conversation.step_outputs.order_by(StepOutput.id.asc()).all()
+        
         return jsonify({
             'conversation': conversation.to_dict(),
-            'messages': [msg.to_dict() for msg in messages]
+            'messages': [msg.to_dict() for msg in messages],
+            'checkpoints': [output.to_dict(include_content=False) for output in checkpoints]
         }), 200
         
     except Exception as e:
@@ -201,9 +954,35 @@ def delete_conversation(session_id):
         db.session.rollback()
         return jsonify({'error': f'删除对话失败: {str(e)}'}), 500
 
+def _load_session(session_id):
+    """
+    读取对话、用户与保存的工作流输入
+    
+    Returns:
+        (conversation, user, 工作流输入, None) 或 (None, None, None, 错误响应)
+    """
+    conversation = Conversation.query.filter_by(session_id=session_id).first()
+    if not conversation:
+        return None, None, None, (jsonify({'error': '对话不存在'}), 404)
+    
+    user = User.query.filter_by(uuid=conversation.user_uuid).first()
+    if not user or not user.get_api_key():
+        return None, None, None, (jsonify({'error': '用户信息无效'}), 400)
+    
+    stored_input = _load_conversation_input(conversation)
+    if stored_input is None:
+        return None, None, None, (jsonify({'error': '对话缺少原始输入，无法继续执行'}), 400)
+    
+    return conversation, user, stored_input, None
+
 @bp.route('/regenerate', methods=['POST'])
 def regenerate_content():
-    """重新生成内容"""
+    """
+    重新生成内容
+    
+    读取对话保存的输入与步骤输出，只重新执行指定步骤及其下游步骤：重新生成题目时复用已有案例，
+    重新生成案例时题目随之更新。请求中的其他字段（如 difficultyLevel）覆盖原输入。
+    """
     try:
         data = request.get_json()
         
@@ -212,47 +991,142 @@ def regenerate_content():
             if not data.get(field):
                 return jsonify({'error': f'缺少必需字段: {field}'}), 400
         
-        conversation = Conversation.query.filter_by(session_id=data['session_id']).first()
-        if not conversation:
-            return jsonify({'error': '对话不存在'}), 404
-        
-        user = User.query.filter_by(uuid=conversation.user_uuid).first()
-        if not user or not user.get_api_key():
-            return jsonify({'error': '用户信息无效'}), 400
-        
-        # 根据步骤重新生成内容
         step = data['step']
-        if step == 'case':
-            # 重新生成案例
-            result = workflow_engine.regenerate_case(data, user)
-        elif step == 'questions':
-            # 重新生成题目
-            result = workflow_engine.regenerate_questions(data, user)
-        else:
+        if step not in workflow_engine.REGENERATION_STEPS:
             return jsonify({'error': '未知的生成步骤'}), 400
         
+        conversation, user, stored_input, error_response = _load_session(data['session_id'])
+        if error_response:
+            return error_response
+        
+        quota_error = _check_quota(user)
+        if quota_error:
+            return quota_error
+        
+        memo = _load_step_memo(conversation, _build_workflow_input(user, conversation, stored_input))
+        overrides = {
+            key: value for key, value in data.items()
+            if key not in ('session_id', 'step', 'user_uuid') and value is not None
+        }
+        workflow_data = {**stored_input, **overrides}
+        if overrides:
+            # 保存修改后的输入，后续重新生成以此为准
+            db.session.add(Message(
+                conversation_id=conversation.id,
+                role='user',
+                content=json.dumps(workflow_data, ensure_ascii=False),
+                workflow_step='user_input'
+            ))
+        # 调用模型前提交，避免持有数据库写锁
+        db.session.commit()
+        
+        workflow_input = _build_workflow_input(user, conversation, workflow_data)
+        result = None
+        new_steps = {}
+        events = workflow_engine.iter_regeneration_events(workflow_input, step, memo)
+        for event in _checkpoint_events(conversation, events):
+            if event['event'] == 'step_finished' and not event.get('memoized'):
+                new_steps[event['step']] = event
+            elif event['event'] == 'workflow_finished':
+                result = event['result']
+        
+        if not result['success']:
+            return jsonify({
+                'error': f"重新生成失败: {result.get('error')}",
+                'steps_completed': result.get('steps_completed', [])
+            }), 500
+        
         # 保存新消息
-        new_message = Message(
-            conversation_id=conversation.id,
-            role='assistant',
-            content=result['content'],
-            workflow_step=f'{step}_regeneration',
-            model_used=user.model_name,
-            tokens_used=result.get('tokens_used', 0)
-        )
-        db.session.add(new_message)
+        models_used = result.get('models_used') or {}
+        if 'case_generation' in new_steps:
+            db.session.add(Message(
+                conversation_id=conversation.id,
+                role='assistant',
+                content=result['case_content'],
+                workflow_step='case_regeneration',
+                model_used=models_used.get('case_generation') or user.get_preferred_model(),
+                tokens_used=new_steps['case_generation'].get('tokens_used', 0)
+            ))
+        question_steps = [name for name in new_steps if name.startswith('question_')]
+        if result.get('questions') and question_steps:
+            db.session.add(Message(
+                conversation_id=conversation.id,
+                role='assistant',
+                content=result['questions'],
+                workflow_step='questions_regeneration',
+                model_used=models_used.get('question_generation') or user.get_preferred_model(),
+                tokens_used=sum(new_steps[name].get('tokens_used', 0) for name in question_steps)
+            ))
         db.session.commit()
         
         return jsonify({
             'success': True,
             'content': result['content'],
-            'tokens_used': result.get('tokens_used', 0)
+            'case_content': result.get('case_content'),
+            'questions': result.get('questions'),
+            'tokens_used': result.get('total_tokens_used', 0),
+            'steps_completed': result.get('steps_completed', []),
+            'steps_reused': result.get('steps_reused', []),
+            'models_used': models_used
         }), 200
         
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': f'重新生成失败: {str(e)}'}), 500
 
+@bp.route('/resume', methods=['POST'])
+def resume_workflow():
+    """
+    从检查点继续执行工作流
+    
+    已完成步骤的输出按输入哈希直接复用，只执行失败或尚未执行的步骤，
+    适用于题目生成失败、请求超时或服务中断后的重试。
+    """
+    try:
+        data = request.get_json() or {}
+        if not data.get('session_id'):
+            return jsonify({'error': '缺少必需字段: session_id'}), 400
+        
+        conversation, user, stored_input, error_response = _load_session(data['session_id'])
+        if error_response:
+            return error_response
+        
+        quota_error = _check_quota(user)
+        if quota_error:
+            return quota_error
+        
+        workflow_input = _build_workflow_input(user, conversation, stored_input)
+        memo = _load_step_memo(conversation, workflow_input)
+        
+        result = None
+        events = workflow_engine.iter_workflow_events(workflow_input, stream=False, memo=memo)
+        for event in _checkpoint_events(conversation, events):
+            if event['event'] == 'workflow_finished':
+                result = event['result']
+        
+        case = _save_workflow_result(user, conversation, stored_input, result)
+        
+        return jsonify({
+            **_summarize_result(conversation, result, case),
+            'steps_reused': result.get('steps_reused', [])
+        }), 200
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'恢复执行失败: {str(e)}'}), 500
+
+@bp.route('/models', methods=['GET'])
+def get_models():
+    """获取模型列表（含上下文长度与定价），all=true 时返回模型目录中的全部模型"""
+    try:
+        include_all = request.args.get('all', 'false').lower() == 'true'
+        return jsonify({
+            'models': openrouter_service.get_available_models(include_all=include_all)
+        }), 200
+        
+    except Exception as e:
+        return jsonify({'error': f'获取模型列表失败: {str(e)}'}), 500
+
 @bp.route('/status', methods=['GET'])
 def get_workflow_status():
     """获取工作流状态"""
@@ -260,13 +1134,7 @@ def get_workflow_status():
         return jsonify({
             'status': 'active',
             'version': '1.0.0',
-            'available_models': [
-                'gpt-4o',
-                'gpt-4o-mini',
-                'claude-3-opus',
-                'claude-3-sonnet',
-                'claude-3-haiku'
-            ],
+            'available_models': [model['id'] for model in openrouter_service.get_available_models()],
             'supported_features': [
                 'case_adaptation',
                 'question_generation',
@@ -0,0 +1,446 @@
+import asyncio
+import concurrent.futures
+import json
+import threading
+import time
+import weakref
+from typing import Callable, Dict, List, Optional, Tuple
+
+import httpx
+from flask import current_app
+
+from .openrouter_service import OpenRouterService
+from .resilience import CircuitOpenError
+from .scheduler import Lease, QueueTimeoutError
+from .tracing import Span, tracer
+
+
+class AsyncOpenRouterService:
+    """
+    基于 asyncio 的 OpenRouter 客户端
+
+    与 OpenRouterService.chat_completion 使用相同的请求参数、返回格式、模型路由与用量记录逻辑，
+    适合在单个线程内并发发起大量模型调用。读写数据库与磁盘缓存等阻塞操作在线程中执行，不阻塞事件循环。
+    """
+
+    def __init__(self, openrouter_service: OpenRouterService, max_concurrency: int = None,
+                 max_connections: int = 100):
+        self.openrouter = openrouter_service
+        self.max_concurrency = max_concurrency
+        self.max_connections = max_connections
+        self._client: Optional[httpx.AsyncClient] = None
+        # 每个事件循环一把锁：同一事件循环内的阻塞调用共用所在线程的数据库会话
+        self._blocking_locks = weakref.WeakKeyDictionary()
+        self._blocking_locks_guard = threading.Lock()
+        # 进行中的异步请求（合并键 -> 结果 future），相同的异步请求等待该 future
+        self._flights: Dict[str, concurrent.futures.Future] = {}
+        self._flights_lock = threading.Lock()
+
+    def _new_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections
+            )
+        )
+
+    async def __aenter__(self) -> 'AsyncOpenRouterService':
+        self._client = self._new_client()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _get_max_concurrency(self) -> int:
+        if self.max_concurrency:
+            return self.max_concurrency
+        try:
+            return current_app.config.get('OPENROUTER_ASYNC_CONCURRENCY', 8)
+        except RuntimeError:
+            return 8
+
+    async def _run_blocking(self, func, *args, **kwargs):
+        """
+        在线程中执行会阻塞的调用（数据库查询、响应缓存、用量记录）
+
+        线程继承当前应用上下文，共用同一个数据库会话，因此同一事件循环内的这些调用逐个执行；
+        不同线程中的事件循环（如并发的 run_many）各自使用独立的会话，互不等待
+        """
+        loop = asyncio.get_running_loop()
+        with self._blocking_locks_guard:
+            lock = self._blocking_locks.get(loop)
+            if lock is None:
+                lock = self._blocking_locks[loop] = asyncio.Lock()
+        async with lock:
+            return await asyncio.to_thread(func, *args, **kwargs)
+
+    async def chat_completion(self, messages: List[Dict], model_name: str = None, api_key: str = None,
+                              user_uuid: str = None, session_id: str = None,
+                              request_type: str = None, workflow_step: str = None, **kwargs) -> Dict:
+        """
+        异步调用OpenRouter聊天完成API，参数与返回值同 OpenRouterService.chat_completion
+        """
+        parent_span = tracer.current_span()
+        if self._client is not None:
+            return await self._chat_completion(self._client, messages, model_name, api_key, user_uuid,
+                                               session_id, request_type, workflow_step, parent_span, **kwargs)
+
+        async with self._new_client() as client:
+            return await self._chat_completion(client, messages, model_name, api_key, user_uuid,
+                                               session_id, request_type, workflow_step, parent_span, **kwargs)
+
+    async def _chat_completion(self, client: httpx.AsyncClient, messages: List[Dict], model_name: str,
+                               api_key: str, user_uuid: str, session_id: str, request_type: str,
+                               workflow_step: str, parent_span: Optional[Span] = None, **kwargs) -> Dict:
+        """
+        按路由策略依次尝试候选模型，规则同 OpenRouterService.chat_completion
+
+        每个请求记录一个 llm.chat span，父 span 由调用方显式传入（事件循环中的任务不一定继承调用方的当前 span）
+        """
+        model_name = model_name or self.openrouter.get_default_model()
+        # 异步客户端只返回完整响应
+        kwargs.pop('stream', None)
+        candidates = await self._run_blocking(
+            self.openrouter._route, model_name, kwargs.pop('routing_policy', None)
+        )
+
+        span = tracer.start_span('llm.chat', parent=parent_span, model=model_name, step=workflow_step)
+        token = tracer.activate(span)
+        result = None
+        try:
+            for index, candidate in enumerate(candidates):
+                result = await self._chat_completion_once(
+                    client, messages, candidate, api_key, user_uuid, session_id,
+                    request_type, workflow_step, **kwargs
+                )
+                result['model_used'] = candidate
+                if result['success'] or not self.openrouter._is_failover_error(result) or index == len(candidates) - 1:
+                    break
+                # 当前模型不可用，切换到下一个候选模型
+                self.openrouter.model_router.record_failover()
+        finally:
+            self.openrouter._end_llm_span(span, result)
+            tracer.deactivate(token, parent_span)
+        return result
+
+    async def _chat_completion_once(self, client: httpx.AsyncClient, messages: List[Dict], model_name: str,
+                                    api_key: str, user_uuid: str, session_id: str, request_type: str,
+                                    workflow_step: str, **kwargs) -> Dict:
+        """使用指定模型异步调用一次聊天完成API（含缓存与重试）"""
+        api_key = api_key or self.openrouter.get_default_api_key()
+
+        if not api_key:
+            return {
+                'success': False,
+                'error': 'API密钥未设置，请在环境变量或用户设置中配置OpenRouter API密钥'
+            }
+
+        headers = self.openrouter._build_headers(api_key)
+        payload = self.openrouter._build_payload(messages, model_name, **kwargs)
+
+        cache_key = await self._run_blocking(self.openrouter._get_cache_key, payload, kwargs.get('use_cache'))
+        if cache_key:
+            cached = await self._run_blocking(self.openrouter.response_cache.get, cache_key)
+            if cached is not None:
+                if user_uuid:
+                    await self._run_blocking(
+                        self.openrouter._log_api_usage,
+                        user_uuid=user_uuid,
+                        model_name=model_name,
+                        response=cached,
+                        session_id=session_id,
+                        request_type=request_type,
+                        workflow_step=workflow_step,
+                        cache_status='cached'
+                    )
+                return {
+                    'success': True,
+                    'data': cached,
+                    'response_time': 0.0,
+                    'cached': True
+                }
+
+        start_time = time.time()
+        priority = kwargs.get('priority')
+        usage_context = self.openrouter._usage_context(user_uuid, session_id, request_type, workflow_step, **kwargs)
+        flight_key = self.openrouter._get_flight_key(payload, api_key, kwargs.get('use_cache'))
+        if not flight_key:
+            return await self._request_completion(
+                client, model_name, api_key, headers, payload, cache_key, user_uuid, priority, usage_context
+            )
+
+        result, leader = await self._join_flight(
+            flight_key,
+            lambda: self._request_completion(
+                client, model_name, api_key, headers, payload, cache_key, user_uuid, priority, usage_context
+            ),
+            lambda: self.openrouter._request_completion(
+                model_name, api_key, headers, payload, cache_key, user_uuid, priority, usage_context
+            )
+        )
+
+        if result['success'] and not leader:
+            result['coalesced'] = True
+            result['response_time'] = time.time() - start_time
+
+            # 上游请求已由发起请求的代码计费，合并的调用方只记一条零成本的归属记录
+            if user_uuid:
+                await self._run_blocking(
+                    self.openrouter._log_api_usage,
+                    model_name=model_name,
+                    response=result['data'],
+                    response_time=result['response_time'],
+                    cache_status='coalesced',
+                    **usage_context
+                )
+
+        return result
+
+    async def _join_flight(self, key: str, request: Callable, fallback: Callable) -> Tuple[Dict, bool]:
+        """
+        合并相同的进行中请求，返回 (结果, 是否为发起请求的调用方)
+
+        相同的异步请求等待第一个请求的结果 future，不占用线程；第一个请求同时加入 single_flight，
+        与同步客户端的相同请求合并：由它发起时同步调用方等待其结果，它被取消时仍在等待的同步调用方
+        在自己的线程中调用 fallback 重新发起；同步请求先发起时在线程中等待其结果。
+        """
+        with self._flights_lock:
+            pending = self._flights.get(key)
+            owner = pending is None
+            if owner:
+                pending = self._flights[key] = concurrent.futures.Future()
+
+        if not owner:
+            self.openrouter.single_flight.record_follower()
+            try:
+                return dict(await asyncio.shield(asyncio.wrap_future(pending))), False
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise
+            # 发起请求的协程已取消，重新发起
+            return await self._join_flight(key, request, fallback)
+
+        def producer():
+            try:
+                yield pending.result()
+            except concurrent.futures.CancelledError:
+                yield fallback()
+
+        try:
+            events, leader = self.openrouter.single_flight.join(key, producer)
+            if leader:
+                result = await request()
+                pending.set_result(result)
+                # 结果已就绪，推进 single_flight 中的请求结束不会等待
+                list(events)
+            else:
+                try:
+                    results = await asyncio.to_thread(list, events)
+                except TimeoutError as e:
+                    results = [{'success': False, 'error': str(e), 'transient': True}]
+                result = results[-1] if results else {'success': False, 'error': 'API请求已取消'}
+                pending.set_result(result)
+            return result, leader
+        finally:
+            if not pending.done():
+                pending.cancel()
+            with self._flights_lock:
+                if self._flights.get(key) is pending:
+                    del self._flights[key]
+
+    async def _request_completion(self, client: httpx.AsyncClient, model_name: str, api_key: str, headers: Dict,
+                                  payload: Dict, cache_key: Optional[str], user_uuid: str = None,
+                                  priority: str = None, usage_context: Optional[Dict] = None) -> Dict:
+        """异步发起一次上游聊天请求，规则同 OpenRouterService._request_completion"""
+        timeout = await self._run_blocking(self.openrouter.get_timeout)
+        # 与同步客户端共用按API密钥的并发名额（在事件循环中等待名额，不占用线程）
+        lease = self.openrouter.scheduler.lease(api_key, user_uuid, priority or 'interactive')
+        try:
+            await lease.acquire_async()
+        except QueueTimeoutError as e:
+            return {'success': False, 'error': str(e), 'queue_timeout': True}
+
+        try:
+            start_time = time.time()
+
+            response, retries = await self._post_with_retry(
+                client, model_name, headers,
+                json.dumps(payload, ensure_ascii=False).encode('utf-8'),
+                timeout, lease
+            )
+
+            response_time = time.time() - start_time
+
+            if response.status_code == 200:
+                result = response.json()
+
+                if cache_key:
+                    await self._run_blocking(self.openrouter.response_cache.set, cache_key, result)
+
+                if usage_context and usage_context.get('user_uuid'):
+                    await self._run_blocking(
+                        self.openrouter._log_api_usage,
+                        model_name=model_name,
+                        response=result,
+                        response_time=response_time,
+                        **usage_context
+                    )
+
+                return {
+                    'success': True,
+                    'data': result,
+                    'response_time': response_time,
+                    'retries': retries
+                }
+            else:
+                return {
+                    'success': False,
+                    'error': f"API请求失败: {response.status_code} - {response.text}",
+                    'status_code': response.status_code,
+                    'retries': retries
+                }
+
+        except CircuitOpenError as e:
+            return {
+                'success': False,
+                'error': str(e),
+                'circuit_open': True
+            }
+        except QueueTimeoutError as e:
+            return {'success': False, 'error': str(e), 'queue_timeout': True}
+        except httpx.TimeoutException:
+            return {
+                'success': False,
+                'error': 'API请求超时，请稍后重试',
+                'transient': True
+            }
+        except httpx.TransportError:
+            return {
+                'success': False,
+                'error': '网络连接错误，请检查网络连接',
+                'transient': True
+            }
+        except Exception as e:
+            return {
+                'success': False,
+                'error': f'API调用异常: {str(e)}'
+            }
+        finally:
+            lease.release()
+
+    async def _post_with_retry(self, client: httpx.AsyncClient, model_name: str, headers: Dict,
+                               body: bytes, timeout: float, lease: Optional[Lease] = None):
+        """异步发送请求，重试与熔断规则同 OpenRouterService._post_with_retry（退避期间归还并发名额）"""
+        breaker = self.openrouter.circuit_breakers.get(model_name)
+        policy = self.openrouter.retry_policy
+        attempt = 0
+
+        while True:
+            breaker.before_request()
+            attempt_start = time.time()
+            try:
+                response = await client.post(
+                    f"{self.openrouter.base_url}/chat/completions",
+                    headers=headers,
+                    content=body,
+                    timeout=timeout
+                )
+            except httpx.TransportError as e:
+                breaker.record_failure()
+                self.openrouter.model_router.record(model_name, time.time() - attempt_start, success=False)
+                reason = 'timeout' if isinstance(e, httpx.TimeoutException) else 'connection_error'
+                delay = policy.get_delay(attempt) if attempt < policy.max_retries else None
+                if delay is None:
+                    policy.record_outcome(attempt > 0, success=False)
+                    raise
+                policy.record_retry(reason)
+                await self._backoff(delay, lease)
+                attempt += 1
+                continue
+            except Exception:
+                breaker.record_failure()
+                raise
+
+            if response.status_code >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+
+            if response.status_code == 200 or policy.is_retryable_status(response.status_code):
+                self.openrouter.model_router.record(
+                    model_name, time.time() - attempt_start, success=response.status_code == 200
+                )
+
+            if policy.is_retryable_status(response.status_code) and attempt < policy.max_retries:
+                retry_after = policy.parse_retry_after(response.headers.get('Retry-After'))
+                delay = policy.get_delay(attempt, retry_after)
+                if delay is not None:
+                    policy.record_retry(f'http_{response.status_code}')
+                    await self._backoff(delay, lease)
+                    attempt += 1
+                    continue
+
+            policy.record_outcome(attempt > 0, success=response.status_code == 200)
+            return response, attempt
+
+    @staticmethod
+    async def _backoff(delay: float, lease: Optional[Lease]):
+        """退避等待，期间归还并发名额"""
+        if lease is None:
+            await asyncio.sleep(delay)
+            return
+        lease.release()
+        await asyncio.sleep(delay)
+        await lease.acquire_async()
+
+    async def chat_completion_many(self, requests: List[Dict], max_concurrency: int = None,
+                                   parent_span: Optional[Span] = None) -> List[Dict]:
+        """
+        并发执行多个聊天请求
+
+        Args:
+            requests: 请求参数列表，每项为 chat_completion 的关键字参数
+            max_concurrency: 最大并发数（默认读取 OPENROUTER_ASYNC_CONCURRENCY）
+            parent_span: 各请求 llm.chat span 的父 span（默认取当前 span）
+
+        Returns:
+            与 requests 顺序一致的结果列表
+        """
+        semaphore = asyncio.Semaphore(max_concurrency or self._get_max_concurrency())
+        parent_span = parent_span or tracer.current_span()
+
+        async def run_one(client: httpx.AsyncClient, request_kwargs: Dict) -> Dict:
+            request_kwargs = dict(request_kwargs)
+            async with semaphore:
+                return await self._chat_completion(
+                    client,
+                    request_kwargs.pop('messages'),
+                    request_kwargs.pop('model_name', None),
+                    request_kwargs.pop('api_key', None),
+                    request_kwargs.pop('user_uuid', None),
+                    request_kwargs.pop('session_id', None),
+                    request_kwargs.pop('request_type', None),
+                    request_kwargs.pop('workflow_step', None),
+                    parent_span,
+                    **request_kwargs
+                )
+
+        if self._client is not None:
+            return list(await asyncio.gather(*(run_one(self._client, r) for r in requests)))
+
+        # 每次批量调用使用独立的客户端，避免多个线程共享同一个事件循环绑定的连接池
+        async with self._new_client() as client:
+            return list(await asyncio.gather(*(run_one(client, r) for r in requests)))
+
+    def run_many(self, requests: List[Dict], max_concurrency: int = None) -> List[Dict]:
+        """
+        在同步代码（如Flask请求线程）中并发执行多个聊天请求
+
+        当前线程的应用上下文会随 asyncio 任务一同传递，用量记录照常写入数据库；
+        各请求的 llm.chat span 挂在调用线程的当前 span（如工作流步骤）下。
+        """
+        return asyncio.run(self.chat_completion_many(
+            requests, max_concurrency=max_concurrency, parent_span=tracer.current_span()
+        ))
@@ -0,0 +1,98 @@
+import threading
+from typing import Callable, Dict, Iterable
+
+
+class CaseChangeHook:
+    """
+    案例变更的事务钩子
+
+    flush 时记录新增、修改与删除的案例，事务提交后通知各订阅者，回滚时丢弃。
+    每个订阅者只关心自己的字段：修改的案例只有这些字段变化时才通知该订阅者
+    （例如查看、点赞计数不影响检索索引）。
+    """
+
+    PENDING_KEY = 'case_changes_pending'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers: Dict[str, Dict] = {}
+        self._installed = False
+
+    def subscribe(self, name: str, fields: Iterable[str], snapshot: Callable,
+                  on_upsert: Callable, on_remove: Callable):
+        """
+        注册订阅者（同名订阅者会被替换）
+
+        Args:
+            name: 订阅者名称，用于错误日志
+            fields: 关心的案例字段
+            snapshot: snapshot(case) 在 flush 时读取案例字段，返回传给 on_upsert 的数据
+            on_upsert: on_upsert(case_id, fields) 案例新增或字段变化后调用
+            on_remove: on_remove(case_id) 案例删除后调用
+        """
+        from sqlalchemy import event
+        from sqlalchemy.orm import Session
+
+        with self._lock:
+            self._subscribers[name] = {
+                'fields': tuple(fields),
+                'snapshot': snapshot,
+                'on_upsert': on_upsert,
+                'on_remove': on_remove
+            }
+            if not self._installed:
+                event.listen(Session, 'after_flush', self._after_flush)
+                event.listen(Session, 'after_commit', self._after_commit)
+                event.listen(Session, 'after_rollback', self._after_rollback)
+                self._installed = True
+
+    def _after_flush(self, session, flush_context):
+        from ..models import Case
+
+        from sqlalchemy import inspect
+
+        with self._lock:
+            subscribers = dict(self._subscribers)
+        if not subscribers:
+            return
+
+        pending = session.info.setdefault(self.PENDING_KEY, {})
+        for obj in session.new:
+            if isinstance(obj, Case) and obj.id is not None:
+                for name, subscriber in subscribers.items():
+                    pending.setdefault(name, {})[obj.id] = subscriber['snapshot'](obj)
+        for obj in session.dirty:
+            if isinstance(obj, Case) and obj.id is not None:
+                attrs = inspect(obj).attrs
+                for name, subscriber in subscribers.items():
+                    if any(attrs[field].history.has_changes() for field in subscriber['fields']):
+                        pending.setdefault(name, {})[obj.id] = subscriber['snapshot'](obj)
+        for obj in session.deleted:
+            if isinstance(obj, Case) and obj.id is not None:
+                for name in subscribers:
+                    pending.setdefault(name, {})[obj.id] = None
+
+    def _after_commit(self, session):
+        pending = session.info.pop(self.PENDING_KEY, None)
+        if not pending:
+            return
+        with self._lock:
+            subscribers = dict(self._subscribers)
+        for name, changes in pending.items():
+            subscriber = subscribers.get(name)
+            if subscriber is None:
+                continue
+            for case_id, fields in changes.items():
+                try:
+                    if fields is None:
+                        subscriber['on_remove'](case_id)
+                    else:
+                        subscriber['on_upsert'](case_id, fields)
+                except Exception as e:
+                    print(f"更新{name}失败: {str(e)}")
+
+    def _after_rollback(self, session):
+        session.info.pop(self.PENDING_KEY, None)
+
+
+case_changes = CaseChangeHook()
@@ -0,0 +1,312 @@
+import atexit
+import json
+import math
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter
+from typing import Dict, List, Optional
+
+# 连续的汉字按字二元组切分，字母数字按词切分
+_CJK_RUN = re.compile(r'[㐀-䶿一-鿿豈-﫿]+')
+_WORD = re.compile(r'[a-z0-9]+(?:[._-][a-z0-9]+)*')
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    中文感知的分词：汉字连续片段切分为相邻二字组（单字片段保留单字），
+    英文与数字按词切分并转为小写
+    """
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    tokens = []
+    for run in _CJK_RUN.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[index:index + 2] for index in range(len(run) - 1))
+    tokens.extend(_WORD.findall(_CJK_RUN.sub(' ', text)))
+    return tokens
+
+
+class CaseIndex:
+    """
+    案例库 BM25 索引
+
+    对案例的标题、知识点、场景、考核目标与正文建立倒排索引（标题、知识点和场景加权），
+    工作流无参考材料时从中取出最相关的若干案例作为生成依据，不访问外部服务。
+    索引保存为磁盘快照，启动时加载快照后只补充索引新增或修改过的案例、移除已删除的案例；
+    运行期间在案例提交后随数据库事务增量更新。
+    """
+
+    # 字段 -> 词频权重
+    FIELD_WEIGHTS = {
+        'title': 2,
+        'knowledge_points': 2,
+        'case_scenario': 2,
+        'learning_objectives': 1,
+        'content': 1
+    }
+
+    # 变化时需要重新索引的字段
+    INDEXED_FIELDS = tuple(FIELD_WEIGHTS) + ('difficulty_level', 'creator_uuid', 'is_public')
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75, excerpt_chars: int = 400,
+                 snapshot_path: Optional[str] = None):
+        self.k1 = k1
+        self.b = b
+        self.excerpt_chars = excerpt_chars
+        self.snapshot_path = snapshot_path
+        self.enabled = True
+
+        self.app = None
+        self._lock = threading.RLock()
+        self._docs: Dict[int, Dict] = {}
+        self._postings: Dict[str, Dict[int, int]] = {}
+        self._total_length = 0
+        self._dirty = False
+        self._atexit_registered = False
+        self._stats = {'queries': 0, 'query_ms_total': 0.0, 'updates': 0, 'removals': 0,
+                       'synced': 0, 'last_sync_ms': None, 'loaded_from_snapshot': 0}
+
+    def init_app(self, app, db):
+        """加载快照、与数据库同步，并订阅案例变更"""
+        from .case_events import case_changes
+
+        self.app = app
+        self.enabled = app.config.get('CASE_INDEX_ENABLED', True)
+        self.excerpt_chars = app.config.get('CASE_INDEX_EXCERPT_CHARS', self.excerpt_chars)
+        self.snapshot_path = app.config.get('CASE_INDEX_PATH') or os.path.join(app.instance_path, 'case_index.json')
+        if not self.enabled:
+            return
+
+        # 案例提交后增量更新索引
+        case_changes.subscribe('案例索引', self.INDEXED_FIELDS, self._case_fields, self.upsert, self.remove)
+
+        self.load_snapshot()
+        with app.app_context():
+            try:
+                self.sync()
+            except Exception as e:
+                print(f"同步案例索引失败: {str(e)}")
+
+        if not self._atexit_registered:
+            atexit.register(self.save_snapshot)
+            self._atexit_registered = True
+
+    @staticmethod
+    def _version(case) -> Optional[str]:
+        updated_at = case.updated_at or case.created_at
+        return updated_at.isoformat() if updated_at else None
+
+    def _case_fields(self, case) -> Dict:
+        return {
+            'version': self._version(case),
+            'title': case.title or '',
+            'knowledge_points': case.knowledge_points or '',
+            'case_scenario': case.case_scenario or '',
+            'learning_objectives': case.learning_objectives or '',
+            'content': case.content or '',
+            'difficulty_level': case.difficulty_level,
+            'creator_uuid': case.creator_uuid,
+            'is_public': bool(case.is_public)
+        }
+
+    def upsert(self, case_id: int, fields: Dict):
+        """索引（或重新索引）一个案例"""
+        terms = Counter()
+        for field, weight in self.FIELD_WEIGHTS.items():
+            for token in tokenize(fields.get(field, '')):
+                terms[token] += weight
+        content = ' '.join((fields.get('content') or '').split())
+        doc = {
+            'version': fields.get('version'),
+            'title': fields.get('title', ''),
+            'knowledge_points': fields.get('knowledge_points', ''),
+            'case_scenario': fields.get('case_scenario', ''),
+            'difficulty_level': fields.get('difficulty_level'),
+            'creator_uuid': fields.get('creator_uuid'),
+            'is_public': fields.get('is_public', False),
+            'excerpt': content[:self.excerpt_chars],
+            'terms': dict(terms),
+            'length': sum(terms.values())
+        }
+        with self._lock:
+            self._remove_locked(case_id)
+            self._add_locked(case_id, doc)
+            self._stats['updates'] += 1
+            self._dirty = True
+
+    def remove(self, case_id: int):
+        with self._lock:
+            if self._remove_locked(case_id):
+                self._stats['removals'] += 1
+                self._dirty = True
+
+    def _add_locked(self, case_id: int, doc: Dict):
+        self._docs[case_id] = doc
+        self._total_length += doc['length']
+        for term, frequency in doc['terms'].items():
+            self._postings.setdefault(term, {})[case_id] = frequency
+
+    def _remove_locked(self, case_id: int) -> bool:
+        doc = self._docs.pop(case_id, None)
+        if doc is None:
+            return False
+        self._total_length -= doc['length']
+        for term in doc['terms']:
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(case_id, None)
+                if not postings:
+                    del self._postings[term]
+        return True
+
+    def sync(self, batch_size: int = 500):
+        """与数据库比对版本（更新时间），只重新索引新增或修改过的案例，移除已删除的案例"""
+        from ..models import Case
+        from .. import db
+
+        started = time.perf_counter()
+        versions = {
+            case_id: (updated_at or created_at).isoformat() if (updated_at or created_at) else None
+            for case_id, updated_at, created_at in db.session.query(Case.id, Case.updated_at, Case.created_at)
+        }
+        with self._lock:
+            removed = [case_id for case_id in self._docs if case_id not in versions]
+            stale = [case_id for case_id, version in versions.items()
+                     if case_id not in self._docs or self._docs[case_id]['version'] != version]
+        for case_id in removed:
+            self.remove(case_id)
+        for offset in range(0, len(stale), batch_size):
+            for case in Case.query.filter(Case.id.in_(stale[offset:offset + batch_size])).all():
+                self.upsert(case.id, self._case_fields(case))
+
+        with self._lock:
+            self._stats['synced'] += len(stale) + len(removed)
+            self._stats['last_sync_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        if stale or removed:
+            self.save_snapshot()
+
+    def rebuild(self):
+        """清空后从数据库重新建立索引"""
+        with self._lock:
+            self._docs = {}
+            self._postings = {}
+            self._total_length = 0
+        self.sync()
+
+    def search(self, query: str, top_k: int = 3, user_uuid: str = None,
+               exclude_ids: List[int] = None, min_score: float = 0.0) -> List[Dict]:
+        """
+        按 BM25 返回最相关的案例
+
+        只返回公开案例和 user_uuid 本人创建的案例，得分低于 min_score 的案例不返回
+
+        Returns:
+            [{'id', 'score', 'title', 'knowledge_points', 'case_scenario', 'difficulty_level', 'excerpt'}]
+        """
+        started = time.perf_counter()
+        terms = Counter(tokenize(query))
+        excluded = set(exclude_ids or [])
+        scores: Dict[int, float] = {}
+        with self._lock:
+            total_docs = len(self._docs)
+            if terms and total_docs:
+                average_length = self._total_length / total_docs or 1.0
+                for term, query_frequency in terms.items():
+                    postings = self._postings.get(term)
+                    if not postings:
+                        continue
+                    idf = math.log(1 + (total_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for case_id, frequency in postings.items():
+                        length = self._docs[case_id]['length']
+                        norm = frequency + self.k1 * (1 - self.b + self.b * length / average_length)
+                        scores[case_id] = scores.get(case_id, 0.0) + query_frequency * idf * frequency * (self.k1 + 1) / norm
+
+            results = []
+            for case_id, score in sorted(scores.items(), key=lambda item: item[1], reverse=True):
+                if score < min_score:
+                    break
+                doc = self._docs[case_id]
+                if case_id in excluded or not (doc['is_public'] or (user_uuid and doc['creator_uuid'] == user_uuid)):
+                    continue
+                results.append({
+                    'id': case_id,
+                    'score': round(score, 4),
+                    'title': doc['title'],
+                    'knowledge_points': doc['knowledge_points'],
+                    'case_scenario': doc['case_scenario'],
+                    'difficulty_level': doc['difficulty_level'],
+                    'excerpt': doc['excerpt']
+                })
+                if len(results) >= top_k:
+                    break
+            self._stats['queries'] += 1
+            self._stats['query_ms_total'] += (time.perf_counter() - started) * 1000
+        return results
+
+    @staticmethod
+    def format_context(results: List[Dict]) -> str:
+        """将检索到的案例整理为提示词中的参考材料"""
+        blocks = []
+        for index, item in enumerate(results, start=1):
+            labels = '；'.join(
+                f'{name}：{item[field]}' for field, name in
+                (('case_scenario', '场景'), ('knowledge_points', '知识点')) if item.get(field)
+            )
+            header = f"{index}. {item['title']}" + (f"（{labels}）" if labels else '')
+            blocks.append(f"{header}\n{item['excerpt']}")
+        return '\n\n'.join(blocks)
+
+    def load_snapshot(self) -> bool:
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return False
+        try:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            with self._lock:
+                self._docs = {}
+                self._postings = {}
+                self._total_length = 0
+                for case_id, doc in snapshot['docs'].items():
+                    self._add_locked(int(case_id), doc)
+                self._stats['loaded_from_snapshot'] = len(self._docs)
+                self._dirty = False
+            return True
+        except (OSError, ValueError, KeyError) as e:
+            print(f"加载案例索引快照失败: {str(e)}")
+            return False
+
+    def save_snapshot(self):
+        """原子写入索引快照（没有变更时跳过）"""
+        if not self.snapshot_path or not self._dirty:
+            return
+        try:
+            with self._lock:
+                data = json.dumps({'saved_at': time.time(), 'docs': self._docs}, ensure_ascii=False)
+                self._dirty = False
+            directory = os.path.dirname(self.snapshot_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            temp_path = f"{self.snapshot_path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(temp_path, self.snapshot_path)
+        except OSError as e:
+            print(f"保存案例索引快照失败: {str(e)}")
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['documents'] = len(self._docs)
+            stats['terms'] = len(self._postings)
+        queries = stats.pop('query_ms_total')
+        stats['mean_query_ms'] = round(queries / stats['queries'], 3) if stats['queries'] else None
+        stats['enabled'] = self.enabled
+        stats['snapshot_path'] = self.snapshot_path
+        return stats
+
+
+case_index = CaseIndex()
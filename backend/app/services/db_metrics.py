@@ -0,0 +1,88 @@
+import threading
+import time
+from typing import Dict, List
+
+from .stats import percentile
+from .tracing import tracer
+
+
+class DatabaseMetrics:
+    """
+    数据库写事务指标
+
+    统计每次会话提交（flush + commit）的耗时。SQLite 同一时间只允许一个写事务，
+    等待写锁的时间会体现在提交耗时中：超过阈值的提交记为一次锁等待，
+    "database is locked" 错误单独计数。
+    """
+
+    def __init__(self, slow_commit_ms: float = 100.0, window_size: int = 1000):
+        self.slow_commit_ms = slow_commit_ms
+        self.window_size = window_size
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._durations: List[float] = []
+        self._stats = {'commits': 0, 'rollbacks': 0, 'lock_waits': 0, 'lock_errors': 0, 'max_commit_ms': 0.0}
+        self._installed = False
+
+    def init_app(self, app, db):
+        """在会话与引擎上注册事件监听"""
+        from sqlalchemy import event
+        from sqlalchemy.orm import Session
+
+        self.slow_commit_ms = app.config.get('DB_SLOW_COMMIT_MS', self.slow_commit_ms)
+
+        if not self._installed:
+            event.listen(Session, 'before_commit', self._before_commit)
+            event.listen(Session, 'after_commit', self._after_commit)
+            event.listen(Session, 'after_rollback', self._after_rollback)
+            self._installed = True
+
+        with app.app_context():
+            event.listen(db.engine, 'handle_error', self._handle_error)
+
+    def _before_commit(self, session):
+        self._local.commit_start = time.perf_counter()
+
+    def _after_commit(self, session):
+        start = getattr(self._local, 'commit_start', None)
+        if start is None:
+            return
+        self._local.commit_start = None
+        duration = time.perf_counter() - start
+        duration_ms = duration * 1000
+        tracer.record('db.commit', duration)
+
+        with self._lock:
+            self._stats['commits'] += 1
+            self._stats['max_commit_ms'] = max(self._stats['max_commit_ms'], round(duration_ms, 2))
+            if duration_ms >= self.slow_commit_ms:
+                self._stats['lock_waits'] += 1
+            self._durations.append(duration_ms)
+            if len(self._durations) > self.window_size:
+                del self._durations[:len(self._durations) - self.window_size]
+
+    def _after_rollback(self, session):
+        self._local.commit_start = None
+        with self._lock:
+            self._stats['rollbacks'] += 1
+
+    def _handle_error(self, context):
+        if 'database is locked' in str(context.original_exception):
+            with self._lock:
+                self._stats['lock_errors'] += 1
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            durations = list(self._durations)
+
+        p50 = percentile(durations, 50)
+        p95 = percentile(durations, 95)
+        stats['commit_p50_ms'] = round(p50, 2) if p50 is not None else None
+        stats['commit_p95_ms'] = round(p95, 2) if p95 is not None else None
+        stats['slow_commit_ms'] = self.slow_commit_ms
+        return stats
+
+
+db_metrics = DatabaseMetrics()
@@ -0,0 +1,603 @@
+import hashlib
+import json
+import os
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set
+
+import requests
+import yaml
+from flask import current_app
+
+from .search import search_service
+
+
+class DSLWorkflowError(Exception):
+    """工作流DSL无法解析或包含不支持的结构"""
+
+
+class WorkflowGraph:
+    """
+    Dify 工作流DSL（如 案例改编.yml）解析后的节点图
+
+    节点类型：start / llm / if-else / tool / end；边带有 sourceHandle，
+    条件分支节点按命中的 case_id（或 false）选择出边，配置了 error_strategy: fail-branch
+    的节点失败时走 fail-branch 出边，其余节点走 source 出边。
+    """
+
+    SUPPORTED_TYPES = ('start', 'llm', 'if-else', 'tool', 'end')
+
+    def __init__(self, nodes: Dict[str, Dict], edges: List[Dict]):
+        self.nodes = nodes
+        self.edges = edges
+        self.incoming: Dict[str, List[Dict]] = {node_id: [] for node_id in nodes}
+        self.outgoing: Dict[str, List[Dict]] = {node_id: [] for node_id in nodes}
+        for edge in edges:
+            if edge['source'] not in nodes or edge['target'] not in nodes:
+                raise DSLWorkflowError(f"连线引用了不存在的节点: {edge['source']} -> {edge['target']}")
+            self.outgoing[edge['source']].append(edge)
+            self.incoming[edge['target']].append(edge)
+        self.start_id = self._validate()
+
+    @classmethod
+    def from_dsl(cls, dsl: Dict) -> 'WorkflowGraph':
+        try:
+            graph = dsl['workflow']['graph']
+            nodes = {str(node['id']): node['data'] for node in graph['nodes']}
+            edges = [
+                {
+                    'id': edge.get('id') or f"{edge['source']}-{edge.get('sourceHandle', 'source')}-{edge['target']}",
+                    'source': str(edge['source']),
+                    'target': str(edge['target']),
+                    'handle': str(edge.get('sourceHandle') or 'source')
+                }
+                for edge in graph['edges']
+            ]
+        except (KeyError, TypeError) as e:
+            raise DSLWorkflowError(f'工作流DSL格式错误: 缺少 {e}')
+        return cls(nodes, edges)
+
+    @classmethod
+    def from_file(cls, path: str) -> 'WorkflowGraph':
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls.from_dsl(yaml.safe_load(f))
+
+    def _validate(self) -> str:
+        unsupported = {data.get('type') for data in self.nodes.values()} - set(self.SUPPORTED_TYPES)
+        if unsupported:
+            raise DSLWorkflowError(f"不支持的节点类型: {', '.join(sorted(map(str, unsupported)))}")
+
+        starts = [node_id for node_id, data in self.nodes.items() if data['type'] == 'start']
+        if len(starts) != 1:
+            raise DSLWorkflowError('工作流必须有且只有一个开始节点')
+
+        # 拓扑排序检查环路
+        remaining = {node_id: len(edges) for node_id, edges in self.incoming.items()}
+        ready = [node_id for node_id, count in remaining.items() if count == 0]
+        visited = 0
+        while ready:
+            node_id = ready.pop()
+            visited += 1
+            for edge in self.outgoing[node_id]:
+                remaining[edge['target']] -= 1
+                if remaining[edge['target']] == 0:
+                    ready.append(edge['target'])
+        if visited != len(self.nodes):
+            raise DSLWorkflowError('工作流中存在环路')
+        return starts[0]
+
+    @property
+    def input_variables(self) -> List[Dict]:
+        return self.nodes[self.start_id].get('variables') or []
+
+
+class _Run:
+    """一次工作流执行的变量与连线状态"""
+
+    def __init__(self, graph: WorkflowGraph, workflow_input: Dict[str, Any]):
+        self.graph = graph
+        self.workflow_input = workflow_input
+        self.variables: Dict[str, Dict[str, Any]] = {}
+        self.system = {'user_id': workflow_input.get('user_uuid', '')}
+        self.resolved = {node_id: 0 for node_id in graph.nodes}
+        self.taken = {node_id: 0 for node_id in graph.nodes}
+        self.lock = threading.Lock()
+
+    def get(self, selector: List[str]) -> Any:
+        if not selector or len(selector) < 2:
+            return ''
+        if selector[0] == 'sys':
+            return self.system.get(selector[1], '')
+        with self.lock:
+            value = self.variables.get(str(selector[0]), {}).get(selector[1], '')
+        return '' if value is None else value
+
+    def set_outputs(self, node_id: str, outputs: Dict[str, Any]):
+        with self.lock:
+            self.variables[node_id] = outputs
+
+
+class DSLWorkflowEngine:
+    """
+    按 Dify 工作流DSL执行案例改编
+
+    将DSL解析为节点图，节点的所有入边都已确定（选中或跳过）后即可执行：
+    至少一条入边被选中则运行，否则跳过并继续向下游传播。互不依赖的节点
+    由线程池并发执行，总耗时取决于关键路径而不是所有节点耗时之和。
+    LLM 节点复用 WorkflowEngine 的模型调用（提示词预算、响应缓存、路由、调度），
+    工具节点结果按参数缓存 DSL_TOOL_CACHE_TTL 秒；每个节点超过 DSL_NODE_TIMEOUT 秒视为失败。
+    DSL 文件修改后下次执行自动重新加载，提示词与分支无需改动代码。
+    """
+
+    TEMPLATE_PATTERN = re.compile(r'\{\{#([^#{}]+?)#\}\}')
+
+    def __init__(self, workflow_engine, path: str, max_workers: int = 4, node_timeout: float = 180.0,
+                 tool_cache_ttl: float = 3600.0, tool_cache_size: int = 256, use_node_models: bool = False,
+                 notify_enabled: bool = False, wecom_hook_key: str = None):
+        self.workflow_engine = workflow_engine
+        self.path = path
+        self.max_workers = max_workers
+        self.node_timeout = node_timeout
+        self.tool_cache_ttl = tool_cache_ttl
+        self.tool_cache_size = tool_cache_size
+        self.use_node_models = use_node_models
+        self.notify_enabled = notify_enabled
+        self.wecom_hook_key = wecom_hook_key
+
+        self._graph: Optional[WorkflowGraph] = None
+        self._graph_mtime: Optional[float] = None
+        self._graph_lock = threading.Lock()
+        self._tool_cache: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._stats = {'runs': 0, 'nodes_run': 0, 'nodes_skipped': 0, 'node_timeouts': 0,
+                       'node_failures': 0, 'tool_cache_hits': 0, 'reloads': 0}
+        self._stats_lock = threading.Lock()
+
+        # 工具名 -> (处理函数, 结果是否可缓存)
+        self.tools: Dict[str, tuple] = {}
+        self.register_tool('google_search', self._search_tool, cacheable=True)
+        self.register_tool('brave_search', self._search_tool, cacheable=True)
+        self.register_tool('wecom_group_bot', self._wecom_tool, cacheable=False)
+
+    @classmethod
+    def from_config(cls, workflow_engine, config) -> 'DSLWorkflowEngine':
+        return cls(
+            workflow_engine,
+            path=config.get('DSL_WORKFLOW_PATH'),
+            max_workers=config.get('DSL_MAX_PARALLEL', 4),
+            node_timeout=config.get('DSL_NODE_TIMEOUT', 180.0),
+            tool_cache_ttl=config.get('DSL_TOOL_CACHE_TTL', 3600.0),
+            use_node_models=config.get('DSL_USE_NODE_MODELS', False),
+            notify_enabled=config.get('DSL_NOTIFY_ENABLED', False),
+            wecom_hook_key=config.get('WECOM_HOOK_KEY')
+        )
+
+    def register_tool(self, tool_name: str, handler: Callable[[Dict[str, Any], Dict, _Run], Dict[str, Any]],
+                      cacheable: bool = False):
+        """
+        注册工具节点的处理函数
+
+        handler(parameters, node, run) 返回节点输出（如 {'text': ...}），失败时抛出异常
+        """
+        self.tools[tool_name] = (handler, cacheable)
+
+    def get_graph(self) -> WorkflowGraph:
+        """加载DSL，文件修改时间变化后重新解析"""
+        mtime = os.path.getmtime(self.path)
+        with self._graph_lock:
+            if self._graph is None or mtime != self._graph_mtime:
+                self._graph = WorkflowGraph.from_file(self.path)
+                if self._graph_mtime is not None:
+                    self._bump('reloads')
+                self._graph_mtime = mtime
+            return self._graph
+
+    def _bump(self, name: str, count: int = 1):
+        with self._stats_lock:
+            self._stats[name] += count
+
+    def render(self, template: str, run: _Run, context: str = '') -> str:
+        """替换 {{#节点ID.变量#}}、{{#sys.user_id#}} 与 {{#context#}} 引用"""
+        def replace(match):
+            reference = match.group(1).strip()
+            if reference == 'context':
+                return context
+            value = run.get(reference.split('.', 1))
+            return value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+
+        return self.TEMPLATE_PATTERN.sub(replace, template or '')
+
+    def iter_workflow_events(self, workflow_input: Dict[str, Any], stream: bool = True) -> Iterator[Dict[str, Any]]:
+        """
+        执行DSL工作流并逐步产出事件，事件与结果格式同 WorkflowEngine.iter_workflow_events
+
+        step 为节点ID，另附 title 与 node_type。结果中 case_content 取结束节点的第一个输出，
+        questions 取第二个输出；outputs 为结束节点的全部输出。
+        """
+        started = time.monotonic()
+        result = {
+            'success': False,
+            'engine': 'dsl',
+            'case_content': None,
+            'questions': None,
+            'total_tokens_used': 0,
+            'steps_completed': [],
+            'models_used': {},
+            'prompt_layout': 'dsl',
+            'node_timings': {}
+        }
+
+        try:
+            graph = self.get_graph()
+        except (OSError, yaml.YAMLError, DSLWorkflowError) as e:
+            result['error'] = f'加载工作流DSL失败: {str(e)}'
+            yield {'event': 'workflow_finished', 'result': result}
+            return
+
+        self._bump('runs')
+        run = _Run(graph, workflow_input)
+        app = current_app._get_current_object()
+        events: 'queue.Queue[Dict]' = queue.Queue()
+        executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='dsl-node')
+        running: Dict[str, float] = {}
+        node_results: Dict[str, Dict[str, Any]] = {}
+        end_outputs = None
+        ready = [graph.start_id]
+
+        try:
+            while (ready or running) and not result.get('error'):
+                while ready:
+                    node_id = ready.pop(0)
+                    node = graph.nodes[node_id]
+                    if node['type'] in ('llm', 'tool'):
+                        yield {'event': 'step_started', 'step': node_id, 'title': node.get('title'),
+                               'node_type': node['type']}
+                        running[node_id] = time.monotonic() + self.node_timeout
+                        executor.submit(self._run_node, app, node_id, node, run, events, stream)
+                        continue
+
+                    # 开始、条件分支与结束节点只做变量计算，直接在当前线程完成
+                    handles = self._run_inline_node(node_id, node, run)
+                    if node['type'] == 'end':
+                        end_outputs = (node_id, node)
+                    ready.extend(self._resolve(graph, run, node_id, handles))
+
+                if not running:
+                    break
+
+                timeout = max(min(running.values()) - time.monotonic(), 0)
+                try:
+                    item = events.get(timeout=timeout)
+                except queue.Empty:
+                    now = time.monotonic()
+                    for node_id in [node_id for node_id, deadline in running.items() if deadline <= now]:
+                        running.pop(node_id)
+                        self._bump('node_timeouts')
+                        item = {'event': 'node_done', 'node_id': node_id,
+                                'outcome': {'success': False, 'error': f'节点执行超时（{self.node_timeout:g}秒）'}}
+                        ready.extend((yield from self._finish_node(graph, run, item, node_results, result)))
+                    if result.get('error'):
+                        break
+                    continue
+
+                if item['event'] == 'token':
+                    if item['workflow_step'] in running:
+                        yield item
+                    continue
+                if item['node_id'] not in running:
+                    # 已超时的节点迟到的结果
+                    continue
+                running.pop(item['node_id'])
+                ready.extend((yield from self._finish_node(graph, run, item, node_results, result)))
+                if result.get('error'):
+                    break
+
+            if not result.get('error'):
+                if end_outputs is None:
+                    result['error'] = '工作流未到达结束节点'
+                else:
+                    self._collect_outputs(end_outputs, run, node_results, result)
+                    result['success'] = True
+
+        except Exception as e:
+            result['error'] = f'工作流执行异常: {str(e)}'
+        finally:
+            # 客户端断开或失败时不等待仍在运行的节点
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        result['elapsed_ms'] = round((time.monotonic() - started) * 1000, 2)
+        yield {'event': 'workflow_finished', 'result': result}
+
+    def _finish_node(self, graph: WorkflowGraph, run: _Run, item: Dict, node_results: Dict,
+                     result: Dict) -> Iterator[Dict]:
+        """处理节点执行结果，产出步骤事件并返回新就绪的节点"""
+        node_id = item['node_id']
+        node = graph.nodes[node_id]
+        outcome = item['outcome']
+        result['node_timings'][node_id] = item.get('elapsed_ms')
+
+        if outcome['success']:
+            node_results[node_id] = outcome
+            run.set_outputs(node_id, outcome.get('outputs') or {'text': outcome.get('content', '')})
+            result['total_tokens_used'] += outcome.get('tokens_used', 0)
+            result['steps_completed'].append(node.get('title') or node_id)
+            event = self.workflow_engine._step_finished_event(node_id, outcome)
+            event.update({'title': node.get('title'), 'node_type': node['type'],
+                          'elapsed_ms': item.get('elapsed_ms')})
+            yield event
+            return self._resolve(graph, run, node_id, {'source'})
+
+        self._bump('node_failures')
+        yield {**self.workflow_engine._step_failed_event(node_id, outcome['error']),
+               'title': node.get('title'), 'node_type': node['type']}
+        if node.get('error_strategy') == 'fail-branch':
+            run.set_outputs(node_id, {'error_message': outcome['error']})
+            return self._resolve(graph, run, node_id, {'fail-branch'})
+
+        result['error'] = f"{node.get('title') or node_id}: {outcome['error']}"
+        return []
+
+    def _resolve(self, graph: WorkflowGraph, run: _Run, node_id: str, handles: Set[str]) -> List[str]:
+        """
+        确定节点出边：handles 中的出边被选中，其余跳过
+
+        Returns:
+            所有入边都已确定且至少一条被选中的下游节点
+        """
+        ready = []
+        pending = [(node_id, handles)]
+        while pending:
+            source, taken_handles = pending.pop()
+            for edge in graph.outgoing[source]:
+                target = edge['target']
+                run.resolved[target] += 1
+                if edge['handle'] in taken_handles:
+                    run.taken[target] += 1
+                if run.resolved[target] < len(graph.incoming[target]):
+                    continue
+                if run.taken[target]:
+                    ready.append(target)
+                else:
+                    # 没有选中的入边，跳过该节点及其下游
+                    self._bump('nodes_skipped')
+                    pending.append((target, set()))
+        return ready
+
+    def _run_inline_node(self, node_id: str, node: Dict, run: _Run) -> Set[str]:
+        node_type = node['type']
+        if node_type == 'start':
+            outputs = {}
+            for variable in node.get('variables') or []:
+                value = run.workflow_input.get(variable['variable'])
+                outputs[variable['variable']] = '' if value is None else value
+            run.set_outputs(node_id, outputs)
+            return {'source'}
+        if node_type == 'if-else':
+            return {self._evaluate_branch(node, run)}
+        if node_type == 'end':
+            run.set_outputs(node_id, {
+                output['variable']: run.get(output.get('value_selector') or [])
+                for output in node.get('outputs') or []
+            })
+        return {'source'}
+
+    def _evaluate_branch(self, node: Dict, run: _Run) -> str:
+        """返回第一个满足条件的 case_id，均不满足时返回 false"""
+        cases = node.get('cases')
+        if not cases:
+            # 旧版DSL只有一组条件
+            cases = [{'case_id': 'true', 'conditions': node.get('conditions') or [],
+                      'logical_operator': node.get('logical_operator', 'and')}]
+
+        for case in cases:
+            checks = [self._check_condition(condition, run) for condition in case.get('conditions') or []]
+            if not checks:
+                continue
+            matched = all(checks) if case.get('logical_operator', 'and') == 'and' else any(checks)
+            if matched:
+                return str(case.get('case_id') or case.get('id'))
+        return 'false'
+
+    def _check_condition(self, condition: Dict, run: _Run) -> bool:
+        actual = run.get(condition.get('variable_selector') or [])
+        expected = self.render(str(condition.get('value') or ''), run)
+        operator = condition.get('comparison_operator')
+        text = actual if isinstance(actual, str) else json.dumps(actual, ensure_ascii=False)
+
+        if operator in ('empty', 'null'):
+            return not actual
+        if operator in ('not empty', 'not null'):
+            return bool(actual)
+        if operator in ('is', '='):
+            return text == expected
+        if operator in ('is not', '≠'):
+            return text != expected
+        if operator == 'contains':
+            return expected in text
+        if operator == 'not contains':
+            return expected not in text
+        if operator == 'start with':
+            return text.startswith(expected)
+        if operator == 'end with':
+            return text.endswith(expected)
+        if operator in ('>', '<', '≥', '≤'):
+            try:
+                left, right = float(text), float(expected)
+            except ValueError:
+                return False
+            return {'>': left > right, '<': left < right, '≥': left >= right, '≤': left <= right}[operator]
+        raise DSLWorkflowError(f'不支持的条件运算符: {operator}')
+
+    def _run_node(self, app, node_id: str, node: Dict, run: _Run, events: 'queue.Queue', stream: bool):
+        """在线程池中执行LLM或工具节点，结果放入事件队列"""
+        started = time.monotonic()
+        with app.app_context():
+            try:
+                if node['type'] == 'llm':
+                    outcome = self._run_llm_node(node_id, node, run, events, stream)
+                else:
+                    outcome = self._run_tool_node(node, run)
+            except Exception as e:
+                outcome = {'success': False, 'error': str(e)}
+        self._bump('nodes_run')
+        events.put({'event': 'node_done', 'node_id': node_id, 'outcome': outcome,
+                    'elapsed_ms': round((time.monotonic() - started) * 1000, 2)})
+
+    def _run_llm_node(self, node_id: str, node: Dict, run: _Run, events: 'queue.Queue', stream: bool) -> Dict:
+        context_selector = (node.get('context') or {}).get('variable_selector') or []
+        context = run.get(context_selector) if (node.get('context') or {}).get('enabled') else ''
+        if not isinstance(context, str):
+            context = json.dumps(context, ensure_ascii=False)
+
+        messages = [
+            {'role': item.get('role', 'system'), 'content': self.render(item.get('text', ''), run, context)}
+            for item in node.get('prompt_template') or []
+        ]
+        model = node.get('model') or {}
+        workflow_input = dict(run.workflow_input)
+        if self.use_node_models and model.get('name'):
+            workflow_input['model_name'] = model['name']
+
+        calls = self.workflow_engine._call_llm(
+            messages, workflow_input,
+            request_type=node.get('title') or 'DSL节点',
+            workflow_step=node_id,
+            stream=stream,
+            params=model.get('completion_params') or {}
+        )
+        # 在工作线程中驱动生成器，token 事件转交给主线程
+        try:
+            while True:
+                events.put(next(calls))
+        except StopIteration as stop:
+            step_result = stop.value
+        if step_result['success']:
+            step_result['outputs'] = {'text': step_result['content']}
+        return step_result
+
+    def _run_tool_node(self, node: Dict, run: _Run) -> Dict:
+        tool_name = node.get('tool_name')
+        if tool_name not in self.tools:
+            raise DSLWorkflowError(f'未注册的工具: {tool_name}')
+        handler, cacheable = self.tools[tool_name]
+
+        parameters = {**(node.get('tool_configurations') or {})}
+        for name, parameter in (node.get('tool_parameters') or {}).items():
+            value = parameter.get('value')
+            if parameter.get('type') == 'variable':
+                value = run.get(value or [])
+            elif isinstance(value, str):
+                value = self.render(value, run)
+            parameters[name] = value
+
+        cache_key = None
+        if cacheable and self.tool_cache_ttl > 0:
+            cache_key = hashlib.sha256(
+                json.dumps([tool_name, parameters], ensure_ascii=False, sort_keys=True).encode('utf-8')
+            ).hexdigest()
+            outputs = self._get_cached_tool(cache_key)
+            if outputs is not None:
+                self._bump('tool_cache_hits')
+                return {'success': True, 'content': outputs.get('text', ''), 'outputs': outputs, 'cached': True}
+
+        retry = node.get('retry_config') or {}
+        attempts = 1 + (retry.get('max_retries', 0) if retry.get('retry_enabled') else 0)
+        for attempt in range(attempts):
+            try:
+                outputs = handler(parameters, node, run)
+                break
+            except Exception:
+                if attempt == attempts - 1:
+                    raise
+                time.sleep(retry.get('retry_interval', 1000) / 1000)
+
+        if cache_key:
+            self._set_cached_tool(cache_key, outputs)
+        return {'success': True, 'content': outputs.get('text', ''), 'outputs': outputs}
+
+    def _get_cached_tool(self, key: str) -> Optional[Dict]:
+        with self._cache_lock:
+            entry = self._tool_cache.get(key)
+            if entry is None:
+                return None
+            expires_at, outputs = entry
+            if expires_at <= time.monotonic():
+                del self._tool_cache[key]
+                return None
+            self._tool_cache.move_to_end(key)
+            return outputs
+
+    def _set_cached_tool(self, key: str, outputs: Dict):
+        with self._cache_lock:
+            self._tool_cache[key] = (time.monotonic() + self.tool_cache_ttl, outputs)
+            self._tool_cache.move_to_end(key)
+            while len(self._tool_cache) > self.tool_cache_size:
+                self._tool_cache.popitem(last=False)
+
+    def _search_tool(self, parameters: Dict[str, Any], node: Dict, run: _Run) -> Dict[str, Any]:
+        """
+        搜索节点：优先使用与节点同名的搜索服务（brave / google），未配置时使用全部已配置的服务；
+        未接入搜索服务或没有结果时与内置引擎一致，以查询内容作为搜索材料
+        """
+        query = parameters.get('query', '')
+        if search_service.enabled:
+            try:
+                count = int(parameters.get('count') or 0) or None
+            except (TypeError, ValueError):
+                count = None
+            search = search_service.search(query, count=count, providers=[node.get('provider_id')])
+            if search['results']:
+                return {'text': search_service.format_context(search['results']), 'json': search['results']}
+        return {'text': f'基于「{query}」的相关案例材料', 'json': []}
+
+    def _wecom_tool(self, parameters: Dict[str, Any], node: Dict, run: _Run) -> Dict[str, Any]:
+        """企业微信群机器人通知；默认关闭，发送失败不影响工作流结果"""
+        if not self.notify_enabled:
+            return {'text': '通知未启用'}
+
+        hook_key = self.wecom_hook_key or parameters.get('hook_key')
+        if not hook_key:
+            return {'text': '未配置企业微信机器人'}
+        try:
+            response = requests.post(
+                'https://qyapi.weixin.qq.com/cgi-bin/webhook/send',
+                params={'key': hook_key},
+                json={'msgtype': 'text', 'text': {'content': parameters.get('content', '')}},
+                timeout=10
+            )
+            response.raise_for_status()
+            return {'text': '通知已发送'}
+        except requests.exceptions.RequestException as e:
+            print(f"发送企业微信通知失败: {str(e)}")
+            return {'text': f'通知发送失败: {str(e)}'}
+
+    def _collect_outputs(self, end_node, run: _Run, node_results: Dict, result: Dict):
+        node_id, node = end_node
+        outputs = run.variables.get(node_id, {})
+        result['outputs'] = outputs
+        result['end_node'] = node.get('title') or node_id
+
+        fields = [('case_content', 'case_generation'), ('questions', 'question_generation')]
+        for (field, step), output in zip(fields, node.get('outputs') or []):
+            value = outputs.get(output['variable'])
+            result[field] = value or None
+            source = (output.get('value_selector') or [None])[0]
+            if source in node_results:
+                result['models_used'][step] = node_results[source].get('model_used')
+
+    def get_stats(self) -> Dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        with self._cache_lock:
+            stats['tool_cache_entries'] = len(self._tool_cache)
+        stats.update({
+            'path': self.path,
+            'max_workers': self.max_workers,
+            'node_timeout': self.node_timeout,
+            'nodes': len(self._graph.nodes) if self._graph else None
+        })
+        return stats
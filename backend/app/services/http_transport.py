@@ -0,0 +1,273 @@
+import hashlib
+import threading
+import time
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+_request_local = threading.local()
+
+
+def _counting_pool(base):
+    """包装 urllib3 连接池，按线程记录新建连接与等待空闲连接的次数"""
+
+    class CountingPool(base):
+        def _new_conn(self):
+            _request_local.new_connections = getattr(_request_local, 'new_connections', 0) + 1
+            return super()._new_conn()
+
+        def _get_conn(self, timeout=None):
+            if self.pool is not None and self.pool.empty():
+                _request_local.pool_waits = getattr(_request_local, 'pool_waits', 0) + 1
+            return super()._get_conn(timeout=timeout)
+
+    CountingPool.__name__ = f'Counting{base.__name__}'
+    return CountingPool
+
+
+class _CountingHTTPAdapter(HTTPAdapter):
+    """统计连接复用情况的 HTTPAdapter"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _counting_pool(HTTPConnectionPool),
+            'https': _counting_pool(HTTPSConnectionPool)
+        }
+
+
+class _PooledSession:
+    """单个 (API密钥, 主机) 对应的连接池会话"""
+
+    def __init__(self, session, pool_maxsize: int, http2: bool = False):
+        self.session = session
+        self.pool_maxsize = pool_maxsize
+        self.http2 = http2
+        self.in_flight = 0
+        self.last_used = time.monotonic()
+
+    def close(self):
+        try:
+            self.session.close()
+        except Exception:
+            pass
+
+
+class HTTPTransport:
+    """
+    OpenRouter HTTP传输层
+
+    为每个 (API密钥, 主机) 维护一个长连接池会话，复用TCP/TLS连接，
+    定期回收空闲会话，并统计连接池指标。线程安全，可在 threaded=True 的
+    Flask 服务中共享同一实例。
+    """
+
+    def __init__(self, pool_connections: int = 4, pool_maxsize: int = 16,
+                 pool_block: bool = False, idle_timeout: float = 90.0,
+                 http2: bool = False):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.idle_timeout = idle_timeout
+        self.http2 = http2
+
+        self._sessions: Dict[Tuple[str, str], _PooledSession] = {}
+        self._lock = threading.Lock()
+        self._last_reap = time.monotonic()
+        self._stats = {
+            'requests': 0,
+            'pool_hits': 0,
+            'new_connections': 0,
+            'pool_waits': 0,
+            'sessions_created': 0,
+            'sessions_reaped': 0,
+            'errors': 0
+        }
+
+    @classmethod
+    def from_config(cls, config) -> 'HTTPTransport':
+        """根据Flask配置创建传输层"""
+        return cls(
+            pool_connections=config.get('OPENROUTER_POOL_CONNECTIONS', 4),
+            pool_maxsize=config.get('OPENROUTER_POOL_MAXSIZE', 16),
+            pool_block=config.get('OPENROUTER_POOL_BLOCK', False),
+            idle_timeout=config.get('OPENROUTER_POOL_IDLE_TIMEOUT', 90.0),
+            http2=config.get('OPENROUTER_HTTP2', False)
+        )
+
+    @staticmethod
+    def _session_key(url: str, api_key: Optional[str]) -> Tuple[str, str]:
+        """会话键：API密钥摘要 + 主机（不在内存中以明文作为键保存密钥）"""
+        parsed = urlparse(url)
+        key_digest = hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()[:16]
+        return key_digest, f"{parsed.scheme}://{parsed.netloc}"
+
+    def _create_session(self) -> _PooledSession:
+        """创建新的连接池会话，HTTP/2 需要安装 h2，否则回退到 HTTP/1.1"""
+        if self.http2:
+            try:
+                import httpx
+                client = httpx.Client(
+                    http2=True,
+                    limits=httpx.Limits(
+                        max_connections=self.pool_maxsize,
+                        max_keepalive_connections=self.pool_maxsize,
+                        keepalive_expiry=self.idle_timeout
+                    )
+                )
+                return _PooledSession(client, self.pool_maxsize, http2=True)
+            except ImportError:
+                print("HTTP/2 需要安装 h2，已回退到 HTTP/1.1 连接池")
+                self.http2 = False
+
+        session = requests.Session()
+        adapter = _CountingHTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            pool_block=self.pool_block
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return _PooledSession(session, self.pool_maxsize)
+
+    def _acquire(self, url: str, api_key: Optional[str]) -> _PooledSession:
+        """获取会话并登记一次在途请求"""
+        key = self._session_key(url, api_key)
+        now = time.monotonic()
+
+        with self._lock:
+            if now - self._last_reap >= max(self.idle_timeout / 2, 1.0):
+                self._reap_idle_locked(now)
+
+            pooled = self._sessions.get(key)
+            if pooled is None:
+                pooled = self._create_session()
+                self._sessions[key] = pooled
+                self._stats['sessions_created'] += 1
+
+            pooled.in_flight += 1
+            pooled.last_used = now
+            self._stats['requests'] += 1
+
+        return pooled
+
+    def _release(self, pooled: _PooledSession, new_connections: int, pool_waits: int):
+        with self._lock:
+            pooled.in_flight -= 1
+            pooled.last_used = time.monotonic()
+            self._stats['pool_waits'] += pool_waits
+            if new_connections > 0:
+                self._stats['new_connections'] += new_connections
+            else:
+                self._stats['pool_hits'] += 1
+
+    def request(self, method: str, url: str, api_key: Optional[str] = None, **kwargs):
+        """
+        通过连接池发送请求
+
+        stream=True 时响应正文在返回后才读取，在途计数保留到调用方关闭响应为止，
+        避免流式读取期间会话被当作空闲会话回收。
+
+        Args:
+            method: HTTP方法
+            url: 完整请求地址
+            api_key: 用于选择会话的API密钥（Authorization头仍由调用方设置）
+            **kwargs: 透传给 requests 的参数（headers, data, json, timeout, stream）
+        """
+        pooled = self._acquire(url, api_key)
+        _request_local.new_connections = 0
+        _request_local.pool_waits = 0
+        response = None
+        try:
+            if pooled.http2:
+                response = self._send_http2(pooled.session, method, url, **kwargs)
+            else:
+                response = pooled.session.request(method, url, **kwargs)
+            return response
+        except Exception:
+            with self._lock:
+                self._stats['errors'] += 1
+            raise
+        finally:
+            new_connections = getattr(_request_local, 'new_connections', 0)
+            pool_waits = getattr(_request_local, 'pool_waits', 0)
+            if response is not None and kwargs.get('stream'):
+                self._release_on_close(response, pooled, new_connections, pool_waits)
+            else:
+                self._release(pooled, new_connections, pool_waits)
+
+    def _release_on_close(self, response, pooled: _PooledSession, new_connections: int, pool_waits: int):
+        """包装流式响应的 close，关闭（或重复关闭）时只释放一次在途计数"""
+        close = response.close
+        once = threading.Lock()
+
+        def close_and_release():
+            try:
+                close()
+            finally:
+                if once.acquire(blocking=False):
+                    self._release(pooled, new_connections, pool_waits)
+
+        response.close = close_and_release
+
+    @staticmethod
+    def _send_http2(client, method: str, url: str, **kwargs):
+        """通过 httpx 发送 HTTP/2 请求，并将异常转换为 requests 异常类型"""
+        import httpx
+        request = client.build_request(
+            method, url,
+            headers=kwargs.get('headers'),
+            content=kwargs.get('data'),
+            json=kwargs.get('json'),
+            timeout=kwargs.get('timeout')
+        )
+        try:
+            return client.send(request, stream=kwargs.get('stream', False))
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e))
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(str(e))
+
+    def post(self, url: str, api_key: Optional[str] = None, **kwargs):
+        return self.request('POST', url, api_key=api_key, **kwargs)
+
+    def get(self, url: str, api_key: Optional[str] = None, **kwargs):
+        return self.request('GET', url, api_key=api_key, **kwargs)
+
+    def _reap_idle_locked(self, now: float):
+        """回收空闲超时的会话（调用方需持有锁）"""
+        self._last_reap = now
+        for key in list(self._sessions.keys()):
+            pooled = self._sessions[key]
+            if pooled.in_flight == 0 and now - pooled.last_used >= self.idle_timeout:
+                pooled.close()
+                del self._sessions[key]
+                self._stats['sessions_reaped'] += 1
+
+    def reap_idle(self):
+        """立即回收空闲会话"""
+        with self._lock:
+            self._reap_idle_locked(time.monotonic())
+
+    def close(self):
+        """关闭全部会话"""
+        with self._lock:
+            for pooled in self._sessions.values():
+                pooled.close()
+            self._sessions.clear()
+
+    def get_stats(self) -> Dict:
+        """获取连接池指标"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['active_sessions'] = len(self._sessions)
+            stats['in_flight'] = sum(p.in_flight for p in self._sessions.values())
+        stats['pool_maxsize'] = self.pool_maxsize
+        stats['http2'] = self.http2
+        reused = stats['pool_hits'] + stats['new_connections']
+        stats['hit_rate'] = round(stats['pool_hits'] / reused, 4) if reused else 0.0
+        return stats
@@ -0,0 +1,496 @@
+import atexit
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterator, List, Optional
+
+from .stats import percentile
+from .tracing import tracer
+
+
+class JobQueueFullError(Exception):
+    """后台任务队列已满或服务正在停止"""
+
+
+class _JobEvents:
+    """运行中任务的事件记录，供进度订阅者从任意位置读取"""
+
+    def __init__(self, events: List[Dict] = None):
+        self.events = list(events or [])
+        self.done = False
+        self._condition = threading.Condition()
+
+    def publish(self, event: Dict):
+        with self._condition:
+            self.events.append(event)
+            self._condition.notify_all()
+
+    def finish(self):
+        with self._condition:
+            self.done = True
+            self._condition.notify_all()
+
+    def subscribe(self, after: int = 0, heartbeat: float = 15.0) -> Iterator[Optional[Dict]]:
+        """逐个产出事件；长时间没有新事件时产出 None，调用方可据此发送保活消息"""
+        index = after
+        while True:
+            with self._condition:
+                if index >= len(self.events) and not self.done:
+                    self._condition.wait(heartbeat)
+                pending = self.events[index:]
+                finished = self.done
+            if not pending and not finished:
+                yield None
+            for event in pending:
+                yield event
+            index += len(pending)
+            if finished and index >= len(self.events):
+                return
+
+
+class JobContext:
+    """传给任务处理函数的上下文：上报进度、检查是否已取消"""
+
+    def __init__(self, manager: 'JobManager', job, events: _JobEvents):
+        self.manager = manager
+        self.job = job
+        self.job_id = job.job_id
+        self.user_uuid = job.user_uuid
+        self.session_id = job.session_id
+        self._events = events
+        self._cancel_event = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel_event.is_set()
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def wait(self, timeout: float) -> bool:
+        """等待 timeout 秒，任务被取消时提前返回 True"""
+        return self._cancel_event.wait(timeout)
+
+    def emit(self, event: Dict, persist: bool = True):
+        """
+        上报一个进度事件
+
+        persist=True 的事件（如步骤开始/完成）写入任务记录，服务重启或其他进程也能查询；
+        模型增量输出等高频事件只推送给当前进程中的订阅者。
+        """
+        from .. import db
+
+        self._events.publish(event)
+        if persist:
+            progress = self.job.get_progress()
+            progress.append(event)
+            self.job.set_progress(progress)
+            db.session.commit()
+
+
+def _matches(column, value):
+    return column.is_(None) if value is None else column == value
+
+
+class JobManager:
+    """
+    后台任务执行器
+
+    提交任务时只写入一条任务记录并放入进程内队列，请求线程立即返回任务ID；
+    固定数量的工作线程依次取出任务，调用按任务类型注册的处理函数执行，
+    步骤进度与结果写入 workflow_jobs 表。进程退出时停止接收新任务，
+    等待队列中的任务执行完毕（最长 JOB_DRAIN_TIMEOUT 秒）。
+    领取任务时记录本进程标识，执行期间定期更新心跳；心跳超时（执行进程已退出）的运行中任务
+    由任一进程以条件更新接管并重新执行，仍有心跳的任务不会被其他进程或其他应用实例重复执行。
+    """
+
+    def __init__(self, workers: int = 4, max_queue_size: int = 1000, drain_timeout: float = 30.0,
+                 heartbeat_interval: float = 15.0, stale_after: float = 60.0):
+        self.workers = workers
+        self.max_queue_size = max_queue_size
+        self.drain_timeout = drain_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = stale_after
+        self.owner_id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+        self.app = None
+        self._handlers: Dict[str, Callable] = {}
+        self._queue: 'queue.Queue[str]' = queue.Queue()
+        self._threads: List[threading.Thread] = []
+        self._stopping = threading.Event()
+        self._heartbeat_thread: Optional[threading.Thread] = None
+        self._heartbeat_stop = threading.Event()
+        self._atexit_registered = False
+        self._lock = threading.Lock()
+        self._live: Dict[str, _JobEvents] = {}
+        self._contexts: Dict[str, JobContext] = {}
+        self._stats = {'submitted': 0, 'succeeded': 0, 'failed': 0, 'cancelled': 0, 'recovered': 0, 'rejected': 0}
+        self._queue_waits: List[float] = []
+
+    def register(self, kind: str, handler: Callable):
+        """
+        注册任务处理函数
+
+        handler(job_input, context) 返回任务结果字典，结果中 success 为 False 时任务记为失败
+        """
+        self._handlers[kind] = handler
+
+    def init_app(self, app):
+        """
+        绑定Flask应用、启动工作线程并恢复未完成的任务
+
+        JOB_WORKERS 为 0 时（如离线工具创建的应用）不执行也不恢复任务，不会改动其他进程正在执行的任务
+        """
+        self.app = app
+        self.workers = app.config.get('JOB_WORKERS', self.workers)
+        self.max_queue_size = app.config.get('JOB_QUEUE_MAX', self.max_queue_size)
+        self.drain_timeout = app.config.get('JOB_DRAIN_TIMEOUT', self.drain_timeout)
+        self.heartbeat_interval = app.config.get('JOB_HEARTBEAT_INTERVAL', self.heartbeat_interval)
+        self.stale_after = app.config.get('JOB_STALE_AFTER', self.stale_after)
+
+        if self.is_running() or self.workers <= 0:
+            return
+
+        self._stopping.clear()
+        with app.app_context():
+            self._recover(include_queued=True)
+
+        self._threads = [
+            threading.Thread(target=self._run, name=f'job-worker-{index}', daemon=True)
+            for index in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+        self._heartbeat_stop.clear()
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat_loop, name='job-heartbeat', daemon=True)
+        self._heartbeat_thread.start()
+
+        if not self._atexit_registered:
+            atexit.register(self.stop)
+            self._atexit_registered = True
+
+    def is_running(self) -> bool:
+        return any(thread.is_alive() for thread in self._threads)
+
+    def _recover(self, include_queued: bool = False):
+        """
+        接管心跳超时的运行中任务并重新放入队列；include_queued 时（启动时）同时放入排队中的任务
+
+        排队中的任务可能同时在其他进程的队列中，领取时的条件更新保证只执行一次
+        """
+        from ..models import WorkflowJob
+        from .. import db
+        from sqlalchemy import and_, or_
+
+        stale_before = datetime.utcnow() - timedelta(seconds=self.stale_after)
+        try:
+            job_ids = []
+            if include_queued:
+                job_ids = [job_id for (job_id,) in db.session.query(WorkflowJob.job_id).filter(
+                    WorkflowJob.status == WorkflowJob.QUEUED
+                ).order_by(WorkflowJob.created_at.asc())]
+
+            stale = WorkflowJob.query.filter(
+                WorkflowJob.status == WorkflowJob.RUNNING,
+                or_(WorkflowJob.heartbeat_at < stale_before,
+                    and_(WorkflowJob.heartbeat_at.is_(None), WorkflowJob.started_at < stale_before))
+            ).order_by(WorkflowJob.created_at.asc()).all()
+            for job in stale:
+                # 以原执行进程与心跳为条件更新，多个进程同时接管时只有一个成功
+                claimed = WorkflowJob.query.filter(
+                    WorkflowJob.job_id == job.job_id,
+                    WorkflowJob.status == WorkflowJob.RUNNING,
+                    _matches(WorkflowJob.owner, job.owner),
+                    _matches(WorkflowJob.heartbeat_at, job.heartbeat_at)
+                ).update({'status': WorkflowJob.QUEUED, 'owner': None, 'heartbeat_at': None},
+                         synchronize_session=False)
+                if claimed:
+                    job_ids.append(job.job_id)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"恢复后台任务失败: {str(e)}")
+            return
+
+        for job_id in job_ids:
+            self._queue.put(job_id)
+        with self._lock:
+            self._stats['recovered'] += len(job_ids)
+        if job_ids:
+            print(f"恢复 {len(job_ids)} 个未完成的后台任务")
+
+    def _heartbeat_loop(self):
+        """定期更新本进程运行中任务的心跳，并接管其他进程遗留的超时任务"""
+        while not self._heartbeat_stop.wait(self.heartbeat_interval):
+            try:
+                with self.app.app_context():
+                    self._heartbeat()
+                    self._recover()
+            except Exception as e:
+                print(f"更新后台任务心跳失败: {str(e)}")
+
+    def _heartbeat(self):
+        from ..models import WorkflowJob
+        from .. import db
+
+        with self._lock:
+            job_ids = list(self._contexts)
+        if not job_ids:
+            return
+        try:
+            WorkflowJob.query.filter(
+                WorkflowJob.job_id.in_(job_ids),
+                WorkflowJob.owner == self.owner_id
+            ).update({'heartbeat_at': datetime.utcnow()}, synchronize_session=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    def _check_accepting(self, kind: str, count: int = 1):
+        if kind not in self._handlers:
+            raise ValueError(f'未知的任务类型: {kind}')
+        if (self._stopping.is_set() or not self.is_running()
+                or self._queue.qsize() + count > self.max_queue_size):
+            with self._lock:
+                self._stats['rejected'] += count
+            raise JobQueueFullError('后台任务队列已满或服务正在停止，请稍后重试')
+
+    def _enqueue(self, jobs: List):
+        for job in jobs:
+            self._queue.put(job.job_id)
+        with self._lock:
+            self._stats['submitted'] += len(jobs)
+
+    def submit(self, kind: str, user_uuid: str, input_data: Dict, session_id: str = None):
+        """
+        创建任务记录并放入队列
+
+        Raises:
+            JobQueueFullError: 队列已满或服务正在停止
+        """
+        from ..models import WorkflowJob
+        from .. import db
+
+        self._check_accepting(kind)
+
+        job = WorkflowJob(user_uuid=user_uuid, input_data=input_data, kind=kind, session_id=session_id)
+        db.session.add(job)
+        db.session.commit()
+
+        self._enqueue([job])
+        return job
+
+    def submit_batch(self, kind: str, user_uuid: str, rows: List[Dict], batch_id: str) -> List:
+        """
+        在一次提交中创建一批任务记录并放入队列
+
+        rows 中每项包含 input(任务输入)、session_id，以及可选的 error：
+        带 error 的行（如输入校验失败）直接记为失败，不进入队列。
+
+        Raises:
+            JobQueueFullError: 队列放不下整批任务或服务正在停止
+        """
+        from ..models import WorkflowJob
+        from .. import db
+
+        self._check_accepting(kind, sum(1 for row in rows if not row.get('error')))
+
+        jobs = []
+        for index, row in enumerate(rows, start=1):
+            job = WorkflowJob(user_uuid=user_uuid, input_data=row['input'], kind=kind,
+                              session_id=row.get('session_id'), batch_id=batch_id, row_index=index)
+            if row.get('error'):
+                job.status = WorkflowJob.FAILED
+                job.error = row['error']
+                job.finished_at = datetime.utcnow()
+            db.session.add(job)
+            jobs.append(job)
+        db.session.commit()
+
+        self._enqueue([job for job in jobs if job.status == WorkflowJob.QUEUED])
+        return jobs
+
+    def requeue(self, jobs: List) -> List:
+        """
+        将失败或已取消的任务重新放入队列（已成功的任务不会重复执行）
+
+        Returns:
+            重新排队的任务
+
+        Raises:
+            JobQueueFullError: 队列已满或服务正在停止
+        """
+        from ..models import WorkflowJob
+        from .. import db
+
+        retry = [job for job in jobs if job.status in (WorkflowJob.FAILED, WorkflowJob.CANCELLED)]
+        if not retry:
+            return []
+        self._check_accepting(retry[0].kind, len(retry))
+
+        for job in retry:
+            job.status = WorkflowJob.QUEUED
+            job.error = None
+            job.set_result(None)
+            job.set_progress([])
+            job.started_at = None
+            job.finished_at = None
+        db.session.commit()
+
+        self._enqueue(retry)
+        return retry
+
+    def cancel(self, job_id: str) -> Optional[str]:
+        """
+        取消任务：排队中的任务直接标记为已取消，运行中的任务在下一个事件处停止
+
+        Returns:
+            取消后的任务状态；任务不存在时返回 None
+        """
+        from ..models import WorkflowJob
+        from .. import db
+
+        job = WorkflowJob.query.filter_by(job_id=job_id).first()
+        if not job:
+            return None
+        if job.status == WorkflowJob.QUEUED:
+            job.status = WorkflowJob.CANCELLED
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+        elif job.status == WorkflowJob.RUNNING:
+            with self._lock:
+                context = self._contexts.get(job_id)
+            if context is not None:
+                context.cancel()
+        return job.status
+
+    def subscribe(self, job_id: str, after: int = 0) -> Optional[Iterator[Optional[Dict]]]:
+        """订阅当前进程中运行的任务事件，任务不在本进程运行时返回 None"""
+        with self._lock:
+            events = self._live.get(job_id)
+        return events.subscribe(after) if events is not None else None
+
+    def _run(self):
+        while True:
+            try:
+                job_id = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return
+                continue
+            try:
+                self._execute(job_id)
+            except Exception as e:
+                print(f"执行后台任务 {job_id} 失败: {str(e)}")
+
+    def _execute(self, job_id: str):
+        from ..models import WorkflowJob
+        from .. import db
+
+        with self.app.app_context():
+            # 以条件更新领取任务，避免同一任务被重复执行
+            now = datetime.utcnow()
+            claimed = WorkflowJob.query.filter_by(job_id=job_id, status=WorkflowJob.QUEUED).update({
+                'status': WorkflowJob.RUNNING,
+                'started_at': now,
+                'owner': self.owner_id,
+                'heartbeat_at': now,
+                'attempts': WorkflowJob.attempts + 1
+            })
+            db.session.commit()
+            if not claimed:
+                return
+
+            job = WorkflowJob.query.filter_by(job_id=job_id).first()
+            self._record_queue_wait(job)
+            events = _JobEvents(job.get_progress())
+            context = JobContext(self, job, events)
+            with self._lock:
+                self._live[job_id] = events
+                self._contexts[job_id] = context
+
+            result = None
+            span = tracer.start_span('job.run', kind=job.kind, job_id=job_id, batch_id=job.batch_id)
+            token = tracer.activate(span)
+            try:
+                result = self._handlers[job.kind](job.get_input(), context)
+                if context.cancelled:
+                    status, error = WorkflowJob.CANCELLED, '任务已取消'
+                elif result and result.get('success', True) is False:
+                    status, error = WorkflowJob.FAILED, result.get('error')
+                else:
+                    status, error = WorkflowJob.SUCCEEDED, None
+            except Exception as e:
+                db.session.rollback()
+                status, error = WorkflowJob.FAILED, f'任务执行异常: {str(e)}'
+            if span is not None:
+                if error:
+                    span.fail(error)
+                span.end()
+                tracer.deactivate(token)
+
+            try:
+                # 心跳超时后任务可能已被其他进程接管，此时不覆盖其状态
+                job = WorkflowJob.query.filter_by(job_id=job_id, owner=self.owner_id).first()
+                if job is None:
+                    print(f"后台任务 {job_id} 已由其他进程接管，不保存本次结果")
+                else:
+                    job.status = status
+                    job.error = error
+                    job.set_result(result)
+                    job.finished_at = datetime.utcnow()
+                    db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"保存后台任务 {job_id} 结果失败: {str(e)}")
+
+            with self._lock:
+                self._stats[status] += 1
+                self._live.pop(job_id, None)
+                self._contexts.pop(job_id, None)
+            events.publish({'event': 'job_finished', 'job_id': job_id, 'status': status,
+                            'error': error, 'result': result})
+            events.finish()
+
+    def _record_queue_wait(self, job):
+        if not job.created_at or not job.started_at:
+            return
+        waited = (job.started_at - job.created_at).total_seconds() * 1000
+        with self._lock:
+            self._queue_waits.append(waited)
+            if len(self._queue_waits) > 1000:
+                del self._queue_waits[:len(self._queue_waits) - 1000]
+
+    def stop(self, timeout: float = None):
+        """停止接收新任务，等待队列中的任务执行完毕"""
+        if not self._threads:
+            return
+        self._stopping.set()
+        deadline = time.monotonic() + (self.drain_timeout if timeout is None else timeout)
+        for thread in self._threads:
+            thread.join(timeout=max(deadline - time.monotonic(), 0))
+        remaining = self._queue.qsize() + sum(1 for thread in self._threads if thread.is_alive())
+        if remaining:
+            print(f"后台任务未在 {self.drain_timeout} 秒内全部完成，剩余任务将在心跳超时后重新执行")
+        self._threads = []
+        self._heartbeat_stop.set()
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['running'] = len(self._live)
+            wait_p95 = percentile(self._queue_waits, 95)
+        stats['queue_depth'] = self._queue.qsize()
+        stats['workers'] = self.workers
+        stats['accepting'] = self.is_running() and not self._stopping.is_set()
+        stats['queue_wait_p95_ms'] = round(wait_p95, 2) if wait_p95 is not None else None
+        return stats
+
+
+job_manager = JobManager()
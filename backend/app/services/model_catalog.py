@@ -0,0 +1,315 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+
+class ModelCatalog:
+    """
+    模型目录
+
+    从 OpenRouter 模型接口加载模型、上下文长度和定价，内存缓存按 TTL 过期后在后台刷新，
+    并将最近一次结果保存为磁盘快照，离线启动时从快照恢复；两者都不可用时使用内置列表。
+    定价统一为每1000 tokens的美元价格。
+    """
+
+    # 内置模型（无法获取远程目录且没有快照时使用）
+    BUILTIN_MODELS = [
+        {
+            'id': 'gpt-4o',
+            'name': 'GPT-4o',
+            'provider': 'OpenAI',
+            'description': '最新的GPT-4模型，性能优异',
+            'context_length': 128000,
+            'pricing': {'input': 0.005, 'output': 0.015}
+        },
+        {
+            'id': 'gpt-4o-mini',
+            'name': 'GPT-4o Mini',
+            'provider': 'OpenAI',
+            'description': '轻量级GPT-4模型，成本较低',
+            'context_length': 128000,
+            'pricing': {'input': 0.00015, 'output': 0.0006}
+        },
+        {
+            'id': 'claude-3-opus',
+            'name': 'Claude 3 Opus',
+            'provider': 'Anthropic',
+            'description': '最强大的Claude模型',
+            'context_length': 200000,
+            'pricing': {'input': 0.015, 'output': 0.075}
+        },
+        {
+            'id': 'claude-3-sonnet',
+            'name': 'Claude 3 Sonnet',
+            'provider': 'Anthropic',
+            'description': '平衡性能和成本的Claude模型',
+            'context_length': 200000,
+            'pricing': {'input': 0.003, 'output': 0.015}
+        },
+        {
+            'id': 'claude-3-haiku',
+            'name': 'Claude 3 Haiku',
+            'provider': 'Anthropic',
+            'description': '快速且经济的Claude模型',
+            'context_length': 200000,
+            'pricing': {'input': 0.00025, 'output': 0.00125}
+        }
+    ]
+
+    # 默认定价
+    DEFAULT_PRICING = {'input': 0.001, 'output': 0.002}
+
+    PROVIDER_NAMES = {
+        'openai': 'OpenAI',
+        'anthropic': 'Anthropic',
+        'google': 'Google',
+        'meta-llama': 'Meta',
+        'mistralai': 'Mistral'
+    }
+
+    def __init__(self, fetch_models: Callable[[], List[Dict]] = None, ttl: int = 3600,
+                 snapshot_path: Optional[str] = None, featured: List[str] = None):
+        """
+        Args:
+            fetch_models: 获取远程模型列表的函数，返回 OpenRouter /models 的 data 列表
+            ttl: 内存目录的有效期（秒）
+            snapshot_path: 磁盘快照路径
+            featured: 在模型列表中展示、参与路由的模型ID
+        """
+        self.fetch_models = fetch_models
+        self.ttl = ttl
+        self.snapshot_path = snapshot_path
+        self.featured = featured or [model['id'] for model in self.BUILTIN_MODELS]
+
+        self._models: Dict[str, Dict] = {}
+        self._loaded_at = 0.0
+        self._source = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._stats = {'refreshes': 0, 'refresh_errors': 0}
+
+    @classmethod
+    def from_config(cls, config, instance_path: str, fetch_models: Callable[[], List[Dict]] = None) -> 'ModelCatalog':
+        featured = config.get('MODEL_CATALOG_FEATURED') or ''
+        return cls(
+            fetch_models=fetch_models,
+            ttl=config.get('MODEL_CATALOG_TTL', 3600),
+            snapshot_path=config.get('MODEL_CATALOG_SNAPSHOT') or os.path.join(instance_path, 'model_catalog.json'),
+            featured=[model.strip() for model in featured.split(',') if model.strip()]
+        )
+
+    @classmethod
+    def _normalize(cls, raw: Dict) -> Dict:
+        """将 OpenRouter 模型数据转换为目录格式（价格由每token换算为每1000 tokens）"""
+        model_id = raw['id']
+        provider = model_id.split('/')[0] if '/' in model_id else ''
+        pricing = raw.get('pricing') or {}
+        top_provider = raw.get('top_provider') or {}
+
+        def per_thousand(value) -> float:
+            try:
+                return round(float(value) * 1000, 8)
+            except (TypeError, ValueError):
+                return 0.0
+
+        return {
+            'id': model_id,
+            'name': raw.get('name') or model_id,
+            'provider': cls.PROVIDER_NAMES.get(provider, provider),
+            'description': raw.get('description', ''),
+            'context_length': raw.get('context_length') or top_provider.get('context_length'),
+            'max_completion_tokens': top_provider.get('max_completion_tokens'),
+            'pricing': {
+                'input': per_thousand(pricing.get('prompt')),
+                'output': per_thousand(pricing.get('completion')),
+                # 提示词缓存读取价格，模型不支持缓存时与输入价格相同
+                'cache_read': per_thousand(pricing.get('input_cache_read', pricing.get('prompt')))
+            }
+        }
+
+    @staticmethod
+    def _index(models: List[Dict]) -> Dict[str, Dict]:
+        """按完整ID和去掉供应商前缀的短ID建立索引（短ID不覆盖已有的完整ID）"""
+        index = {model['id']: model for model in models}
+        for model in models:
+            short_id = model['id'].split('/')[-1]
+            index.setdefault(short_id, model)
+        return index
+
+    def _set_models(self, models: List[Dict], source: str, loaded_at: float = None):
+        with self._lock:
+            self._models = self._index(models)
+            self._loaded_at = loaded_at or time.time()
+            self._source = source
+
+    def _load_snapshot(self) -> bool:
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return False
+        try:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            self._set_models(snapshot['models'], 'snapshot', snapshot.get('fetched_at'))
+            return True
+        except (OSError, ValueError, KeyError) as e:
+            print(f"读取模型目录快照失败: {str(e)}")
+            return False
+
+    def _save_snapshot(self, models: List[Dict]):
+        if not self.snapshot_path:
+            return
+        try:
+            directory = os.path.dirname(self.snapshot_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            temp_path = f"{self.snapshot_path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'fetched_at': time.time(), 'models': models}, f, ensure_ascii=False)
+            os.replace(temp_path, self.snapshot_path)
+        except OSError as e:
+            print(f"保存模型目录快照失败: {str(e)}")
+
+    def refresh(self) -> bool:
+        """从远程接口刷新目录，成功后写入快照"""
+        if self.fetch_models is None:
+            return False
+        try:
+            models = [self._normalize(raw) for raw in self.fetch_models() if raw.get('id')]
+            if not models:
+                raise ValueError('模型列表为空')
+        except Exception as e:
+            print(f"刷新模型目录失败: {str(e)}")
+            with self._lock:
+                self._stats['refresh_errors'] += 1
+            return False
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+        self._set_models(models, 'remote')
+        self._save_snapshot(models)
+        with self._lock:
+            self._stats['refreshes'] += 1
+        return True
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self.refresh, name='model-catalog-refresh', daemon=True).start()
+
+    def _ensure_loaded(self) -> Dict[str, Dict]:
+        """
+        获取当前目录
+
+        首次使用时优先读取快照，没有快照时先使用内置列表并立即在后台请求远程接口，
+        请求不会等待远程目录；目录过期后继续使用旧数据并在后台刷新。
+        """
+        if not self._models:
+            with self._load_lock:
+                if not self._models and not self._load_snapshot():
+                    # 内置列表只是临时兜底，后台刷新失败时5分钟后再尝试
+                    self._set_models(self.BUILTIN_MODELS, 'builtin',
+                                     loaded_at=time.time() - max(self.ttl - 300, 0))
+                    self._refresh_in_background()
+        if time.time() - self._loaded_at >= self.ttl:
+            self._refresh_in_background()
+        return self._models
+
+    def get_model(self, model_name: str) -> Optional[Dict]:
+        models = self._ensure_loaded()
+        model = models.get(model_name)
+        if model is None and model_name:
+            model = models.get(model_name.split('/')[-1])
+        if model is None:
+            # 远程目录中没有时回退到内置信息
+            model = next((m for m in self.BUILTIN_MODELS if m['id'] == model_name), None)
+        return model
+
+    def get_pricing(self, model_name: str) -> Dict:
+        """获取模型定价（每1000 tokens），未知模型使用默认定价"""
+        model = self.get_model(model_name)
+        return model['pricing'] if model else self.DEFAULT_PRICING
+
+    def get_context_length(self, model_name: str) -> Optional[int]:
+        model = self.get_model(model_name)
+        return model.get('context_length') if model else None
+
+    def get_pricing_table(self) -> Dict[str, Dict]:
+        """展示模型的定价表，包含 default 键"""
+        table = {model_id: self.get_pricing(model_id) for model_id in self.featured}
+        table['default'] = self.DEFAULT_PRICING
+        return table
+
+    def list_models(self, include_all: bool = False) -> List[Dict]:
+        """
+        获取模型列表
+
+        Args:
+            include_all: 是否返回远程目录中的全部模型，默认只返回展示模型
+        """
+        if include_all:
+            models = self._ensure_loaded()
+            unique = {model['id']: model for model in models.values()}
+            return sorted(unique.values(), key=lambda m: m['id'])
+
+        featured = []
+        for model_id in self.featured:
+            model = self.get_model(model_id)
+            if model:
+                featured.append(dict(model, id=model_id))
+        return featured
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['source'] = self._source
+            stats['models'] = len({model['id'] for model in self._models.values()})
+            stats['age_seconds'] = round(time.time() - self._loaded_at, 1) if self._loaded_at else None
+        stats['ttl'] = self.ttl
+        return stats
+
+
+class KeyValidationCache:
+    """API密钥校验结果缓存，按密钥摘要保存，不在内存中保留明文密钥"""
+
+    def __init__(self, ttl: int = 600, invalid_ttl: int = 60):
+        self.ttl = ttl
+        self.invalid_ttl = invalid_ttl
+        self._entries: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0}
+
+    @classmethod
+    def from_config(cls, config) -> 'KeyValidationCache':
+        return cls(ttl=config.get('KEY_VALIDATION_TTL', 600))
+
+    @staticmethod
+    def _digest(api_key: str) -> str:
+        return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+    def get(self, api_key: str) -> Optional[Dict]:
+        digest = self._digest(api_key)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None and entry[1] > time.time():
+                self._stats['hits'] += 1
+                return entry[0]
+            self._entries.pop(digest, None)
+            self._stats['misses'] += 1
+            return None
+
+    def set(self, api_key: str, result: Dict):
+        ttl = self.ttl if result.get('valid') else self.invalid_ttl
+        with self._lock:
+            self._entries[self._digest(api_key)] = (result, time.time() + ttl)
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        return stats
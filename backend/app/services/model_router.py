@@ -0,0 +1,165 @@
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional
+
+from .stats import percentile
+
+
+class ModelStats:
+    """单个模型的滚动延迟与错误统计"""
+
+    def __init__(self, window_size: int = 100, window_seconds: float = 600.0):
+        self.window_seconds = window_seconds
+        self._samples = deque(maxlen=window_size)  # (时间戳, 延迟秒数, 是否成功)
+
+    def record(self, latency: float, success: bool):
+        self._samples.append((time.time(), latency, success))
+
+    def _recent(self) -> List[tuple]:
+        cutoff = time.time() - self.window_seconds
+        return [sample for sample in self._samples if sample[0] >= cutoff]
+
+    def snapshot(self) -> Dict:
+        samples = self._recent()
+        latencies = [latency for _, latency, success in samples if success]
+        errors = sum(1 for _, _, success in samples if not success)
+        p50 = percentile(latencies, 50)
+        p95 = percentile(latencies, 95)
+        return {
+            'samples': len(samples),
+            'errors': errors,
+            'error_rate': round(errors / len(samples), 4) if samples else 0.0,
+            'p50_ms': round(p50 * 1000, 1) if p50 is not None else None,
+            'p95_ms': round(p95 * 1000, 1) if p95 is not None else None
+        }
+
+
+class ModelRouter:
+    """
+    延迟感知的模型路由
+
+    按策略给出候选模型的尝试顺序：
+        fixed: 只使用请求的模型（默认，与原有行为一致）
+        fallback: 请求的模型优先，失败后按回退链依次尝试
+        fastest: 按滚动 p95 延迟从低到高
+        cheapest: 在 p95 不超过阈值的模型中按价格从低到高
+    统计样本不足的模型视为可用；错误率过高或熔断中的模型排到最后。
+    """
+
+    POLICIES = ('fixed', 'fallback', 'fastest', 'cheapest')
+
+    def __init__(self, policy: str = 'fixed', fallback_chain: List[str] = None,
+                 max_p95_ms: float = 20000.0, max_error_rate: float = 0.5,
+                 min_samples: int = 5, window_size: int = 100, window_seconds: float = 600.0):
+        self.policy = policy if policy in self.POLICIES else 'fixed'
+        self.fallback_chain = fallback_chain or []
+        self.max_p95_ms = max_p95_ms
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.window_size = window_size
+        self.window_seconds = window_seconds
+
+        self._stats: Dict[str, ModelStats] = {}
+        self._lock = threading.Lock()
+        self._failovers = 0
+
+    @classmethod
+    def from_config(cls, config) -> 'ModelRouter':
+        chain = config.get('MODEL_FALLBACK_CHAIN') or ''
+        return cls(
+            policy=config.get('MODEL_ROUTING_POLICY', 'fixed'),
+            fallback_chain=[model.strip() for model in chain.split(',') if model.strip()],
+            max_p95_ms=config.get('MODEL_ROUTING_MAX_P95_MS', 20000.0),
+            max_error_rate=config.get('MODEL_ROUTING_MAX_ERROR_RATE', 0.5)
+        )
+
+    def record(self, model_name: str, latency: float, success: bool):
+        """记录一次调用结果"""
+        with self._lock:
+            stats = self._stats.get(model_name)
+            if stats is None:
+                stats = ModelStats(self.window_size, self.window_seconds)
+                self._stats[model_name] = stats
+            stats.record(latency, success)
+
+    def record_failover(self):
+        with self._lock:
+            self._failovers += 1
+
+    def _snapshot(self, model_name: str) -> Optional[Dict]:
+        with self._lock:
+            stats = self._stats.get(model_name)
+            return stats.snapshot() if stats else None
+
+    def _is_healthy(self, model_name: str, is_available: Callable[[str], bool]) -> bool:
+        if not is_available(model_name):
+            return False
+        snapshot = self._snapshot(model_name)
+        if not snapshot or snapshot['samples'] < self.min_samples:
+            return True
+        return snapshot['error_rate'] <= self.max_error_rate
+
+    def _p95(self, model_name: str) -> Optional[float]:
+        snapshot = self._snapshot(model_name)
+        if not snapshot or snapshot['samples'] < self.min_samples:
+            return None
+        return snapshot['p95_ms']
+
+    def select(self, requested_model: str, models: List[str], pricing: Dict[str, Dict],
+               policy: str = None, is_available: Callable[[str], bool] = None) -> List[str]:
+        """
+        计算模型尝试顺序
+
+        Args:
+            requested_model: 用户请求的模型
+            models: 可路由的模型集合
+            pricing: 模型定价（每1000 tokens）
+            policy: 本次请求使用的策略，为空时使用默认策略
+            is_available: 判断模型当前是否可用（如熔断器状态）
+
+        Returns:
+            按优先级排列的模型列表，第一个为首选模型
+        """
+        policy = policy if policy in self.POLICIES else self.policy
+        is_available = is_available or (lambda model: True)
+
+        if policy == 'fixed':
+            return [requested_model]
+
+        if policy == 'fallback':
+            ordered = [requested_model] + [m for m in self.fallback_chain if m != requested_model]
+        else:
+            candidates = list(dict.fromkeys([requested_model] + list(models)))
+            if policy == 'fastest':
+                # 无统计数据的模型排在有数据的模型之后，请求的模型在同等条件下优先
+                ordered = sorted(
+                    candidates,
+                    key=lambda m: (self._p95(m) is None, self._p95(m) or 0, m != requested_model)
+                )
+            else:
+                def price(model):
+                    model_pricing = pricing.get(model) or pricing.get('default', {})
+                    return model_pricing.get('input', 0) + model_pricing.get('output', 0)
+
+                within_budget = [
+                    m for m in candidates
+                    if self._p95(m) is None or self._p95(m) <= self.max_p95_ms
+                ]
+                over_budget = [m for m in candidates if m not in within_budget]
+                ordered = sorted(within_budget, key=price) + sorted(over_budget, key=lambda m: self._p95(m))
+
+        healthy = [m for m in ordered if self._is_healthy(m, is_available)]
+        unhealthy = [m for m in ordered if m not in healthy]
+        return healthy + unhealthy
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            models = {name: stats.snapshot() for name, stats in self._stats.items()}
+            failovers = self._failovers
+        return {
+            'policy': self.policy,
+            'fallback_chain': self.fallback_chain,
+            'failovers': failovers,
+            'models': models
+        }
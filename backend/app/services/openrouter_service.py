@@ -1,29 +1,261 @@
 import requests
+import hashlib
 import json
+import threading
 import time
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional
 from flask import current_app
-from ..models import APIUsage
+from ..models import APIUsage, SystemConfig
 from .. import db
+from .http_transport import HTTPTransport
+from .response_cache import ResponseCache, make_cache_key
+from .resilience import CircuitBreakerRegistry, CircuitOpenError, RetryPolicy
+from .model_router import ModelRouter
+from .token_budget import TokenBudget
+from .usage_recorder import usage_recorder
+from .model_catalog import KeyValidationCache, ModelCatalog
+from .singleflight import SingleFlight
+from .scheduler import FairScheduler, Lease, QueueTimeoutError
+from .tracing import tracer
 
 class OpenRouterService:
     """OpenRouter API集成服务"""
     
     def __init__(self):
-        self.base_url = "https://openrouter.ai/api/v1"
+        self.default_base_url = "https://openrouter.ai/api/v1"
+        self._base_url = None
         self.timeout = 30
         
-        # 模型定价信息（每1000 tokens的价格，单位：美元）
-        self.model_pricing = {
-            'gpt-4o': {'input': 0.005, 'output': 0.015},
-            'gpt-4o-mini': {'input': 0.00015, 'output': 0.0006},
-            'claude-3-opus': {'input': 0.015, 'output': 0.075},
-            'claude-3-sonnet': {'input': 0.003, 'output': 0.015},
-            'claude-3-haiku': {'input': 0.00025, 'output': 0.00125},
-            # 默认定价
-            'default': {'input': 0.001, 'output': 0.002}
+        # 共享组件（首次使用时根据应用配置创建）
+        self._components = {}
+        self._components_lock = threading.Lock()
+    
+    def _get_component(self, name: str, factory):
+        """
+        获取共享组件，首次访问时创建
+        
+        factory 接收当前 Flask 应用；不在应用上下文中时传入 None，组件使用默认参数。
+        """
+        component = self._components.get(name)
+        if component is None:
+            with self._components_lock:
+                component = self._components.get(name)
+                if component is None:
+                    component = factory(self._get_app())
+                    self._components[name] = component
+        return component
+    
+    @staticmethod
+    def _get_app():
+        """获取当前 Flask 应用，不在应用上下文中时返回 None"""
+        try:
+            return current_app._get_current_object()
+        except RuntimeError:
+            return None
+    
+    @property
+    def base_url(self) -> str:
+        """API地址：显式设置的地址优先，其次为应用配置 OPENROUTER_BASE_URL（可指向本地模拟服务）"""
+        if self._base_url:
+            return self._base_url
+        try:
+            # 记住最近一次配置的地址，供后台线程（不在应用上下文中）使用
+            self.default_base_url = current_app.config.get('OPENROUTER_BASE_URL') or self.default_base_url
+        except RuntimeError:
+            pass
+        return self.default_base_url
+    
+    @base_url.setter
+    def base_url(self, value: str):
+        self._base_url = value
+    
+    @property
+    def transport(self) -> HTTPTransport:
+        """获取共享的连接池传输层"""
+        return self._get_component(
+            'transport',
+            lambda app: HTTPTransport.from_config(app.config) if app else HTTPTransport()
+        )
+    
+    @property
+    def response_cache(self) -> ResponseCache:
+        """获取共享的LLM响应缓存（不在应用上下文中时仅使用内存缓存）"""
+        return self._get_component(
+            'response_cache',
+            lambda app: ResponseCache.from_config(app.config, app.instance_path) if app else ResponseCache()
+        )
+    
+    @property
+    def retry_policy(self) -> RetryPolicy:
+        """获取重试策略"""
+        return self._get_component(
+            'retry_policy',
+            lambda app: RetryPolicy.from_config(app.config) if app else RetryPolicy()
+        )
+    
+    @property
+    def circuit_breakers(self) -> CircuitBreakerRegistry:
+        """获取按模型划分的熔断器"""
+        return self._get_component(
+            'circuit_breakers',
+            lambda app: CircuitBreakerRegistry.from_config(app.config) if app else CircuitBreakerRegistry()
+        )
+    
+    @property
+    def model_router(self) -> ModelRouter:
+        """获取延迟感知的模型路由"""
+        return self._get_component(
+            'model_router',
+            lambda app: ModelRouter.from_config(app.config) if app else ModelRouter()
+        )
+    
+    @property
+    def token_budget(self) -> TokenBudget:
+        """获取本地token估算与提示词预算（上下文长度来自模型目录）"""
+        lookup = self.model_catalog.get_context_length
+        return self._get_component(
+            'token_budget',
+            lambda app: TokenBudget.from_config(app.config, lookup) if app else TokenBudget(context_length_lookup=lookup)
+        )
+    
+    @property
+    def model_catalog(self) -> ModelCatalog:
+        """获取模型目录（模型、上下文长度与定价）"""
+        return self._get_component(
+            'model_catalog',
+            lambda app: (
+                ModelCatalog.from_config(app.config, app.instance_path, self._fetch_models) if app
+                else ModelCatalog(self._fetch_models)
+            )
+        )
+    
+    @property
+    def key_validation_cache(self) -> KeyValidationCache:
+        """获取API密钥校验结果缓存"""
+        return self._get_component(
+            'key_validation_cache',
+            lambda app: KeyValidationCache.from_config(app.config) if app else KeyValidationCache()
+        )
+    
+    @property
+    def single_flight(self) -> SingleFlight:
+        """获取相同进行中请求的合并器"""
+        return self._get_component(
+            'single_flight',
+            lambda app: SingleFlight.from_config(app.config) if app else SingleFlight()
+        )
+    
+    @property
+    def scheduler(self) -> FairScheduler:
+        """获取按API密钥限制并发的公平调度器"""
+        return self._get_component(
+            'scheduler',
+            lambda app: FairScheduler.from_config(app.config) if app else FairScheduler()
+        )
+    
+    @property
+    def model_pricing(self) -> Dict[str, Dict]:
+        """模型定价信息（每1000 tokens的价格，单位：美元），包含 default 默认定价"""
+        return self.model_catalog.get_pricing_table()
+    
+    def get_transport_stats(self) -> Dict:
+        """获取连接池指标"""
+        return self.transport.get_stats()
+    
+    def get_cache_stats(self) -> Dict:
+        """获取响应缓存统计"""
+        return self.response_cache.get_stats()
+    
+    def get_resilience_stats(self) -> Dict:
+        """获取重试次数与熔断器状态"""
+        return {
+            'retry': self.retry_policy.get_stats(),
+            'circuit_breakers': self.circuit_breakers.get_stats()
+        }
+    
+    def get_routing_stats(self) -> Dict:
+        """获取模型路由的延迟与错误统计"""
+        return self.model_router.get_stats()
+    
+    def get_token_budget_stats(self) -> Dict:
+        """获取token预算与估算校准统计"""
+        return self.token_budget.get_stats()
+    
+    def get_catalog_stats(self) -> Dict:
+        """获取模型目录与密钥校验缓存统计"""
+        return {
+            'catalog': self.model_catalog.get_stats(),
+            'key_validation': self.key_validation_cache.get_stats()
         }
     
+    def get_coalescing_stats(self) -> Dict:
+        """获取相同请求合并统计"""
+        return self.single_flight.get_stats()
+    
+    def get_scheduler_stats(self) -> Dict:
+        """获取各API密钥的并发、排队深度与排队等待时间"""
+        return self.scheduler.get_stats()
+    
+    def _route(self, model_name: str, routing_policy: str = None) -> List[str]:
+        """按路由策略计算模型尝试顺序"""
+        models = [model for model in self.model_pricing if model != 'default']
+        return self.model_router.select(
+            model_name, models, self.model_pricing, policy=routing_policy,
+            is_available=lambda model: self.circuit_breakers.get(model).is_available()
+        )
+    
+    @staticmethod
+    def _is_failover_error(result: Dict) -> bool:
+        """判断失败是否应切换到下一个候选模型（熔断、超时、网络错误、限流与服务端错误）"""
+        return bool(
+            result.get('circuit_open') or result.get('transient') or
+            result.get('status_code') in RetryPolicy.RETRYABLE_STATUS
+        )
+    
+    def get_timeout(self) -> float:
+        """获取请求超时时间，优先读取系统配置 openrouter_timeout"""
+        try:
+            return float(SystemConfig.get_config('openrouter_timeout', self.timeout))
+        except Exception:
+            return self.timeout
+    
+    def _get_cache_key(self, payload: Dict, use_cache: Optional[bool] = None) -> Optional[str]:
+        """
+        计算请求的缓存键，不应使用缓存时返回 None
+        
+        缓存受系统配置 cache_enabled 控制；temperature > 0 的请求输出不确定，
+        仅在调用方显式传入 use_cache=True 时才使用缓存。
+        """
+        if use_cache is False:
+            return None
+        
+        try:
+            if SystemConfig.get_config('cache_enabled', 'true').lower() != 'true':
+                return None
+        except Exception:
+            return None
+        
+        if payload.get('temperature', 0) > 0 and not use_cache:
+            self.response_cache.record_bypass()
+            return None
+        
+        params = {key: value for key, value in payload.items() if key not in ('model', 'messages', 'stream', 'stream_options')}
+        return make_cache_key(payload['model'], payload['messages'], params)
+    
+    def _get_flight_key(self, payload: Dict, api_key: str, use_cache: Optional[bool] = None) -> Optional[str]:
+        """
+        计算合并相同进行中请求的键，不应合并时返回 None
+        
+        键由规范化后的模型、消息与参数组成，并区分API密钥（不同密钥分别计费，不合并）；
+        调用方显式传入 use_cache=False（如重新生成）时每次都发起独立请求。
+        """
+        if use_cache is False or not self.single_flight.enabled:
+            return None
+        
+        params = {key: value for key, value in payload.items() if key not in ('model', 'messages')}
+        key_hash = hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+        return f"{key_hash}:{make_cache_key(payload['model'], payload['messages'], params)}"
+    
     def get_default_api_key(self) -> Optional[str]:
         """获取默认API密钥"""
         return current_app.config.get('OPENROUTER_API_KEY')
@@ -32,6 +264,115 @@ class OpenRouterService:
         """获取默认模型"""
         return current_app.config.get('DEFAULT_MODEL', 'gpt-4o-mini')
     
+    def _build_headers(self, api_key: str) -> Dict:
+        """构建请求头"""
+        return {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json; charset=utf-8",
+            "HTTP-Referer": "https://case-creator.local",
+            "X-Title": "Case Creator Expert"  # 使用英文避免编码问题
+        }
+    
+    def _build_payload(self, messages: List[Dict], model_name: str, **kwargs) -> Dict:
+        """构建请求数据"""
+        payload = {
+            "model": model_name,
+            "messages": messages,
+            "temperature": kwargs.get('temperature', 0.7),
+            "max_tokens": kwargs.get('max_tokens', 2000),
+            "top_p": kwargs.get('top_p', 1.0),
+            "frequency_penalty": kwargs.get('frequency_penalty', 0),
+            "presence_penalty": kwargs.get('presence_penalty', 0)
+        }
+        
+        # 流式模式下要求在最后一个数据块中返回token用量
+        if kwargs.get('stream', False):
+            payload['stream'] = True
+            payload['stream_options'] = {'include_usage': True}
+        
+        return payload
+    
+    def _post_with_retry(self, model_name: str, api_key: str, headers: Dict, body: bytes,
+                         stream: bool = False, lease: Optional[Lease] = None):
+        """
+        发送聊天请求，对幂等失败进行退避重试，并维护模型熔断器
+        
+        传入 lease 时退避等待期间归还API密钥的并发名额，下次发送前重新排队获取
+        
+        Returns:
+            (response, 重试次数)；重试耗尽后返回最后一次响应或抛出最后一次异常
+        
+        Raises:
+            CircuitOpenError: 模型熔断中
+            QueueTimeoutError: 退避后重新排队超时
+        """
+        breaker = self.circuit_breakers.get(model_name)
+        policy = self.retry_policy
+        timeout = self.get_timeout()
+        attempt = 0
+        
+        while True:
+            breaker.before_request()
+            attempt_start = time.time()
+            try:
+                response = self.transport.post(
+                    f"{self.base_url}/chat/completions",
+                    api_key=api_key,
+                    headers=headers,
+                    data=body,
+                    timeout=timeout,
+                    stream=stream
+                )
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                breaker.record_failure()
+                self.model_router.record(model_name, time.time() - attempt_start, success=False)
+                reason = 'timeout' if isinstance(e, requests.exceptions.Timeout) else 'connection_error'
+                delay = policy.get_delay(attempt) if attempt < policy.max_retries else None
+                if delay is None:
+                    policy.record_outcome(attempt > 0, success=False)
+                    raise
+                policy.record_retry(reason)
+                self._backoff(delay, lease)
+                attempt += 1
+                continue
+            except Exception:
+                breaker.record_failure()
+                raise
+            
+            if response.status_code >= 500:
+                breaker.record_failure()
+            else:
+                # 4xx 说明模型可达，不计入熔断
+                breaker.record_success()
+            
+            if response.status_code == 200 or policy.is_retryable_status(response.status_code):
+                self.model_router.record(
+                    model_name, time.time() - attempt_start, success=response.status_code == 200
+                )
+            
+            if policy.is_retryable_status(response.status_code) and attempt < policy.max_retries:
+                retry_after = policy.parse_retry_after(response.headers.get('Retry-After'))
+                delay = policy.get_delay(attempt, retry_after)
+                if delay is not None:
+                    response.close()
+                    policy.record_retry(f'http_{response.status_code}')
+                    self._backoff(delay, lease)
+                    attempt += 1
+                    continue
+            
+            policy.record_outcome(attempt > 0, success=response.status_code == 200)
+            return response, attempt
+    
+    @staticmethod
+    def _backoff(delay: float, lease: Optional[Lease]):
+        """退避等待，期间归还并发名额"""
+        if lease is None:
+            time.sleep(delay)
+            return
+        lease.release()
+        time.sleep(delay)
+        lease.acquire()
+    
     def chat_completion(self, messages: List[Dict], model_name: str = None, api_key: str = None, 
                        user_uuid: str = None, session_id: str = None, 
                        request_type: str = None, workflow_step: str = None, **kwargs) -> Dict:
@@ -46,14 +387,73 @@ class OpenRouterService:
             session_id: 会话ID
             request_type: 请求类型
             workflow_step: 工作流步骤
-            **kwargs: 其他参数
+            **kwargs: 其他参数（stream=True 时内部按SSE流式接收后汇总返回；
+                routing_policy 指定本次请求的模型路由策略）
         
         Returns:
-            API响应结果
+            API响应结果，model_used 为实际使用的模型
         """
+        if kwargs.get('stream', False):
+            return self._collect_stream(self.stream_chat_completion(
+                messages, model_name=model_name, api_key=api_key, user_uuid=user_uuid,
+                session_id=session_id, request_type=request_type,
+                workflow_step=workflow_step, **kwargs
+            ))
+        
         # 使用默认值填充缺失参数
-        api_key = api_key or self.get_default_api_key()
         model_name = model_name or self.get_default_model()
+        candidates = self._route(model_name, kwargs.pop('routing_policy', None))
+        
+        span = tracer.start_span('llm.chat', model=model_name, step=workflow_step)
+        token = tracer.activate(span)
+        result = None
+        try:
+            for index, candidate in enumerate(candidates):
+                result = self._chat_completion_once(
+                    messages, candidate, api_key, user_uuid, session_id,
+                    request_type, workflow_step, **kwargs
+                )
+                result['model_used'] = candidate
+                if result['success'] or not self._is_failover_error(result) or index == len(candidates) - 1:
+                    break
+                # 当前模型不可用，切换到下一个候选模型
+                self.model_router.record_failover()
+        finally:
+            self._end_llm_span(span, result)
+            tracer.deactivate(token)
+        
+        return result
+    
+    @staticmethod
+    def _end_llm_span(span, outcome: Optional[Dict]):
+        """结束模型调用 span，记录实际模型、token用量、重试、缓存命中与首个token耗时"""
+        if span is None:
+            return
+        if outcome is None:
+            span.fail('调用未完成')
+            span.end()
+            return
+        span.set(model=outcome.get('model_used') or span.attributes.get('model'), llm_calls=1)
+        if outcome.get('retries'):
+            span.set(retries=outcome['retries'])
+        if outcome.get('cached'):
+            span.set(cache_hits=1)
+        if outcome.get('coalesced'):
+            span.set(coalesced=True)
+        if outcome.get('first_token_time') is not None:
+            span.set(first_token_ms=round(outcome['first_token_time'] * 1000, 2))
+        if outcome.get('data'):
+            usage = outcome['data'].get('usage') or {}
+            span.set(tokens=0 if outcome.get('cached') else usage.get('total_tokens', 0))
+        else:
+            span.fail(outcome.get('error'))
+        span.end()
+    
+    def _chat_completion_once(self, messages: List[Dict], model_name: str, api_key: str,
+                              user_uuid: str, session_id: str, request_type: str,
+                              workflow_step: str, **kwargs) -> Dict:
+        """使用指定模型调用一次聊天完成API（含缓存与重试）"""
+        api_key = api_key or self.get_default_api_key()
         
         if not api_key:
             return {
@@ -61,37 +461,105 @@ class OpenRouterService:
                 'error': 'API密钥未设置，请在环境变量或用户设置中配置OpenRouter API密钥'
             }
         
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json; charset=utf-8",
-            "HTTP-Referer": "https://case-creator.local",
-            "X-Title": "Case Creator Expert"  # 使用英文避免编码问题
-        }
+        headers = self._build_headers(api_key)
+        payload = self._build_payload(messages, model_name, **kwargs)
         
-        # 准备请求数据
-        payload = {
-            "model": model_name,
-            "messages": messages,
-            "temperature": kwargs.get('temperature', 0.7),
-            "max_tokens": kwargs.get('max_tokens', 2000),
-            "top_p": kwargs.get('top_p', 1.0),
-            "frequency_penalty": kwargs.get('frequency_penalty', 0),
-            "presence_penalty": kwargs.get('presence_penalty', 0)
-        }
+        cache_key = self._get_cache_key(payload, kwargs.get('use_cache'))
+        if cache_key:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                if user_uuid:
+                    self._log_api_usage(
+                        user_uuid=user_uuid,
+                        model_name=model_name,
+                        response=cached,
+                        session_id=session_id,
+                        request_type=request_type,
+                        workflow_step=workflow_step,
+                        cache_status='cached'
+                    )
+                return {
+                    'success': True,
+                    'data': cached,
+                    'response_time': 0.0,
+                    'cached': True
+                }
         
-        # 如果有系统提示，可以添加stream选项
-        if kwargs.get('stream', False):
-            payload['stream'] = True
+        start_time = time.time()
+        usage_context = self._usage_context(user_uuid, session_id, request_type, workflow_step, **kwargs)
+        flight_key = self._get_flight_key(payload, api_key, kwargs.get('use_cache'))
+        if flight_key:
+            # 相同请求进行中时不再发起上游请求，等待并共享其结果
+            events, leader = self.single_flight.join(
+                flight_key,
+                lambda: iter([self._request_completion(
+                    model_name, api_key, headers, payload, cache_key, user_uuid, kwargs.get('priority'),
+                    usage_context
+                )])
+            )
+            try:
+                results = list(events)
+            except TimeoutError as e:
+                return {'success': False, 'error': str(e), 'transient': True}
+            result = results[-1] if results else {'success': False, 'error': 'API请求已取消'}
+        else:
+            result = self._request_completion(
+                model_name, api_key, headers, payload, cache_key, user_uuid, kwargs.get('priority'),
+                usage_context
+            )
+            leader = True
+        
+        if result['success'] and not leader:
+            result['coalesced'] = True
+            result['response_time'] = time.time() - start_time
+            
+            # 上游请求已由发起请求的代码计费，合并的调用方只记一条零成本的归属记录
+            if user_uuid:
+                self._log_api_usage(
+                    model_name=model_name,
+                    response=result['data'],
+                    response_time=result['response_time'],
+                    cache_status='coalesced',
+                    **usage_context
+                )
+        
+        return result
+    
+    @staticmethod
+    def _usage_context(user_uuid: str, session_id: str, request_type: str, workflow_step: str,
+                       **kwargs) -> Dict:
+        """调用方的使用记录归属信息，传给 _log_api_usage"""
+        return {
+            'user_uuid': user_uuid,
+            'session_id': session_id,
+            'request_type': request_type,
+            'workflow_step': workflow_step,
+            'estimated_prompt_tokens': kwargs.get('estimated_prompt_tokens')
+        }
+    
+    def _request_completion(self, model_name: str, api_key: str, headers: Dict, payload: Dict,
+                            cache_key: Optional[str], user_uuid: str = None, priority: str = None,
+                            usage_context: Optional[Dict] = None) -> Dict:
+        """
+        发起一次上游聊天请求（含重试），成功时写入响应缓存并按 usage_context 记录计费用量；
+        请求前按API密钥排队获取并发名额
+
+        计费在发起上游请求的代码中只记录一次，与等待结果的调用方是否仍在无关
+        """
+        lease = self.scheduler.lease(api_key, user_uuid, priority or 'interactive')
+        try:
+            lease.acquire()
+        except QueueTimeoutError as e:
+            return {'success': False, 'error': str(e), 'queue_timeout': True}
         
         try:
             start_time = time.time()
             
             # 发送请求，显式处理UTF-8编码
-            response = requests.post(
-                f"{self.base_url}/chat/completions",
-                headers=headers,
-                data=json.dumps(payload, ensure_ascii=False).encode('utf-8'),
-                timeout=self.timeout
+            response, retries = self._post_with_retry(
+                model_name, api_key, headers,
+                json.dumps(payload, ensure_ascii=False).encode('utf-8'),
+                lease=lease
             )
             
             end_time = time.time()
@@ -101,172 +569,459 @@ class OpenRouterService:
             if response.status_code == 200:
                 result = response.json()
                 
-                # 记录API使用情况
-                if user_uuid:
-                    self._log_api_usage(
-                        user_uuid=user_uuid,
-                        model_name=model_name,
-                        response=result,
-                        session_id=session_id,
-                        request_type=request_type,
-                        workflow_step=workflow_step,
-                        response_time=response_time
-                    )
+                if cache_key:
+                    self.response_cache.set(cache_key, result)
+                
+                if usage_context and usage_context.get('user_uuid'):
+                    self._log_api_usage(model_name=model_name, response=result,
+                                        response_time=response_time, **usage_context)
                 
                 return {
                     'success': True,
                     'data': result,
-                    'response_time': response_time
+                    'response_time': response_time,
+                    'retries': retries
                 }
             else:
                 error_message = f"API请求失败: {response.status_code} - {response.text}"
                 return {
                     'success': False,
                     'error': error_message,
-                    'status_code': response.status_code
+                    'status_code': response.status_code,
+                    'retries': retries
                 }
                 
+        except CircuitOpenError as e:
+            return {
+                'success': False,
+                'error': str(e),
+                'circuit_open': True
+            }
+        except QueueTimeoutError as e:
+            return {'success': False, 'error': str(e), 'queue_timeout': True}
         except requests.exceptions.Timeout:
             return {
                 'success': False,
-                'error': 'API请求超时，请稍后重试'
+                'error': 'API请求超时，请稍后重试',
+                'transient': True
             }
         except requests.exceptions.ConnectionError:
             return {
                 'success': False,
-                'error': '网络连接错误，请检查网络连接'
+                'error': '网络连接错误，请检查网络连接',
+                'transient': True
             }
         except Exception as e:
             return {
                 'success': False,
                 'error': f'API调用异常: {str(e)}'
             }
+        finally:
+            lease.release()
     
-    def _log_api_usage(self, user_uuid: str, model_name: str, response: Dict,
-                      session_id: str = None, request_type: str = None,
-                      workflow_step: str = None, response_time: float = None):
-        """记录API使用统计"""
+    def stream_chat_completion(self, messages: List[Dict], model_name: str = None, api_key: str = None,
+                               user_uuid: str = None, session_id: str = None,
+                               request_type: str = None, workflow_step: str = None,
+                               **kwargs) -> Iterator[Dict]:
+        """
+        以SSE流式方式调用OpenRouter聊天完成API
+        
+        逐个产出事件：
+            {'type': 'delta', 'content': 增量文本}
+            {'type': 'done', 'data': 与非流式响应格式一致的完整结果, 'response_time': 耗时,
+             'first_token_time': 首个token耗时}
+            {'type': 'error', 'error': 错误信息, 'status_code': 状态码(可选)}
+        done/error 事件的 model_used 为实际使用的模型。首个增量输出之前失败时按路由策略切换模型。
+        """
+        model_name = model_name or self.get_default_model()
+        candidates = self._route(model_name, kwargs.pop('routing_policy', None))
+        
+        span = tracer.start_span('llm.chat', model=model_name, step=workflow_step, stream=True)
+        token = tracer.activate(span)
+        outcome = None
         try:
-            # 提取token使用信息
-            usage = response.get('usage', {})
-            prompt_tokens = usage.get('prompt_tokens', 0)
-            completion_tokens = usage.get('completion_tokens', 0)
-            total_tokens = usage.get('total_tokens', prompt_tokens + completion_tokens)
+            for index, candidate in enumerate(candidates):
+                started = False
+                for event in self._stream_chat_completion_once(
+                    messages, candidate, api_key, user_uuid, session_id,
+                    request_type, workflow_step, **kwargs
+                ):
+                    if event['type'] == 'delta':
+                        started = True
+                    elif event['type'] == 'error' and not started and index < len(candidates) - 1 \
+                            and self._is_failover_error(event):
+                        # 当前模型不可用，切换到下一个候选模型
+                        self.model_router.record_failover()
+                        break
+                    else:
+                        event['model_used'] = candidate
+                        outcome = event
+                    yield event
+                else:
+                    return
+        finally:
+            self._end_llm_span(span, outcome)
+            tracer.deactivate(token, span.parent if span else None)
+    
+    def _stream_chat_completion_once(self, messages: List[Dict], model_name: str, api_key: str,
+                                     user_uuid: str, session_id: str, request_type: str,
+                                     workflow_step: str, **kwargs) -> Iterator[Dict]:
+        """使用指定模型流式调用一次聊天完成API（含缓存与重试）"""
+        api_key = api_key or self.get_default_api_key()
+        
+        if not api_key:
+            yield {
+                'type': 'error',
+                'error': 'API密钥未设置，请在环境变量或用户设置中配置OpenRouter API密钥'
+            }
+            return
+        
+        headers = self._build_headers(api_key)
+        headers['Accept'] = 'text/event-stream'
+        payload = self._build_payload(messages, model_name, **{**kwargs, 'stream': True})
+        
+        cache_key = self._get_cache_key(payload, kwargs.get('use_cache'))
+        if cache_key:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                if user_uuid:
+                    self._log_api_usage(
+                        user_uuid=user_uuid,
+                        model_name=model_name,
+                        response=cached,
+                        session_id=session_id,
+                        request_type=request_type,
+                        workflow_step=workflow_step,
+                        cache_status='cached'
+                    )
+                yield {'type': 'delta', 'content': cached['choices'][0]['message']['content']}
+                yield {'type': 'done', 'data': cached, 'response_time': 0.0, 'first_token_time': 0.0,
+                       'cached': True}
+                return
+        
+        start_time = time.time()
+        usage_context = self._usage_context(user_uuid, session_id, request_type, workflow_step, **kwargs)
+        flight_key = self._get_flight_key(payload, api_key, kwargs.get('use_cache'))
+        if flight_key:
+            # 相同的流式请求进行中时订阅其事件（从头重放已产出的增量）
+            events, leader = self.single_flight.join(
+                flight_key,
+                lambda: self._stream_request(
+                    model_name, api_key, headers, payload, cache_key, user_uuid, kwargs.get('priority'),
+                    usage_context
+                )
+            )
+        else:
+            events = self._stream_request(
+                model_name, api_key, headers, payload, cache_key, user_uuid, kwargs.get('priority'),
+                usage_context
+            )
+            leader = True
+        
+        try:
+            for event in events:
+                if event['type'] == 'done' and not leader:
+                    event['coalesced'] = True
+                    event['response_time'] = time.time() - start_time
+                    # 上游请求已由发起请求的代码计费，合并的调用方只记一条零成本的归属记录
+                    if user_uuid:
+                        self._log_api_usage(
+                            model_name=model_name,
+                            response=event['data'],
+                            response_time=event['response_time'],
+                            cache_status='coalesced',
+                            **usage_context
+                        )
+                yield event
+        except TimeoutError as e:
+            yield {'type': 'error', 'error': str(e), 'transient': True}
+        finally:
+            # 调用方提前停止读取时关闭上游（合并的请求仅在所有调用方都离开后取消）
+            events.close()
+    
+    def _stream_request(self, model_name: str, api_key: str, headers: Dict, payload: Dict,
+                        cache_key: Optional[str], user_uuid: str = None,
+                        priority: str = None, usage_context: Optional[Dict] = None) -> Iterator[Dict]:
+        """
+        发起一次上游流式请求（含重试），完整结束时写入响应缓存并按 usage_context 记录计费用量；
+        读取期间占用API密钥的并发名额
+        """
+        lease = self.scheduler.lease(api_key, user_uuid, priority or 'interactive')
+        try:
+            lease.acquire()
+        except QueueTimeoutError as e:
+            yield {'type': 'error', 'error': str(e), 'queue_timeout': True}
+            return
+        
+        response = None
+        try:
+            start_time = time.time()
+            response, retries = self._post_with_retry(
+                model_name, api_key, headers,
+                json.dumps(payload, ensure_ascii=False).encode('utf-8'),
+                stream=True, lease=lease
+            )
             
-            # 计算成本
-            cost = self._calculate_cost(model_name, prompt_tokens, completion_tokens)
+            if response.status_code != 200:
+                if hasattr(response, 'read'):
+                    # httpx 流式响应需先读取正文才能访问 text
+                    response.read()
+                yield {
+                    'type': 'error',
+                    'error': f"API请求失败: {response.status_code} - {response.text}",
+                    'status_code': response.status_code,
+                    'retries': retries
+                }
+                return
             
-            # 创建使用记录
-            api_usage = APIUsage(
-                user_uuid=user_uuid,
-                model_name=model_name,
-                tokens_used=total_tokens,
-                cost=cost,
-                request_type=request_type,
-                workflow_step=workflow_step,
-                session_id=session_id
-            )
+            content_parts = []
+            usage = {}
+            finish_reason = None
+            response_model = model_name
+            first_token_time = None
+            
+            for chunk in self._iter_sse_events(response):
+                if 'error' in chunk:
+                    error = chunk['error']
+                    message = error.get('message', str(error)) if isinstance(error, dict) else str(error)
+                    yield {'type': 'error', 'error': f'API流式响应错误: {message}'}
+                    return
+                
+                response_model = chunk.get('model', response_model)
+                if chunk.get('usage'):
+                    usage = chunk['usage']
+                
+                for choice in chunk.get('choices') or []:
+                    delta = (choice.get('delta') or {}).get('content')
+                    if delta:
+                        if first_token_time is None:
+                            first_token_time = time.time() - start_time
+                        content_parts.append(delta)
+                        yield {'type': 'delta', 'content': delta}
+                    if choice.get('finish_reason'):
+                        finish_reason = choice['finish_reason']
+            
+            response_time = time.time() - start_time
+            result = {
+                'model': response_model,
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': ''.join(content_parts)},
+                    'finish_reason': finish_reason
+                }],
+                'usage': usage
+            }
+            
+            if cache_key and finish_reason:
+                self.response_cache.set(cache_key, result)
             
-            db.session.add(api_usage)
-            db.session.commit()
+            if usage_context and usage_context.get('user_uuid'):
+                self._log_api_usage(model_name=model_name, response=result,
+                                    response_time=response_time, **usage_context)
             
+            yield {
+                'type': 'done',
+                'data': result,
+                'response_time': response_time,
+                'first_token_time': first_token_time,
+                'retries': retries
+            }
+            
+        except CircuitOpenError as e:
+            yield {'type': 'error', 'error': str(e), 'circuit_open': True}
+        except QueueTimeoutError as e:
+            yield {'type': 'error', 'error': str(e), 'queue_timeout': True}
+        except requests.exceptions.Timeout:
+            yield {'type': 'error', 'error': 'API请求超时，请稍后重试', 'transient': True}
+        except requests.exceptions.ConnectionError:
+            yield {'type': 'error', 'error': '网络连接错误，请检查网络连接', 'transient': True}
         except Exception as e:
-            # 记录日志失败不应该影响主要功能
-            print(f"记录API使用情况失败: {str(e)}")
-            db.session.rollback()
+            yield {'type': 'error', 'error': f'API调用异常: {str(e)}'}
+        finally:
+            if response is not None:
+                response.close()
+            lease.release()
+    
+    @staticmethod
+    def _iter_sse_events(response) -> Iterator[Dict]:
+        """解析SSE响应，逐个产出 data 字段的JSON对象，忽略注释行（如 OpenRouter 的保活消息）"""
+        data_lines = []
+        for raw_line in response.iter_lines():
+            line = raw_line.decode('utf-8') if isinstance(raw_line, bytes) else raw_line
+            
+            if not line:
+                # 空行表示一个事件结束
+                if data_lines:
+                    data = '\n'.join(data_lines)
+                    data_lines = []
+                    if data == '[DONE]':
+                        return
+                    yield json.loads(data)
+                continue
+            
+            if line.startswith(':'):
+                continue
+            
+            if line.startswith('data:'):
+                data_lines.append(line[5:].lstrip())
+        
+        if data_lines:
+            data = '\n'.join(data_lines)
+            if data != '[DONE]':
+                yield json.loads(data)
     
-    def _calculate_cost(self, model_name: str, prompt_tokens: int, completion_tokens: int) -> float:
-        """计算API调用成本"""
-        # 获取模型定价，如果没有则使用默认定价
-        pricing = self.model_pricing.get(model_name, self.model_pricing['default'])
+    @staticmethod
+    def _collect_stream(events: Iterator[Dict]) -> Dict:
+        """将流式事件汇总为与 chat_completion 一致的返回格式"""
+        for event in events:
+            if event['type'] == 'done':
+                result = {
+                    'success': True,
+                    'data': event['data'],
+                    'response_time': event['response_time']
+                }
+                for key in ('cached', 'coalesced', 'retries', 'model_used'):
+                    if key in event:
+                        result[key] = event[key]
+                return result
+            if event['type'] == 'error':
+                result = {'success': False, 'error': event['error']}
+                for key in ('status_code', 'retries', 'circuit_open', 'transient', 'queue_timeout', 'model_used'):
+                    if key in event:
+                        result[key] = event[key]
+                return result
+        return {'success': False, 'error': 'API流式响应意外结束'}
+    
+    def _log_api_usage(self, user_uuid: str, model_name: str, response: Dict,
+                      session_id: str = None, request_type: str = None,
+                      workflow_step: str = None, response_time: float = None,
+                      cache_status: str = None, estimated_prompt_tokens: int = None):
+        """记录API使用统计（缓存命中与合并的请求记为零成本）"""
+        with tracer.span('usage.record', cache_status=cache_status):
+            try:
+                if cache_status:
+                    prompt_tokens = 0
+                    completion_tokens = 0
+                    total_tokens = 0
+                    cached_tokens = 0
+                    cost = 0.0
+                else:
+                    # 提取token使用信息
+                    usage = response.get('usage') or {}
+                    prompt_tokens = usage.get('prompt_tokens', 0)
+                    completion_tokens = usage.get('completion_tokens', 0)
+                    total_tokens = usage.get('total_tokens', prompt_tokens + completion_tokens)
+                    cached_tokens = self.get_cached_tokens(usage)
+                
+                    # 计算成本
+                    cost = self._calculate_cost(model_name, prompt_tokens, completion_tokens, cached_tokens)
+                
+                    # 记录本地估算值与实际值，用于校准估算器
+                    self.token_budget.record_actual(model_name, estimated_prompt_tokens, prompt_tokens)
+                
+                # 创建使用记录
+                fields = dict(
+                    user_uuid=user_uuid,
+                    model_name=model_name,
+                    tokens_used=total_tokens,
+                    cost=cost,
+                    request_type=request_type,
+                    workflow_step=workflow_step,
+                    session_id=session_id,
+                    cache_status=cache_status,
+                    prompt_tokens=prompt_tokens,
+                    completion_tokens=completion_tokens,
+                    cached_tokens=cached_tokens,
+                    estimated_prompt_tokens=estimated_prompt_tokens
+                )
+                
+                # 优先交给后台批量写入，未启用时同步写入
+                if usage_recorder.record(**fields):
+                    return
+                
+                db.session.add(APIUsage(**fields))
+                db.session.commit()
+                
+            except Exception as e:
+                # 记录日志失败不应该影响主要功能
+                print(f"记录API使用情况失败: {str(e)}")
+                db.session.rollback()
+    
+    @staticmethod
+    def get_cached_tokens(usage: Dict) -> int:
+        """从用量信息中读取命中服务端提示词缓存的token数"""
+        details = usage.get('prompt_tokens_details') or {}
+        return int(details.get('cached_tokens') or 0)
+    
+    def _calculate_cost(self, model_name: str, prompt_tokens: int, completion_tokens: int,
+                        cached_tokens: int = 0) -> float:
+        """计算API调用成本，命中提示词缓存的部分按缓存读取价格计算（未提供时按输入价格）"""
+        # 从模型目录获取定价，未知模型使用默认定价
+        pricing = self.model_catalog.get_pricing(model_name)
         
         # 计算成本（价格是每1000个token）
-        input_cost = (prompt_tokens / 1000) * pricing['input']
+        cached_tokens = min(cached_tokens, prompt_tokens)
+        input_cost = ((prompt_tokens - cached_tokens) / 1000) * pricing['input']
+        input_cost += (cached_tokens / 1000) * pricing.get('cache_read', pricing['input'])
         output_cost = (completion_tokens / 1000) * pricing['output']
         
         return round(input_cost + output_cost, 6)
     
-    def get_available_models(self) -> List[Dict]:
+    def _fetch_models(self) -> List[Dict]:
+        """从OpenRouter模型接口获取模型列表（无需API密钥）"""
+        response = self.transport.get(f"{self.base_url}/models", timeout=10)
+        response.raise_for_status()
+        return response.json().get('data', [])
+    
+    def get_available_models(self, include_all: bool = False) -> List[Dict]:
         """获取可用模型列表"""
-        return [
-            {
-                'id': 'gpt-4o',
-                'name': 'GPT-4o',
-                'provider': 'OpenAI',
-                'description': '最新的GPT-4模型，性能优异',
-                'pricing': self.model_pricing.get('gpt-4o')
-            },
-            {
-                'id': 'gpt-4o-mini',
-                'name': 'GPT-4o Mini',
-                'provider': 'OpenAI',
-                'description': '轻量级GPT-4模型，成本较低',
-                'pricing': self.model_pricing.get('gpt-4o-mini')
-            },
-            {
-                'id': 'claude-3-opus',
-                'name': 'Claude 3 Opus',
-                'provider': 'Anthropic',
-                'description': '最强大的Claude模型',
-                'pricing': self.model_pricing.get('claude-3-opus')
-            },
-            {
-                'id': 'claude-3-sonnet',
-                'name': 'Claude 3 Sonnet',
-                'provider': 'Anthropic',
-                'description': '平衡性能和成本的Claude模型',
-                'pricing': self.model_pricing.get('claude-3-sonnet')
-            },
-            {
-                'id': 'claude-3-haiku',
-                'name': 'Claude 3 Haiku',
-                'provider': 'Anthropic',
-                'description': '快速且经济的Claude模型',
-                'pricing': self.model_pricing.get('claude-3-haiku')
-            }
-        ]
+        return self.model_catalog.list_models(include_all=include_all)
     
     def validate_api_key(self, api_key: str = None) -> Dict:
-        """验证API密钥有效性"""
+        """
+        验证API密钥有效性
+        
+        调用密钥元数据接口，不消耗token；结果按密钥摘要缓存
+        """
         api_key = api_key or self.get_default_api_key()
         
         if not api_key:
             return {'valid': False, 'message': 'API密钥未设置'}
         
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        # 发送简单的测试请求
-        test_payload = {
-            "model": "gpt-4o-mini",
-            "messages": [{"role": "user", "content": "Hello"}],
-            "max_tokens": 1
-        }
+        cached = self.key_validation_cache.get(api_key)
+        if cached is not None:
+            return dict(cached, cached=True)
         
         try:
-            response = requests.post(
-                f"{self.base_url}/chat/completions",
-                headers=headers,
-                json=test_payload,
+            response = self.transport.get(
+                f"{self.base_url}/auth/key",
+                api_key=api_key,
+                headers=self._build_headers(api_key),
                 timeout=10
             )
             
             if response.status_code == 200:
-                return {'valid': True, 'message': 'API密钥有效'}
-            elif response.status_code == 401:
-                return {'valid': False, 'message': 'API密钥无效或已过期'}
+                key_info = response.json().get('data') or {}
+                result = {
+                    'valid': True,
+                    'message': 'API密钥有效',
+                    'label': key_info.get('label'),
+                    'usage': key_info.get('usage'),
+                    'limit': key_info.get('limit'),
+                    'is_free_tier': key_info.get('is_free_tier')
+                }
+            elif response.status_code in (401, 403):
+                result = {'valid': False, 'message': 'API密钥无效或已过期'}
             else:
+                # 服务端异常不代表密钥无效，不缓存
                 return {'valid': False, 'message': f'验证失败: {response.status_code}'}
+            
+            self.key_validation_cache.set(api_key, result)
+            return result
                 
         except Exception as e:
             return {'valid': False, 'message': f'验证异常: {str(e)}'}
     
     def get_model_info(self, model_name: str) -> Optional[Dict]:
         """获取模型信息"""
-        models = self.get_available_models()
-        for model in models:
-            if model['id'] == model_name:
-                return model
-        return None 
\ No newline at end of file
+        return self.model_catalog.get_model(model_name) 
\ No newline at end of file
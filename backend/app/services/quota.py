@@ -0,0 +1,260 @@
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Deque, Dict, Optional, Tuple
+
+
+def _day_key(now: float) -> str:
+    """用量按UTC自然日统计（与 api_usage.created_at 一致）"""
+    return datetime.utcfromtimestamp(now).strftime('%Y-%m-%d')
+
+
+def _seconds_until_next_day(now: float) -> int:
+    current = datetime.utcfromtimestamp(now)
+    next_day = datetime(current.year, current.month, current.day) + timedelta(days=1)
+    return max(int((next_day - current).total_seconds()) + 1, 1)
+
+
+class MemoryQuotaStore:
+    """进程内计数：每分钟请求数使用滑动窗口，每日请求数按自然日计数"""
+
+    backend = 'memory'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._windows: Dict[str, Deque[float]] = {}
+        self._daily: Dict[str, int] = {}
+        self._day: Optional[str] = None
+
+    def _roll_day(self, day: str):
+        if self._day != day:
+            self._day = day
+            self._daily = {}
+
+    def acquire(self, user_uuid: str, now: float, rate_limit: Optional[int], window: float,
+                daily_limit: Optional[int], count: int = 1) -> Tuple[bool, Optional[str], float]:
+        """
+        尝试为用户计入 count 次请求（全部计入或全部不计入）
+
+        rate_limit / daily_limit 为 None 时不计入对应的计数，为 0 时只计数不限制
+
+        Returns:
+            (是否允许, 超限原因 rate/daily, 建议重试等待秒数)
+        """
+        day = _day_key(now)
+        with self._lock:
+            self._roll_day(day)
+
+            if daily_limit and self._daily.get(user_uuid, 0) + count > daily_limit:
+                return False, 'daily', _seconds_until_next_day(now)
+
+            if rate_limit is not None:
+                hits = self._windows.setdefault(user_uuid, deque())
+                while hits and hits[0] <= now - window:
+                    hits.popleft()
+                if rate_limit > 0 and len(hits) + count > rate_limit:
+                    return False, 'rate', max(hits[0] + window - now, 0.0) if hits else window
+                hits.extend([now] * count)
+
+            if daily_limit is not None:
+                self._daily[user_uuid] = self._daily.get(user_uuid, 0) + count
+            return True, None, 0.0
+
+    def load_daily(self, counts: Dict[str, int], now: float):
+        """用数据库中的当日用量初始化计数"""
+        with self._lock:
+            self._roll_day(_day_key(now))
+            for user_uuid, count in counts.items():
+                self._daily[user_uuid] = max(self._daily.get(user_uuid, 0), count)
+
+    def tracked_users(self) -> int:
+        with self._lock:
+            return len(self._daily)
+
+
+class RedisQuotaStore:
+    """
+    Redis 共享计数，用于多进程部署
+
+    每分钟请求数使用有序集合实现滑动窗口，每日请求数使用按日期命名、次日过期的计数键。
+    """
+
+    backend = 'redis'
+
+    def __init__(self, url: str, prefix: str = 'case_creator:quota'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.client.ping()
+        self.prefix = prefix
+
+    def _daily_key(self, user_uuid: str, day: str) -> str:
+        return f"{self.prefix}:daily:{day}:{user_uuid}"
+
+    def acquire(self, user_uuid: str, now: float, rate_limit: Optional[int], window: float,
+                daily_limit: Optional[int], count: int = 1) -> Tuple[bool, Optional[str], float]:
+        # 先计数再判断，超限时撤销，保证多进程并发下不超额
+        daily_key = self._daily_key(user_uuid, _day_key(now))
+        if daily_limit is not None:
+            pipe = self.client.pipeline()
+            pipe.incrby(daily_key, count)
+            pipe.expire(daily_key, _seconds_until_next_day(now) + 3600)
+            daily_count, _ = pipe.execute()
+            if daily_limit > 0 and daily_count > daily_limit:
+                self.client.decrby(daily_key, count)
+                return False, 'daily', _seconds_until_next_day(now)
+
+        if rate_limit:
+            window_key = f"{self.prefix}:window:{user_uuid}"
+            members = {f"{now}:{threading.get_ident()}:{index}": now for index in range(count)}
+            pipe = self.client.pipeline()
+            pipe.zremrangebyscore(window_key, 0, now - window)
+            pipe.zadd(window_key, members)
+            pipe.zcard(window_key)
+            pipe.zrange(window_key, 0, 0, withscores=True)
+            pipe.expire(window_key, int(window) + 1)
+            _, _, window_count, oldest, _ = pipe.execute()
+            if window_count > rate_limit:
+                pipe = self.client.pipeline()
+                pipe.zrem(window_key, *members)
+                if daily_limit is not None:
+                    pipe.decrby(daily_key, count)
+                pipe.execute()
+                oldest_time = oldest[0][1] if oldest else now
+                return False, 'rate', max(oldest_time + window - now, 0.0)
+
+        return True, None, 0.0
+
+    def load_daily(self, counts: Dict[str, int], now: float):
+        """仅为尚无计数的用户写入数据库中的当日用量（其他进程可能已在计数）"""
+        day = _day_key(now)
+        ttl = _seconds_until_next_day(now) + 3600
+        pipe = self.client.pipeline()
+        for user_uuid, count in counts.items():
+            pipe.set(self._daily_key(user_uuid, day), count, ex=ttl, nx=True)
+        pipe.execute()
+
+    def tracked_users(self) -> Optional[int]:
+        return None
+
+
+class QuotaManager:
+    """
+    用户请求配额
+
+    在工作流开始调用模型之前检查：每分钟请求数（滑动窗口）和每日请求数
+    （系统配置 max_daily_requests，未设置时使用 MAX_DAILY_REQUESTS）。
+    计数保存在内存中，启动时根据 api_usage 中当日的会话数重建，请求路径上不查询用量表；
+    多进程部署可配置 QUOTA_BACKEND=redis 共享计数。管理员不受限制。
+    """
+
+    def __init__(self, enabled: bool = True, rate_limit: int = 10, window: float = 60.0,
+                 daily_limit: int = 100, store=None):
+        self.enabled = enabled
+        self.rate_limit = rate_limit
+        self.window = window
+        self.daily_limit = daily_limit
+        self.store = store or MemoryQuotaStore()
+
+        self._lock = threading.Lock()
+        self._stats = {'allowed': 0, 'rejected_rate': 0, 'rejected_daily': 0, 'store_errors': 0}
+
+    def init_app(self, app):
+        """根据配置选择计数存储，并从 api_usage 重建当日用量"""
+        config = app.config
+        self.enabled = config.get('QUOTA_ENABLED', self.enabled)
+        self.rate_limit = config.get('RATE_LIMIT_PER_MINUTE', self.rate_limit)
+        self.daily_limit = config.get('MAX_DAILY_REQUESTS', self.daily_limit)
+
+        if config.get('QUOTA_BACKEND', 'memory') == 'redis':
+            try:
+                self.store = RedisQuotaStore(config.get('QUOTA_REDIS_URL', 'redis://localhost:6379/0'))
+            except Exception as e:
+                print(f"配额计数无法使用Redis，已回退到进程内计数: {str(e)}")
+                self.store = MemoryQuotaStore()
+        else:
+            self.store = MemoryQuotaStore()
+
+        if self.enabled:
+            with app.app_context():
+                self.rebuild()
+
+    def rebuild(self):
+        """按用户统计当日 api_usage 中的不同会话数（一次工作流对应一个会话）"""
+        from sqlalchemy import func
+        from ..models import APIUsage
+
+        now = time.time()
+        day_start = datetime.strptime(_day_key(now), '%Y-%m-%d')
+        try:
+            rows = APIUsage.query.with_entities(
+                APIUsage.user_uuid, func.count(func.distinct(APIUsage.session_id))
+            ).filter(APIUsage.created_at >= day_start).group_by(APIUsage.user_uuid).all()
+            self.store.load_daily({user_uuid: count for user_uuid, count in rows}, now)
+        except Exception as e:
+            print(f"重建用户配额计数失败: {str(e)}")
+
+    def get_daily_limit(self) -> int:
+        """每日请求上限，系统配置优先"""
+        from ..models import SystemConfig
+
+        try:
+            return int(SystemConfig.get_config('max_daily_requests', self.daily_limit))
+        except Exception:
+            return self.daily_limit
+
+    def check(self, user, count: int = 1, daily: bool = True, rate: bool = True) -> Optional[Dict]:
+        """
+        为用户计入 count 次工作流请求（全部计入或全部不计入）
+
+        daily / rate 为 False 时不计入对应的配额：批量任务提交时按行计入每日配额，
+        每行执行前再占用每分钟配额
+
+        Returns:
+            超出配额时返回 {'error': 错误信息, 'retry_after': 秒数}，否则返回 None
+        """
+        if not self.enabled or getattr(user, 'is_admin', False):
+            return None
+
+        daily_limit = self.get_daily_limit()
+        try:
+            allowed, reason, retry_after = self.store.acquire(
+                user.uuid, time.time(), self.rate_limit if rate else None, self.window,
+                daily_limit if daily else None, count
+            )
+        except Exception as e:
+            # 计数存储不可用时不阻塞业务
+            print(f"检查用户配额失败: {str(e)}")
+            with self._lock:
+                self._stats['store_errors'] += 1
+            return None
+
+        with self._lock:
+            self._stats['allowed' if allowed else f'rejected_{reason}'] += 1
+        if allowed:
+            return None
+
+        retry_after = max(int(retry_after + 0.999), 1)
+        if reason == 'daily' and count > 1:
+            error = f'本次需要{count}次请求，超出每日剩余请求次数（每日上限{daily_limit}次）'
+        elif reason == 'daily':
+            error = f'已达到每日请求上限（{daily_limit}次），请明天再试'
+        else:
+            error = f'请求过于频繁（每分钟最多{self.rate_limit}次），请{retry_after}秒后重试'
+        return {'error': error, 'retry_after': retry_after}
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update({
+            'enabled': self.enabled,
+            'backend': self.store.backend,
+            'rate_limit_per_minute': self.rate_limit,
+            'daily_limit': self.get_daily_limit(),
+            'tracked_users': self.store.tracked_users()
+        })
+        return stats
+
+
+quota_manager = QuotaManager()
@@ -0,0 +1,206 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+
+class CircuitOpenError(Exception):
+    """模型熔断中，请求被快速拒绝"""
+
+    def __init__(self, model_name: str, retry_in: float):
+        self.model_name = model_name
+        self.retry_in = retry_in
+        super().__init__(f'模型 {model_name} 暂时不可用（熔断中），请约 {int(retry_in) + 1} 秒后重试或切换模型')
+
+
+class RetryPolicy:
+    """
+    幂等失败的重试策略
+
+    对超时、连接错误以及 408/425/429/5xx 响应进行指数退避重试（全抖动），
+    优先遵循服务端返回的 Retry-After。
+    """
+
+    RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+    def __init__(self, max_retries: int = 2, base_delay: float = 0.5, max_delay: float = 8.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._lock = threading.Lock()
+        self._stats = {
+            'retries': 0,
+            'retry_successes': 0,
+            'retries_exhausted': 0,
+            'by_reason': {}
+        }
+
+    @classmethod
+    def from_config(cls, config) -> 'RetryPolicy':
+        return cls(
+            max_retries=config.get('OPENROUTER_MAX_RETRIES', 2),
+            base_delay=config.get('OPENROUTER_RETRY_BASE_DELAY', 0.5),
+            max_delay=config.get('OPENROUTER_RETRY_MAX_DELAY', 8.0)
+        )
+
+    def is_retryable_status(self, status_code: int) -> bool:
+        return status_code in self.RETRYABLE_STATUS
+
+    @staticmethod
+    def parse_retry_after(value: Optional[str]) -> Optional[float]:
+        """解析 Retry-After 头（秒数或HTTP日期）"""
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+    def get_delay(self, attempt: int, retry_after: Optional[float] = None) -> Optional[float]:
+        """
+        计算第 attempt 次重试前的等待时间（attempt 从0开始）
+
+        Returns:
+            等待秒数；Retry-After 超过最大等待时间时返回 None，表示不再重试
+        """
+        if retry_after is not None:
+            return retry_after if retry_after <= self.max_delay else None
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def record_retry(self, reason: str):
+        with self._lock:
+            self._stats['retries'] += 1
+            self._stats['by_reason'][reason] = self._stats['by_reason'].get(reason, 0) + 1
+
+    def record_outcome(self, retried: bool, success: bool):
+        if not retried:
+            return
+        with self._lock:
+            if success:
+                self._stats['retry_successes'] += 1
+            else:
+                self._stats['retries_exhausted'] += 1
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['by_reason'] = dict(self._stats['by_reason'])
+        stats['max_retries'] = self.max_retries
+        return stats
+
+
+class CircuitBreaker:
+    """
+    单个模型的熔断器
+
+    closed: 正常放行；连续失败达到阈值后进入 open
+    open: 快速失败，冷却时间结束后进入 half_open
+    half_open: 只放行一个探测请求，成功则恢复 closed，失败则重新 open
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, model_name: str, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        self.model_name = model_name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.total_failures = 0
+        self.times_opened = 0
+        self.rejected = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_request(self):
+        """请求前检查，熔断中抛出 CircuitOpenError"""
+        with self._lock:
+            if self.state == self.OPEN:
+                elapsed = time.monotonic() - self.opened_at
+                if elapsed < self.recovery_timeout:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.model_name, self.recovery_timeout - elapsed)
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+
+            if self.state == self.HALF_OPEN:
+                if self._probe_in_flight:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.model_name, 1.0)
+                self._probe_in_flight = True
+
+    def is_available(self) -> bool:
+        """熔断器当前是否会放行请求（不改变状态）"""
+        with self._lock:
+            if self.state == self.OPEN:
+                return time.monotonic() - self.opened_at >= self.recovery_timeout
+            if self.state == self.HALF_OPEN:
+                return not self._probe_in_flight
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.total_failures += 1
+            self.consecutive_failures += 1
+            self._probe_in_flight = False
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.times_opened += 1
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'total_failures': self.total_failures,
+                'times_opened': self.times_opened,
+                'rejected': self.rejected
+            }
+
+
+class CircuitBreakerRegistry:
+    """按模型维护熔断器"""
+
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config) -> 'CircuitBreakerRegistry':
+        return cls(
+            failure_threshold=config.get('OPENROUTER_BREAKER_THRESHOLD', 5),
+            recovery_timeout=config.get('OPENROUTER_BREAKER_RECOVERY', 30.0)
+        )
+
+    def get(self, model_name: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(model_name)
+            if breaker is None:
+                breaker = CircuitBreaker(model_name, self.failure_threshold, self.recovery_timeout)
+                self._breakers[model_name] = breaker
+            return breaker
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return {breaker.model_name: breaker.get_stats() for breaker in breakers}
@@ -0,0 +1,225 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+
+_WHITESPACE_RE = re.compile(r'\s+')
+# 中文字符与相邻字符之间的空白没有语义
+_CJK_SPACE_RE = re.compile(r'(?<=[\u2e80-\u9fff\uf900-\ufaff])\s+|\s+(?=[\u2e80-\u9fff\uf900-\ufaff])')
+
+
+def normalize_text(text: str) -> str:
+    """
+    规范化文本：NFKC 将全角字母、数字和标点转换为半角，去除中文字符两侧的空白并合并连续空白
+    """
+    if not isinstance(text, str):
+        return text
+    text = unicodedata.normalize('NFKC', text)
+    text = _CJK_SPACE_RE.sub('', text)
+    return _WHITESPACE_RE.sub(' ', text).strip()
+
+
+def make_cache_key(model_name: str, messages: List[Dict], params: Dict[str, Any]) -> str:
+    """根据模型、消息和采样参数生成缓存键"""
+    normalized = {
+        'model': normalize_text(model_name or ''),
+        'messages': [
+            {'role': message.get('role'), 'content': normalize_text(message.get('content', ''))}
+            for message in messages
+        ],
+        'params': {key: params[key] for key in sorted(params) if params[key] is not None}
+    }
+    raw = json.dumps(normalized, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    LLM响应缓存
+
+    内存 LRU 作为一级缓存，SQLite 文件作为二级持久缓存；
+    按 TTL 过期，内存按条目数淘汰，磁盘按总字节数淘汰最久未访问的条目
+    （磁盘总字节数在写入和删除时累计，超出容量时才扫描表）。
+    """
+
+    def __init__(self, path: Optional[str] = None, max_memory_entries: int = 512,
+                 ttl: int = 86400, max_disk_bytes: int = 256 * 1024 * 1024):
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.ttl = ttl
+        self.max_disk_bytes = max_disk_bytes
+
+        self._memory: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._disk_bytes = 0
+        self._stats = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'sets': 0,
+            'bypassed': 0,
+            'evictions': 0,
+            'expired': 0
+        }
+
+        if path:
+            self._init_disk()
+
+    @classmethod
+    def from_config(cls, config, instance_path: str) -> 'ResponseCache':
+        """根据Flask配置创建缓存"""
+        path = config.get('LLM_CACHE_PATH') or os.path.join(instance_path, 'llm_cache.db')
+        return cls(
+            path=path,
+            max_memory_entries=config.get('LLM_CACHE_MAX_ENTRIES', 512),
+            ttl=config.get('LLM_CACHE_TTL', 86400),
+            max_disk_bytes=int(config.get('LLM_CACHE_MAX_DISK_MB', 256) * 1024 * 1024)
+        )
+
+    def _init_disk(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS llm_cache ('
+            'cache_key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, '
+            'expires_at REAL NOT NULL, last_access REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_llm_cache_access ON llm_cache (last_access)')
+        self._conn.commit()
+        self._disk_bytes = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM llm_cache').fetchone()[0]
+
+    def get(self, key: str) -> Optional[Dict]:
+        """读取缓存，未命中或已过期返回 None"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    self._stats['memory_hits'] += 1
+                    return value
+                del self._memory[key]
+                self._stats['expired'] += 1
+
+            if self._conn is not None:
+                try:
+                    row = self._conn.execute(
+                        'SELECT value, expires_at FROM llm_cache WHERE cache_key = ?', (key,)
+                    ).fetchone()
+                    if row is not None:
+                        if row[1] > now:
+                            self._conn.execute(
+                                'UPDATE llm_cache SET last_access = ? WHERE cache_key = ?', (now, key)
+                            )
+                            self._conn.commit()
+                            value = json.loads(row[0])
+                            self._remember_locked(key, value, row[1])
+                            self._stats['disk_hits'] += 1
+                            return value
+                        self._delete_disk_locked(key)
+                        self._conn.commit()
+                        self._stats['expired'] += 1
+                except sqlite3.Error as e:
+                    print(f"读取响应缓存失败: {str(e)}")
+
+            self._stats['misses'] += 1
+            return None
+
+    def set(self, key: str, value: Dict, ttl: int = None):
+        """写入缓存"""
+        now = time.time()
+        expires_at = now + (ttl or self.ttl)
+        with self._lock:
+            self._remember_locked(key, value, expires_at)
+            self._stats['sets'] += 1
+
+            if self._conn is not None:
+                try:
+                    raw = json.dumps(value, ensure_ascii=False)
+                    size = len(raw.encode('utf-8'))
+                    self._delete_disk_locked(key)
+                    self._conn.execute(
+                        'INSERT INTO llm_cache (cache_key, value, size, expires_at, last_access) '
+                        'VALUES (?, ?, ?, ?, ?)',
+                        (key, raw, size, expires_at, now)
+                    )
+                    self._disk_bytes += size
+                    if self._disk_bytes > self.max_disk_bytes:
+                        self._evict_disk_locked(now)
+                    self._conn.commit()
+                except sqlite3.Error as e:
+                    print(f"写入响应缓存失败: {str(e)}")
+
+    def record_bypass(self):
+        with self._lock:
+            self._stats['bypassed'] += 1
+
+    def _remember_locked(self, key: str, value: Dict, expires_at: float):
+        self._memory[key] = (value, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def _delete_disk_locked(self, key: str):
+        """删除一个磁盘条目并扣减累计字节数"""
+        row = self._conn.execute('SELECT size FROM llm_cache WHERE cache_key = ?', (key,)).fetchone()
+        if row is not None:
+            self._conn.execute('DELETE FROM llm_cache WHERE cache_key = ?', (key,))
+            self._disk_bytes -= row[0]
+
+    def _evict_disk_locked(self, now: float):
+        """超出容量时删除过期条目，仍超出时按最久未访问顺序淘汰"""
+        expired = self._conn.execute('DELETE FROM llm_cache WHERE expires_at <= ?', (now,)).rowcount
+        self._stats['expired'] += max(expired, 0)
+
+        # 重新统计实际大小（其他进程也可能写入同一缓存文件）
+        total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM llm_cache').fetchone()[0]
+        if total > self.max_disk_bytes:
+            rows = self._conn.execute('SELECT cache_key, size FROM llm_cache ORDER BY last_access ASC').fetchall()
+            for cache_key, size in rows:
+                if total <= self.max_disk_bytes:
+                    break
+                self._conn.execute('DELETE FROM llm_cache WHERE cache_key = ?', (cache_key,))
+                self._memory.pop(cache_key, None)
+                total -= size
+                self._stats['evictions'] += 1
+        self._disk_bytes = total
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._memory.clear()
+            if self._conn is not None:
+                self._conn.execute('DELETE FROM llm_cache')
+                self._conn.commit()
+                self._disk_bytes = 0
+
+    def get_stats(self) -> Dict:
+        """获取命中率等统计信息"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['memory_entries'] = len(self._memory)
+            if self._conn is not None:
+                try:
+                    row = self._conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache').fetchone()
+                    stats['disk_entries'], stats['disk_bytes'] = row
+                except sqlite3.Error:
+                    pass
+        hits = stats['memory_hits'] + stats['disk_hits']
+        lookups = hits + stats['misses']
+        stats['hits'] = hits
+        stats['hit_rate'] = round(hits / lookups, 4) if lookups else 0.0
+        return stats
@@ -0,0 +1,296 @@
+import asyncio
+import hashlib
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+from .stats import percentile
+
+
+class QueueTimeoutError(Exception):
+    """排队等待API密钥并发名额超时"""
+
+    def __init__(self, waited: float):
+        self.waited = waited
+        super().__init__(f'请求排队超时（已等待{waited:.0f}秒），当前使用人数较多，请稍后重试')
+
+
+class _Ticket:
+    __slots__ = ('key', 'user_uuid', 'priority', 'start_tag', 'seq', 'enqueued_at', 'event', 'granted', 'on_grant')
+
+    def __init__(self, key: str, user_uuid: str, priority: str, start_tag: float, seq: int,
+                 on_grant: Callable = None):
+        self.key = key
+        self.user_uuid = user_uuid
+        self.priority = priority
+        self.start_tag = start_tag
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.event = threading.Event()
+        self.granted = False
+        self.on_grant = on_grant
+
+
+class _KeyState:
+    """单个API密钥的并发名额与等待队列"""
+
+    def __init__(self):
+        self.active = 0
+        self.waiters: List[_Ticket] = []
+        self.virtual_time = 0.0
+        self.finish_tags: Dict[str, float] = {}
+
+
+class FairScheduler:
+    """
+    按API密钥限制上游并发的公平调度器
+
+    同一密钥（如所有新用户共用的默认密钥）同时进行的请求数不超过 max_concurrency，
+    超出的请求排队。名额释放时按以下顺序分配：
+      1. 交互请求（interactive）优先于批量/后台请求（bulk），
+         bulk 请求等待超过 starvation_seconds 后按交互请求对待，避免饿死；
+      2. 同一优先级内按用户公平排队（起始时间公平排队 SFQ）：
+         每个用户的请求依次获得递增的虚拟起始时间，起始时间最小者先执行，
+         大量提交请求的用户不会挤占其他用户的名额。
+    """
+
+    PRIORITIES = ('interactive', 'bulk')
+
+    def __init__(self, max_concurrency: int = 8, queue_timeout: float = 120.0,
+                 starvation_seconds: float = 30.0, window_size: int = 1000):
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.starvation_seconds = starvation_seconds
+        self.window_size = window_size
+
+        self._lock = threading.Lock()
+        self._keys: Dict[str, _KeyState] = {}
+        self._seq = itertools.count()
+        self._waits = {priority: [] for priority in self.PRIORITIES}
+        self._stats = {'granted': 0, 'queued': 0, 'timeouts': 0, 'promoted': 0}
+
+    @classmethod
+    def from_config(cls, config) -> 'FairScheduler':
+        return cls(
+            max_concurrency=config.get('LLM_KEY_CONCURRENCY', 8),
+            queue_timeout=config.get('LLM_QUEUE_TIMEOUT', 120.0),
+            starvation_seconds=config.get('LLM_BULK_STARVATION_SECONDS', 30.0)
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_concurrency > 0
+
+    @staticmethod
+    def _key_id(api_key: str) -> str:
+        return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:12]
+
+    def acquire(self, api_key: str, user_uuid: str = None, priority: str = 'interactive') -> Optional[_Ticket]:
+        """
+        获取API密钥的一个并发名额，必要时排队等待
+
+        Returns:
+            名额凭证，需传给 release；未启用调度时返回 None
+
+        Raises:
+            QueueTimeoutError: 排队超过 queue_timeout
+        """
+        if not self.enabled:
+            return None
+
+        ticket = self._enqueue(api_key, user_uuid, priority)
+        if not ticket.granted and not ticket.event.wait(self.queue_timeout):
+            self._abandon(ticket, timed_out=True)
+
+        self._record_wait(ticket)
+        return ticket
+
+    async def acquire_async(self, api_key: str, user_uuid: str = None,
+                            priority: str = 'interactive') -> Optional[_Ticket]:
+        """
+        acquire 的协程版本：排队时等待名额分配时完成的 future，不占用线程
+
+        Raises:
+            QueueTimeoutError: 排队超过 queue_timeout
+        """
+        if not self.enabled:
+            return None
+
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def resolve():
+            if not granted.done():
+                granted.set_result(None)
+
+        ticket = self._enqueue(api_key, user_uuid, priority, on_grant=lambda: loop.call_soon_threadsafe(resolve))
+        if not ticket.granted:
+            try:
+                await asyncio.wait_for(granted, self.queue_timeout)
+            except asyncio.TimeoutError:
+                self._abandon(ticket, timed_out=True)
+            except asyncio.CancelledError:
+                # 协程被取消：仍在排队则退出队列，已分配的名额立即归还
+                if not self._abandon(ticket):
+                    self.release(ticket)
+                raise
+
+        self._record_wait(ticket)
+        return ticket
+
+    def _enqueue(self, api_key: str, user_uuid: str, priority: str, on_grant: Callable = None) -> _Ticket:
+        """创建名额凭证，有空闲名额时直接分配，否则加入等待队列"""
+        if priority not in self.PRIORITIES:
+            priority = 'interactive'
+
+        key = self._key_id(api_key)
+        user = user_uuid or 'anonymous'
+        with self._lock:
+            state = self._keys.setdefault(key, _KeyState())
+            start_tag = max(state.virtual_time, state.finish_tags.get(user, 0.0))
+            state.finish_tags[user] = start_tag + 1.0
+            ticket = _Ticket(key, user, priority, start_tag, next(self._seq), on_grant)
+
+            if state.active < self.max_concurrency and not state.waiters:
+                self._grant(state, ticket)
+            else:
+                state.waiters.append(ticket)
+                self._stats['queued'] += 1
+        return ticket
+
+    def _abandon(self, ticket: _Ticket, timed_out: bool = False) -> bool:
+        """
+        放弃排队；等待期间已获得名额时返回 False
+
+        Raises:
+            QueueTimeoutError: timed_out 且仍未获得名额
+        """
+        with self._lock:
+            if ticket.granted:
+                return False
+            self._keys[ticket.key].waiters.remove(ticket)
+            if timed_out:
+                self._stats['timeouts'] += 1
+                raise QueueTimeoutError(time.monotonic() - ticket.enqueued_at)
+        return True
+
+    def release(self, ticket: Optional[_Ticket]):
+        """释放名额并分配给下一个等待的请求"""
+        if ticket is None:
+            return
+        with self._lock:
+            state = self._keys[ticket.key]
+            state.active -= 1
+            self._dispatch(state)
+
+    def lease(self, api_key: str, user_uuid: str = None, priority: str = 'interactive') -> 'Lease':
+        """创建一次请求的名额租约（尚未获取名额）"""
+        return Lease(self, api_key, user_uuid, priority)
+
+    @contextmanager
+    def slot(self, api_key: str, user_uuid: str = None, priority: str = 'interactive'):
+        ticket = self.acquire(api_key, user_uuid, priority)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def _grant(self, state: _KeyState, ticket: _Ticket):
+        state.active += 1
+        state.virtual_time = max(state.virtual_time, ticket.start_tag)
+        ticket.granted = True
+        self._stats['granted'] += 1
+        ticket.event.set()
+        if ticket.on_grant is not None:
+            ticket.on_grant()
+
+    def _dispatch(self, state: _KeyState):
+        now = time.monotonic()
+        while state.active < self.max_concurrency and state.waiters:
+            def order(ticket: _Ticket):
+                starving = ticket.priority == 'bulk' and now - ticket.enqueued_at >= self.starvation_seconds
+                rank = 0 if ticket.priority == 'interactive' or starving else 1
+                return rank, ticket.start_tag, ticket.seq
+
+            ticket = min(state.waiters, key=order)
+            if ticket.priority == 'bulk' and order(ticket)[0] == 0:
+                self._stats['promoted'] += 1
+            state.waiters.remove(ticket)
+            self._grant(state, ticket)
+
+        if not state.waiters:
+            # 没有等待者时清理已落后于虚拟时间的用户记录
+            state.finish_tags = {
+                user: tag for user, tag in state.finish_tags.items() if tag > state.virtual_time
+            }
+
+    def _record_wait(self, ticket: _Ticket):
+        waited = (time.monotonic() - ticket.enqueued_at) * 1000
+        with self._lock:
+            waits = self._waits[ticket.priority]
+            waits.append(waited)
+            if len(waits) > self.window_size:
+                del waits[:len(waits) - self.window_size]
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            keys = {
+                key: {
+                    'active': state.active,
+                    'queued_interactive': sum(1 for t in state.waiters if t.priority == 'interactive'),
+                    'queued_bulk': sum(1 for t in state.waiters if t.priority == 'bulk'),
+                    'queued_users': len({t.user_uuid for t in state.waiters})
+                }
+                for key, state in self._keys.items()
+            }
+            waits = {priority: list(values) for priority, values in self._waits.items()}
+
+        def wait_ms(values: List[float], value: float):
+            result = percentile(values, value)
+            return round(result, 2) if result is not None else None
+
+        stats.update({
+            'enabled': self.enabled,
+            'max_concurrency_per_key': self.max_concurrency,
+            'queue_depth': sum(item['queued_interactive'] + item['queued_bulk'] for item in keys.values()),
+            'keys': keys,
+            'wait_ms': {
+                priority: {'p50': wait_ms(values, 50), 'p95': wait_ms(values, 95), 'max': wait_ms(values, 100)}
+                for priority, values in waits.items()
+            }
+        })
+        return stats
+
+
+class Lease:
+    """
+    一次上游请求占用的并发名额
+
+    重试退避期间先 release 归还名额供其他请求使用，再次发送前重新 acquire 排队；
+    重复 release 不会多归还名额。
+    """
+
+    def __init__(self, scheduler: FairScheduler, api_key: str, user_uuid: str = None,
+                 priority: str = 'interactive'):
+        self.scheduler = scheduler
+        self.api_key = api_key
+        self.user_uuid = user_uuid
+        self.priority = priority
+        self._ticket: Optional[_Ticket] = None
+
+    def acquire(self):
+        """
+        Raises:
+            QueueTimeoutError: 排队超过 queue_timeout
+        """
+        self._ticket = self.scheduler.acquire(self.api_key, self.user_uuid, self.priority)
+
+    async def acquire_async(self):
+        self._ticket = await self.scheduler.acquire_async(self.api_key, self.user_uuid, self.priority)
+
+    def release(self):
+        ticket, self._ticket = self._ticket, None
+        self.scheduler.release(ticket)
@@ -0,0 +1,389 @@
+import hashlib
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+import requests
+
+
+class SearchProviderError(Exception):
+    """搜索服务返回错误或响应格式无法解析"""
+
+
+class BraveSearchProvider:
+    """Brave Search API（或兼容接口）"""
+
+    name = 'brave'
+
+    def __init__(self, api_key: str, base_url: str = 'https://api.search.brave.com/res/v1/web/search',
+                 session: requests.Session = None):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.session = session or requests.Session()
+
+    def search(self, query: str, count: int, timeout: float) -> List[Dict]:
+        try:
+            response = self.session.get(
+                self.base_url,
+                params={'q': query, 'count': count},
+                headers={'Accept': 'application/json', 'X-Subscription-Token': self.api_key},
+                timeout=timeout
+            )
+            response.raise_for_status()
+            items = ((response.json().get('web') or {}).get('results')) or []
+        except (requests.exceptions.RequestException, ValueError) as e:
+            raise SearchProviderError(f'Brave搜索失败: {str(e)}')
+        return [
+            {'title': item.get('title', ''), 'url': item.get('url', ''), 'snippet': item.get('description', '')}
+            for item in items
+        ]
+
+
+class GoogleSearchProvider:
+    """Google Custom Search JSON API（或兼容接口）"""
+
+    name = 'google'
+
+    def __init__(self, api_key: str, cx: str, base_url: str = 'https://www.googleapis.com/customsearch/v1',
+                 session: requests.Session = None):
+        self.api_key = api_key
+        self.cx = cx
+        self.base_url = base_url
+        self.session = session or requests.Session()
+
+    def search(self, query: str, count: int, timeout: float) -> List[Dict]:
+        try:
+            response = self.session.get(
+                self.base_url,
+                # 接口单次最多返回10条
+                params={'key': self.api_key, 'cx': self.cx, 'q': query, 'num': min(count, 10)},
+                timeout=timeout
+            )
+            response.raise_for_status()
+            items = response.json().get('items') or []
+        except (requests.exceptions.RequestException, ValueError) as e:
+            raise SearchProviderError(f'Google搜索失败: {str(e)}')
+        return [
+            {'title': item.get('title', ''), 'url': item.get('link', ''), 'snippet': item.get('snippet', '')}
+            for item in items
+        ]
+
+
+class LocalSearchProvider:
+    """
+    本地搜索（不访问网络）
+
+    按查询生成确定的搜索结果，用于测试、压测和未配置搜索服务的离线环境；
+    latency 可模拟外部搜索服务的响应时间。
+    """
+
+    name = 'local'
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+
+    def search(self, query: str, count: int, timeout: float) -> List[Dict]:
+        if self.latency:
+            time.sleep(self.latency)
+        digest = hashlib.sha256(query.encode('utf-8')).hexdigest()[:12]
+        return [
+            {
+                'title': f'{query} 相关案例 {index}',
+                'url': f'local://search/{digest}/{index}',
+                'snippet': f'基于「{query}」的相关案例材料（第{index}条）'
+            }
+            for index in range(1, count + 1)
+        ]
+
+
+class SearchService:
+    """
+    搜索服务
+
+    同时向所有已配置的搜索服务发起查询，每个服务有独立的截止时间；第一个返回有效结果的服务
+    完成后只再等待很短的合并窗口，之后到达的结果不再等待，搜索步骤只增加最快服务的延迟。
+    各服务的结果按链接与摘要去重，按倒数排名融合（多个服务都返回的结果排名靠前）；
+    结果按规范化后的查询缓存 SEARCH_CACHE_TTL 秒。
+    """
+
+    # 倒数排名融合的平滑常数
+    RRF_K = 60
+
+    def __init__(self, providers: List = None, timeout: float = 5.0, merge_window: float = 0.2,
+                 max_results: int = 5, cache_ttl: float = 3600.0, cache_size: int = 256):
+        self.providers = list(providers or [])
+        self.timeout = timeout
+        self.merge_window = merge_window
+        self.max_results = max_results
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+        self._cache: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {'queries': 0, 'cache_hits': 0, 'empty': 0}
+        self._provider_stats: Dict[str, Dict] = {}
+
+    def init_app(self, app):
+        """按配置创建搜索服务（SEARCH_PROVIDERS 为空时不搜索）"""
+        config = app.config
+        self.timeout = config.get('SEARCH_TIMEOUT', self.timeout)
+        self.merge_window = config.get('SEARCH_MERGE_WINDOW', self.merge_window)
+        self.max_results = config.get('SEARCH_MAX_RESULTS', self.max_results)
+        self.cache_ttl = config.get('SEARCH_CACHE_TTL', self.cache_ttl)
+        self.cache_size = config.get('SEARCH_CACHE_SIZE', self.cache_size)
+
+        providers = []
+        names = [name.strip().lower() for name in (config.get('SEARCH_PROVIDERS') or '').split(',') if name.strip()]
+        for name in names:
+            if name == 'brave' and config.get('BRAVE_SEARCH_API_KEY'):
+                providers.append(BraveSearchProvider(
+                    config['BRAVE_SEARCH_API_KEY'],
+                    config.get('BRAVE_SEARCH_URL') or 'https://api.search.brave.com/res/v1/web/search'
+                ))
+            elif name == 'google' and config.get('GOOGLE_SEARCH_API_KEY') and config.get('GOOGLE_SEARCH_CX'):
+                providers.append(GoogleSearchProvider(
+                    config['GOOGLE_SEARCH_API_KEY'], config['GOOGLE_SEARCH_CX'],
+                    config.get('GOOGLE_SEARCH_URL') or 'https://www.googleapis.com/customsearch/v1'
+                ))
+            elif name == 'local':
+                providers.append(LocalSearchProvider(config.get('SEARCH_LOCAL_LATENCY', 0.0)))
+            else:
+                print(f"搜索服务 {name} 未配置API密钥或不受支持，已忽略")
+        self.set_providers(providers)
+
+    def set_providers(self, providers: List):
+        self.providers = list(providers)
+        with self._stats_lock:
+            for provider in self.providers:
+                self._provider_stats.setdefault(provider.name, {
+                    'calls': 0, 'completed': 0, 'errors': 0, 'timeouts': 0, 'first': 0, 'latency_ms_total': 0.0
+                })
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.providers)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='search')
+            return self._executor
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        """规范化查询：全角转半角、小写、合并空白"""
+        return ' '.join(unicodedata.normalize('NFKC', query or '').lower().split())
+
+    @staticmethod
+    def _normalize_url(url: str) -> str:
+        parts = urlsplit((url or '').strip())
+        host = parts.netloc.lower()
+        if host.startswith('www.'):
+            host = host[4:]
+        return f"{host}{parts.path.rstrip('/')}{'?' + parts.query if parts.query else ''}"
+
+    def search(self, query: str, count: int = None, providers: List[str] = None) -> Dict:
+        """
+        搜索并返回合并后的结果
+
+        Args:
+            query: 查询内容
+            count: 返回结果数，默认 SEARCH_MAX_RESULTS
+            providers: 只使用指定名称的搜索服务（未配置时使用全部服务）
+
+        Returns:
+            {'query', 'results': [{'title', 'url', 'snippet', 'providers'}], 'providers': 各服务状态,
+             'cached', 'elapsed_ms'}
+        """
+        started = time.monotonic()
+        count = count or self.max_results
+        normalized = self.normalize_query(query)
+        selected = [provider for provider in self.providers if not providers or provider.name in providers]
+        selected = selected or self.providers
+
+        with self._stats_lock:
+            self._stats['queries'] += 1
+
+        cache_key = f"{count}:{','.join(sorted(provider.name for provider in selected))}:{normalized}"
+        cached = self._get_cached(cache_key)
+        if cached is not None:
+            with self._stats_lock:
+                self._stats['cache_hits'] += 1
+            return {**cached, 'cached': True, 'elapsed_ms': round((time.monotonic() - started) * 1000, 2)}
+
+        responses, statuses = self._query_providers(selected, normalized, count)
+        results = self._merge(responses, count)
+
+        response = {'query': normalized, 'results': results, 'providers': statuses}
+        if results:
+            self._set_cached(cache_key, response)
+        else:
+            with self._stats_lock:
+                self._stats['empty'] += 1
+        return {**response, 'cached': False, 'elapsed_ms': round((time.monotonic() - started) * 1000, 2)}
+
+    def _query_providers(self, providers: List, query: str, count: int):
+        """并发查询，第一个有效结果到达后只再等待合并窗口"""
+        if not providers or not query:
+            return {}, {}
+
+        executor = self._get_executor()
+        started = time.monotonic()
+        futures = {
+            executor.submit(self._call_provider, provider, query, count): provider.name
+            for provider in providers
+        }
+        deadline = started + self.timeout
+        responses: Dict[str, List[Dict]] = {}
+        statuses: Dict[str, Dict] = {}
+        pending = set(futures)
+
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = futures[future]
+                items, latency, error = future.result()
+                statuses[name] = {'status': 'error' if error else 'ok', 'latency_ms': round(latency * 1000, 2),
+                                  'count': len(items)}
+                if error:
+                    statuses[name]['error'] = error
+                elif items:
+                    if not responses:
+                        self._bump_provider(name, 'first')
+                        # 最快的有效结果已到达，其余服务只再等待合并窗口
+                        deadline = min(deadline, time.monotonic() + self.merge_window)
+                    responses[name] = items
+
+        for future in pending:
+            name = futures[future]
+            statuses[name] = {'status': 'timeout', 'latency_ms': round((time.monotonic() - started) * 1000, 2),
+                              'count': 0}
+            self._bump_provider(name, 'timeouts')
+        return responses, statuses
+
+    def _call_provider(self, provider, query: str, count: int):
+        started = time.monotonic()
+        self._bump_provider(provider.name, 'calls')
+        try:
+            items = provider.search(query, count, self.timeout)
+            error = None
+        except Exception as e:
+            items, error = [], str(e)
+            self._bump_provider(provider.name, 'errors')
+        latency = time.monotonic() - started
+        self._bump_provider(provider.name, 'completed')
+        self._bump_provider(provider.name, 'latency_ms_total', latency * 1000)
+        return [item for item in items if item.get('snippet') or item.get('title')], latency, error
+
+    def _merge(self, responses: Dict[str, List[Dict]], count: int) -> List[Dict]:
+        """按链接与摘要去重，倒数排名融合排序"""
+        merged: Dict[str, Dict] = {}
+        for name, items in responses.items():
+            for rank, item in enumerate(items, start=1):
+                snippet = ' '.join((item.get('snippet') or '').split())
+                key = self._normalize_url(item.get('url')) or snippet
+                if not key:
+                    continue
+                existing = merged.get(key)
+                if existing is None:
+                    # 不同链接但摘要相同（转载）也视为重复
+                    existing = next(
+                        (entry for entry in merged.values() if snippet and entry['snippet'] == snippet), None
+                    )
+                if existing is None:
+                    existing = merged[key] = {
+                        'title': item.get('title', ''),
+                        'url': item.get('url', ''),
+                        'snippet': snippet,
+                        'providers': [],
+                        'score': 0.0
+                    }
+                if name not in existing['providers']:
+                    existing['providers'].append(name)
+                    existing['score'] += 1.0 / (self.RRF_K + rank)
+                if len(snippet) > len(existing['snippet']):
+                    existing['snippet'] = snippet
+
+        ranked = sorted(merged.values(), key=lambda entry: entry['score'], reverse=True)[:count]
+        for entry in ranked:
+            entry['score'] = round(entry['score'], 6)
+        return ranked
+
+    @staticmethod
+    def format_context(results: List[Dict]) -> str:
+        """将搜索结果整理为提示词中的搜索材料"""
+        blocks = []
+        for index, item in enumerate(results, start=1):
+            lines = [f"{index}. {item.get('title') or '搜索结果'}"]
+            if item.get('snippet'):
+                lines.append(item['snippet'])
+            if item.get('url'):
+                lines.append(f"来源: {item['url']}")
+            blocks.append('\n'.join(lines))
+        return '\n\n'.join(blocks)
+
+    def _get_cached(self, key: str) -> Optional[Dict]:
+        if self.cache_ttl <= 0:
+            return None
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            expires_at, response = entry
+            if expires_at <= time.monotonic():
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return response
+
+    def _set_cached(self, key: str, response: Dict):
+        if self.cache_ttl <= 0:
+            return
+        with self._cache_lock:
+            self._cache[key] = (time.monotonic() + self.cache_ttl, response)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _bump_provider(self, name: str, field: str, amount: float = 1):
+        with self._stats_lock:
+            stats = self._provider_stats.setdefault(name, {
+                'calls': 0, 'completed': 0, 'errors': 0, 'timeouts': 0, 'first': 0, 'latency_ms_total': 0.0
+            })
+            stats[field] += amount
+
+    def get_stats(self) -> Dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+            providers = {}
+            for name, item in self._provider_stats.items():
+                completed = item['completed']
+                providers[name] = {
+                    'calls': item['calls'],
+                    'errors': item['errors'],
+                    'timeouts': item['timeouts'],
+                    'first': item['first'],
+                    'mean_latency_ms': round(item['latency_ms_total'] / completed, 2) if completed > 0 else None
+                }
+        with self._cache_lock:
+            stats['cache_entries'] = len(self._cache)
+        stats.update({
+            'enabled': self.enabled,
+            'providers': providers,
+            'timeout': self.timeout,
+            'merge_window': self.merge_window
+        })
+        return stats
+
+
+search_service = SearchService()
@@ -0,0 +1,247 @@
+import random
+import re
+import threading
+import time
+import unicodedata
+import zlib
+from typing import Dict, FrozenSet, List, Optional
+
+# 归一化时去掉空白与标点，只比较文字本身
+_NON_WORD = re.compile(r'[\W_]+')
+
+_MERSENNE_PRIME = (1 << 61) - 1
+
+
+def shingles(text: str, size: int = 2) -> FrozenSet[str]:
+    """将文本归一化后切分为字符 n-gram 集合（不足 n 个字符时取整段文本）"""
+    text = _NON_WORD.sub('', unicodedata.normalize('NFKC', text or '').lower())
+    if len(text) <= size:
+        return frozenset([text]) if text else frozenset()
+    return frozenset(text[index:index + size] for index in range(len(text) - size + 1))
+
+
+def jaccard(left: FrozenSet[str], right: FrozenSet[str]) -> float:
+    if not left and not right:
+        return 1.0
+    if not left or not right:
+        return 0.0
+    return len(left & right) / len(left | right)
+
+
+class SimilarInputCache:
+    """
+    近似工作流输入查找
+
+    以已生成案例的输入字段（知识点、场景、考核目标）为索引，新请求与某个已有案例的输入近似时
+    （例如知识点与场景相同、仅考核目标措辞不同）提示或直接复用该案例，节省一次完整生成。
+    与按提示词精确匹配的响应缓存不同，这里比较的是工作流输入：
+    知识点与场景的字符二元组经 MinHash/LSH 找出候选案例，再按各字段的 Jaccard 相似度加权打分。
+    难度不同的案例不会匹配，只匹配公开案例和本人创建的案例。
+    """
+
+    # 工作流输入字段 -> (案例字段, 相似度权重)
+    FIELD_WEIGHTS = {
+        'knowledgePoints': ('knowledge_points', 0.4),
+        'caseScenario': ('case_scenario', 0.4),
+        'learningObjectives': ('learning_objectives', 0.2)
+    }
+
+    # 参与 LSH 分桶的字段
+    KEY_FIELDS = ('knowledgePoints', 'caseScenario')
+
+    POLICIES = ('off', 'suggest', 'reuse')
+
+    # 变化时需要重新索引的案例字段
+    INDEXED_FIELDS = ('title', 'knowledge_points', 'case_scenario', 'learning_objectives',
+                      'difficulty_level', 'creator_uuid', 'is_public')
+
+    def __init__(self, threshold: float = 0.85, policy: str = 'suggest',
+                 num_perm: int = 32, bands: int = 16, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError('num_perm 必须是 bands 的整数倍')
+        self.threshold = threshold
+        self.policy = policy
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = random.Random(seed)
+        self._permutations = [(rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+                              for _ in range(num_perm)]
+
+        self._lock = threading.RLock()
+        self._docs: Dict[int, Dict] = {}
+        self._buckets: Dict[tuple, set] = {}
+        self._stats = {'lookups': 0, 'hits': 0, 'reused': 0, 'estimated_tokens_saved': 0,
+                       'candidates': 0, 'lookup_ms_total': 0.0, 'last_sync_ms': None}
+
+    def init_app(self, app, db):
+        """从案例库建立索引，并订阅案例变更"""
+        from .case_events import case_changes
+
+        self.threshold = app.config.get('SIMILAR_INPUT_THRESHOLD', self.threshold)
+        policy = (app.config.get('SIMILAR_INPUT_POLICY') or self.policy).strip().lower()
+        self.policy = policy if policy in self.POLICIES else 'suggest'
+        if self.policy == 'off':
+            return
+
+        case_changes.subscribe('近似输入索引', self.INDEXED_FIELDS, self._case_fields, self.upsert, self.remove)
+
+        with app.app_context():
+            try:
+                self.sync()
+            except Exception as e:
+                print(f"建立近似输入索引失败: {str(e)}")
+
+    def resolve_policy(self, requested: Optional[str]) -> str:
+        """请求中的 similarCase 优先，取值无效时使用配置的默认策略（配置为 off 时始终不查找）"""
+        if self.policy == 'off':
+            return 'off'
+        requested = (requested or '').strip().lower()
+        if requested in self.POLICIES:
+            return requested
+        return self.policy
+
+    def _signature(self, key_shingles: FrozenSet[str]) -> List[int]:
+        hashes = [zlib.crc32(item.encode('utf-8')) for item in key_shingles]
+        return [min((a * value + b) % _MERSENNE_PRIME for value in hashes) for a, b in self._permutations]
+
+    def _band_keys(self, field_shingles: Dict[str, FrozenSet[str]]) -> List[tuple]:
+        key_shingles = frozenset(
+            f'{field}:{item}' for field in self.KEY_FIELDS for item in field_shingles[field]
+        )
+        if not key_shingles:
+            return []
+        signature = self._signature(key_shingles)
+        return [(band, tuple(signature[band * self.rows:(band + 1) * self.rows]))
+                for band in range(self.bands)]
+
+    def _input_shingles(self, values: Dict[str, str]) -> Dict[str, FrozenSet[str]]:
+        return {field: shingles(values.get(field)) for field in self.FIELD_WEIGHTS}
+
+    @staticmethod
+    def _normalize_difficulty(value) -> str:
+        return (value or '').strip()
+
+    def upsert(self, case_id: int, fields: Dict):
+        """索引（或重新索引）一个案例的输入字段"""
+        values = {name: fields.get(column) for name, (column, _) in self.FIELD_WEIGHTS.items()}
+        field_shingles = self._input_shingles(values)
+        doc = {
+            'title': fields.get('title') or '',
+            'knowledge_points': fields.get('knowledge_points') or '',
+            'case_scenario': fields.get('case_scenario') or '',
+            'difficulty_level': self._normalize_difficulty(fields.get('difficulty_level')),
+            'creator_uuid': fields.get('creator_uuid'),
+            'is_public': bool(fields.get('is_public')),
+            'shingles': field_shingles,
+            'bands': self._band_keys(field_shingles)
+        }
+        with self._lock:
+            self._remove_locked(case_id)
+            if not doc['bands']:
+                return
+            self._docs[case_id] = doc
+            for key in doc['bands']:
+                self._buckets.setdefault(key, set()).add(case_id)
+
+    def remove(self, case_id: int):
+        with self._lock:
+            self._remove_locked(case_id)
+
+    def _remove_locked(self, case_id: int):
+        doc = self._docs.pop(case_id, None)
+        if doc is None:
+            return
+        for key in doc['bands']:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(case_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    def sync(self):
+        """从数据库重新建立索引（只读取输入字段，不加载案例正文）"""
+        from ..models import Case
+        from .. import db
+
+        started = time.perf_counter()
+        columns = ('id',) + self.INDEXED_FIELDS
+        rows = db.session.query(*(getattr(Case, column) for column in columns)).all()
+        with self._lock:
+            self._docs = {}
+            self._buckets = {}
+        for row in rows:
+            fields = dict(zip(columns, row))
+            self.upsert(fields['id'], fields)
+        with self._lock:
+            self._stats['last_sync_ms'] = round((time.perf_counter() - started) * 1000, 2)
+
+    def lookup(self, workflow_input: Dict, user_uuid: str = None, limit: int = 1) -> List[Dict]:
+        """
+        查找与工作流输入近似的已有案例
+
+        Returns:
+            按相似度从高到低的匹配 [{'case_id', 'score', 'title', 'knowledge_points',
+            'case_scenario', 'difficulty_level'}]，相似度低于阈值的案例不返回
+        """
+        started = time.perf_counter()
+        field_shingles = self._input_shingles(workflow_input)
+        difficulty = self._normalize_difficulty(workflow_input.get('difficultyLevel'))
+        band_keys = self._band_keys(field_shingles)
+        matches = []
+        with self._lock:
+            candidates = set()
+            for key in band_keys:
+                candidates.update(self._buckets.get(key, ()))
+            for case_id in candidates:
+                doc = self._docs[case_id]
+                if doc['difficulty_level'] != difficulty:
+                    continue
+                if not (doc['is_public'] or (user_uuid and doc['creator_uuid'] == user_uuid)):
+                    continue
+                score = sum(
+                    weight * jaccard(field_shingles[field], doc['shingles'][field])
+                    for field, (_, weight) in self.FIELD_WEIGHTS.items()
+                )
+                if score >= self.threshold:
+                    matches.append({
+                        'case_id': case_id,
+                        'score': round(score, 4),
+                        'title': doc['title'],
+                        'knowledge_points': doc['knowledge_points'],
+                        'case_scenario': doc['case_scenario'],
+                        'difficulty_level': doc['difficulty_level'] or None
+                    })
+            matches.sort(key=lambda item: (item['score'], item['case_id']), reverse=True)
+            self._stats['lookups'] += 1
+            self._stats['candidates'] += len(candidates)
+            if matches:
+                self._stats['hits'] += 1
+            self._stats['lookup_ms_total'] += (time.perf_counter() - started) * 1000
+        return matches[:limit]
+
+    def record_reuse(self, tokens_saved: int):
+        """记录一次直接复用（tokens_saved 为按复用内容估算的节省量）"""
+        with self._lock:
+            self._stats['reused'] += 1
+            self._stats['estimated_tokens_saved'] += tokens_saved
+
+    def _case_fields(self, case) -> Dict:
+        return {field: getattr(case, field) for field in self.INDEXED_FIELDS}
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['indexed_cases'] = len(self._docs)
+            stats['buckets'] = len(self._buckets)
+        lookup_ms = stats.pop('lookup_ms_total')
+        candidates = stats.pop('candidates')
+        lookups = stats['lookups']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else None
+        stats['mean_candidates'] = round(candidates / lookups, 2) if lookups else None
+        stats['mean_lookup_ms'] = round(lookup_ms / lookups, 3) if lookups else None
+        stats['policy'] = self.policy
+        stats['threshold'] = self.threshold
+        return stats
+
+
+similar_input_cache = SimilarInputCache()
@@ -0,0 +1,157 @@
+import threading
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+
+class _Flight:
+    """
+    一次进行中的上游请求，按顺序缓存产出的事件，供所有等待者读取
+
+    不单独开线程：需要下一个事件而没有调用方在推进请求时，由该调用方在自己的线程中推进一步
+    （通常是发起请求的调用方）；推进的调用方离开后，其他等待者接手继续推进。
+    """
+
+    def __init__(self, producer: Callable[[], Iterator[Dict]]):
+        self.producer = producer
+        self.iterator: Optional[Iterator[Dict]] = None
+        self.events = []
+        self.done = False
+        self.cancelled = False
+        self.driving = False
+        self.waiters = 0
+        self.condition = threading.Condition()
+
+
+class SingleFlight:
+    """
+    相同请求合并（single-flight）
+
+    同一键的请求在进行中时，后到的调用不再发起上游请求，而是等待并共享第一个请求的结果。
+    上游请求在调用方线程中执行，单个调用方取消等待不会影响其他调用方；所有调用方都离开后请求随之取消。
+    """
+
+    def __init__(self, enabled: bool = True, wait_timeout: Optional[float] = None):
+        self.enabled = enabled
+        self.wait_timeout = wait_timeout
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+        self._stats = {'leaders': 0, 'followers': 0, 'cancelled': 0, 'errors': 0}
+
+    @classmethod
+    def from_config(cls, config) -> 'SingleFlight':
+        return cls(
+            enabled=config.get('LLM_COALESCE_ENABLED', True),
+            wait_timeout=config.get('LLM_COALESCE_WAIT_TIMEOUT') or None
+        )
+
+    def join(self, key: str, producer: Callable[[], Iterator[Dict]]) -> Tuple[Iterator[Dict], bool]:
+        """
+        加入或发起一次请求
+
+        Args:
+            key: 请求键（规范化后的模型、消息和参数）
+            producer: 发起上游请求并逐个产出事件的函数，每个请求只执行一次
+
+        Returns:
+            (事件迭代器, 是否为发起请求的调用方)
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.waiters += 1
+                self._stats['followers'] += 1
+                return self._subscribe(key, flight), False
+
+            flight = _Flight(producer)
+            flight.waiters = 1
+            self._flights[key] = flight
+            self._stats['leaders'] += 1
+
+        return self._subscribe(key, flight), True
+
+    def record_follower(self):
+        """记录一次在本类之外合并的等待（如异步客户端等待进行中的相同异步请求）"""
+        with self._lock:
+            self._stats['followers'] += 1
+
+    def _subscribe(self, key: str, flight: _Flight) -> Iterator[Dict]:
+        """
+        从头读取事件直到请求结束；每个等待者得到事件的独立副本
+
+        等待者停止迭代（或等待超时）不会影响请求本身和其他等待者；所有等待者都提前离开时取消尚未完成的请求。
+        """
+        index = 0
+        completed = False
+        try:
+            while True:
+                with flight.condition:
+                    ready = lambda: index < len(flight.events) or flight.done or not flight.driving
+                    if not flight.condition.wait_for(ready, self.wait_timeout):
+                        raise TimeoutError('等待合并请求结果超时')
+                    pending = flight.events[index:]
+                    finished = flight.done
+                    drive = not pending and not finished
+                    if drive:
+                        flight.driving = True
+                if drive:
+                    self._advance(key, flight)
+                    continue
+                for event in pending:
+                    yield dict(event)
+                index += len(pending)
+                if finished and index >= len(flight.events):
+                    completed = True
+                    return
+        finally:
+            if not completed:
+                self._leave(key, flight)
+
+    def _advance(self, key: str, flight: _Flight):
+        """在当前线程中推进请求，产出一个事件或结束请求"""
+        event = None
+        finished = False
+        try:
+            if flight.iterator is None:
+                flight.iterator = iter(flight.producer())
+            event = next(flight.iterator)
+        except StopIteration:
+            finished = True
+        except Exception as e:
+            with self._lock:
+                self._stats['errors'] += 1
+            event = {'type': 'error', 'success': False, 'error': f'API调用异常: {str(e)}'}
+            finished = True
+
+        if finished:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+        with flight.condition:
+            if event is not None:
+                flight.events.append(event)
+            flight.done = flight.done or finished
+            flight.driving = False
+            flight.condition.notify_all()
+
+    def _leave(self, key: str, flight: _Flight):
+        """等待者提前离开；最后一个等待者离开时取消请求并关闭上游生成器以释放连接"""
+        with self._lock:
+            flight.waiters -= 1
+            if flight.waiters > 0 or flight.done:
+                return
+            flight.cancelled = True
+            self._stats['cancelled'] += 1
+            if self._flights.get(key) is flight:
+                # 之后的相同请求重新发起，不再等待已取消的请求
+                del self._flights[key]
+        close = getattr(flight.iterator, 'close', None)
+        if close is not None:
+            close()
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._flights)
+        stats['enabled'] = self.enabled
+        calls = stats['leaders'] + stats['followers']
+        stats['coalescing_rate'] = round(stats['followers'] / calls, 4) if calls else 0.0
+        return stats
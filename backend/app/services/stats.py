@@ -0,0 +1,9 @@
+from typing import Iterable, Optional
+
+
+def percentile(values: Iterable[float], value: float) -> Optional[float]:
+    """按最近秩计算百分位数（value 取 0-100），没有样本时返回 None"""
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(int(round(value / 100 * (len(values) - 1))), len(values) - 1)]
@@ -0,0 +1,203 @@
+import math
+import re
+import threading
+from typing import Callable, Dict, List, Optional
+
+
+# 中日韩文字、全角符号：大多数分词器中约1个字符对应1个token
+_CJK_RE = re.compile(r'[\u2e80-\u9fff\uf900-\ufaff\uff00-\uffef]')
+
+# 每条消息的格式开销（角色标记、分隔符）以及回复前缀
+_MESSAGE_OVERHEAD = 4
+_REPLY_PRIMING = 3
+
+
+class PromptTooLargeError(Exception):
+    """提示词超出模型上下文窗口"""
+
+    def __init__(self, model_name: str, prompt_tokens: int, context_window: int):
+        self.model_name = model_name
+        self.prompt_tokens = prompt_tokens
+        self.context_window = context_window
+        super().__init__(
+            f'输入内容过长：预计 {prompt_tokens} tokens，超出模型 {model_name} '
+            f'的上下文窗口 {context_window} tokens，请精简参考材料后重试'
+        )
+
+
+class TokenBudget:
+    """
+    本地token估算与提示词预算
+
+    不依赖网络估算提示词token数，按模型上下文窗口计算剩余输出预算，
+    在调用前拒绝或裁剪超长输入；记录估算值与实际值用于校准。
+    安装 tiktoken 时 OpenAI 模型使用精确分词，否则按字符类别估算。
+    """
+
+    # 模型上下文窗口（tokens）
+    CONTEXT_WINDOWS = {
+        'gpt-4o': 128000,
+        'gpt-4o-mini': 128000,
+        'claude-3-opus': 200000,
+        'claude-3-sonnet': 200000,
+        'claude-3-haiku': 200000,
+        'default': 16384
+    }
+
+    TRIM_MARKER = '\n……（参考材料过长，以下内容已省略）'
+
+    def __init__(self, max_output_tokens: int = 2000, min_output_tokens: int = 512,
+                 safety_margin: int = 256, overflow_policy: str = 'trim',
+                 context_length_lookup: Callable[[str], Optional[int]] = None):
+        self.max_output_tokens = max_output_tokens
+        self.min_output_tokens = min_output_tokens
+        self.safety_margin = safety_margin
+        self.overflow_policy = overflow_policy if overflow_policy in ('trim', 'reject') else 'trim'
+        # 模型目录提供的上下文长度，缺失时使用内置值
+        self.context_length_lookup = context_length_lookup
+
+        self._encoding = None
+        self._encoding_loaded = False
+        self._lock = threading.Lock()
+        self._calibration: Dict[str, Dict] = {}
+        self._stats = {'planned': 0, 'trimmed': 0, 'rejected': 0}
+
+    @classmethod
+    def from_config(cls, config, context_length_lookup: Callable[[str], Optional[int]] = None) -> 'TokenBudget':
+        return cls(
+            max_output_tokens=config.get('LLM_MAX_OUTPUT_TOKENS', 2000),
+            min_output_tokens=config.get('LLM_MIN_OUTPUT_TOKENS', 512),
+            safety_margin=config.get('LLM_CONTEXT_SAFETY_MARGIN', 256),
+            overflow_policy=config.get('PROMPT_OVERFLOW_POLICY', 'trim'),
+            context_length_lookup=context_length_lookup
+        )
+
+    @staticmethod
+    def _base_model(model_name: str) -> str:
+        """去掉供应商前缀，如 openai/gpt-4o -> gpt-4o"""
+        return (model_name or '').split('/')[-1]
+
+    def get_context_window(self, model_name: str) -> int:
+        if self.context_length_lookup is not None:
+            context_length = self.context_length_lookup(model_name)
+            if context_length:
+                return int(context_length)
+        return self.CONTEXT_WINDOWS.get(self._base_model(model_name), self.CONTEXT_WINDOWS['default'])
+
+    def _get_encoding(self):
+        if not self._encoding_loaded:
+            try:
+                import tiktoken
+                self._encoding = tiktoken.get_encoding('o200k_base')
+            except Exception:
+                self._encoding = None
+            self._encoding_loaded = True
+        return self._encoding
+
+    def estimate_text(self, text: str, model_name: str = None) -> int:
+        """估算一段文本的token数"""
+        if not text:
+            return 0
+
+        if self._base_model(model_name).startswith('gpt-'):
+            encoding = self._get_encoding()
+            if encoding is not None:
+                return len(encoding.encode(text, disallowed_special=()))
+
+        other_count = len(_CJK_RE.sub('', text))
+        cjk_count = len(text) - other_count
+        # 英文及符号平均约4个字符一个token
+        return cjk_count + math.ceil(other_count / 4)
+
+    def estimate_messages(self, messages: List[Dict], model_name: str = None) -> int:
+        """估算一组聊天消息的提示词token数"""
+        total = _REPLY_PRIMING
+        for message in messages:
+            total += _MESSAGE_OVERHEAD + self.estimate_text(message.get('content', ''), model_name)
+        return total
+
+    def available_prompt_tokens(self, model_name: str) -> int:
+        """在保留最小输出预算后，提示词最多可用的token数"""
+        return self.get_context_window(model_name) - self.min_output_tokens - self.safety_margin
+
+    def plan(self, messages: List[Dict], model_name: str, max_output_tokens: int = None) -> Dict:
+        """
+        计算一次调用的token预算
+
+        Returns:
+            {'estimated_prompt_tokens', 'context_window', 'max_tokens'}
+
+        Raises:
+            PromptTooLargeError: 剩余输出预算不足 min_output_tokens
+        """
+        prompt_tokens = self.estimate_messages(messages, model_name)
+        context_window = self.get_context_window(model_name)
+        remaining = context_window - prompt_tokens - self.safety_margin
+
+        if remaining < self.min_output_tokens:
+            with self._lock:
+                self._stats['rejected'] += 1
+            raise PromptTooLargeError(model_name, prompt_tokens, context_window)
+
+        with self._lock:
+            self._stats['planned'] += 1
+
+        return {
+            'estimated_prompt_tokens': prompt_tokens,
+            'context_window': context_window,
+            'max_tokens': min(max_output_tokens or self.max_output_tokens, remaining)
+        }
+
+    def trim_text(self, text: str, max_tokens: int, model_name: str = None) -> str:
+        """
+        将文本裁剪到不超过 max_tokens，保留开头部分并追加省略标记
+
+        Returns:
+            原文本（未超出时）或裁剪后的文本
+        """
+        if max_tokens <= 0:
+            return ''
+        if self.estimate_text(text, model_name) <= max_tokens:
+            return text
+
+        budget = max_tokens - self.estimate_text(self.TRIM_MARKER, model_name)
+        # 二分查找可保留的最长前缀（每个字符至少计1/4个token，据此缩小查找范围）
+        low, high = 0, min(len(text), max(budget, 0) * 4 + 4)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.estimate_text(text[:middle], model_name) <= budget:
+                low = middle
+            else:
+                high = middle - 1
+
+        with self._lock:
+            self._stats['trimmed'] += 1
+        return text[:low] + self.TRIM_MARKER
+
+    def record_actual(self, model_name: str, estimated_prompt_tokens: Optional[int], actual_prompt_tokens: int):
+        """记录估算值与接口返回的实际提示词token数"""
+        if not estimated_prompt_tokens or not actual_prompt_tokens:
+            return
+        with self._lock:
+            entry = self._calibration.setdefault(
+                self._base_model(model_name), {'samples': 0, 'estimated': 0, 'actual': 0}
+            )
+            entry['samples'] += 1
+            entry['estimated'] += estimated_prompt_tokens
+            entry['actual'] += actual_prompt_tokens
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            calibration = {
+                model: {
+                    'samples': entry['samples'],
+                    # 实际值/估算值，大于1表示估算偏低
+                    'actual_to_estimated': round(entry['actual'] / entry['estimated'], 4)
+                }
+                for model, entry in self._calibration.items() if entry['estimated']
+            }
+        stats['overflow_policy'] = self.overflow_policy
+        stats['tokenizer'] = 'tiktoken' if self._encoding is not None else 'heuristic'
+        stats['calibration'] = calibration
+        return stats
@@ -0,0 +1,417 @@
+import atexit
+import contextvars
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
+
+# 当前线程（或请求上下文）中正在执行的 span
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+_TRACEPARENT = re.compile(r'^[0-9a-f]{2}-([0-9a-f]{32})-[0-9a-f]{16}-[0-9a-f]{2}$')
+
+
+class Span:
+    """一次计时的操作，attributes 记录模型、token用量、重试次数等信息"""
+
+    def __init__(self, tracer, name: str, trace_id: str, parent: Optional['Span'], attributes: Dict):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent = parent
+        self.attributes = attributes
+        self.start_time = time.time()
+        self.status = 'ok'
+        self.error = None
+        self.duration = None
+        self._started = time.perf_counter()
+
+    @property
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self._started) * 1000
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, key: str, value=1):
+        """累加计数类属性（如 token 用量、重试次数）"""
+        self.attributes[key] = self.attributes.get(key, 0) + value
+
+    def fail(self, error):
+        self.status = 'error'
+        self.error = str(error)[:500] if error else None
+
+    def end(self, duration: float = None):
+        """结束计时（重复调用无效），duration 为外部测得的耗时（秒）"""
+        if self.duration is not None:
+            return
+        self.duration = duration if duration is not None else time.perf_counter() - self._started
+        self.tracer._finish(self)
+
+    def to_dict(self) -> Dict:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent.span_id if self.parent else None,
+            'name': self.name,
+            'start': self.start_time,
+            'duration_ms': round(self.duration * 1000, 3) if self.duration is not None else None,
+            'status': self.status,
+            'error': self.error,
+            'attributes': self.attributes
+        }
+
+
+class MetricsRegistry:
+    """聚合计数器与直方图，按 Prometheus 文本格式输出"""
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # 指标名 -> {'type', 'help', 'series': {标签元组: 值}}
+        self._families: Dict[str, Dict] = {}
+
+    def _series(self, name: str, kind: str, help_text: str, labels: Dict) -> Tuple[Dict, tuple]:
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = {'type': kind, 'help': help_text, 'series': {}}
+        return family['series'], tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name: str, labels: Dict, value: float = 1, help_text: str = ''):
+        with self._lock:
+            series, key = self._series(name, 'counter', help_text, labels)
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, labels: Dict, value: float, help_text: str = ''):
+        with self._lock:
+            series, key = self._series(name, 'histogram', help_text, labels)
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @staticmethod
+    def _format_labels(labels: tuple, extra: Tuple[str, str] = None) -> str:
+        pairs = list(labels) + ([extra] if extra else [])
+        if not pairs:
+            return ''
+        escaped = (
+            '{}="{}"'.format(key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for key, value in pairs
+        )
+        return '{' + ','.join(escaped) + '}'
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name in sorted(self._families):
+                family = self._families[name]
+                if family['help']:
+                    lines.append(f"# HELP {name} {family['help']}")
+                lines.append(f"# TYPE {name} {family['type']}")
+                for labels, value in sorted(family['series'].items()):
+                    if family['type'] == 'counter':
+                        lines.append(f'{name}{self._format_labels(labels)} {value:g}')
+                        continue
+                    for bound, count in zip(self.buckets, value['buckets']):
+                        lines.append(f'{name}_bucket{self._format_labels(labels, ("le", f"{bound:g}"))} {count}')
+                    lines.append(f'{name}_bucket{self._format_labels(labels, ("le", "+Inf"))} {value["count"]}')
+                    lines.append(f'{name}_sum{self._format_labels(labels)} {value["sum"]:.6f}')
+                    lines.append(f'{name}_count{self._format_labels(labels)} {value["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+class Tracer:
+    """
+    轻量级请求追踪
+
+    每个HTTP请求、后台任务与工作流步骤记录为一个 span，模型调用、提示词构建、数据库提交与
+    用量记录作为其子 span。结束的 span 按名称聚合为耗时直方图与 token/重试/缓存命中计数
+    （通过 /metrics 输出），配置导出路径时逐行写入 JSONL 文件供离线分析。
+    """
+
+    METRIC_PREFIX = 'case_creator'
+
+    # span 名称 -> 作为指标标签的属性（控制标签基数）
+    METRIC_LABELS = {
+        'http.request': ('method', 'route', 'code'),
+        'job.run': ('kind',),
+        'workflow.run': ('engine',),
+        'workflow.step': ('step',),
+        'llm.chat': ('model',),
+        'prompt.build': ('template',),
+    }
+
+    # 计数类属性 -> 指标后缀
+    COUNTED_ATTRIBUTES = {
+        'tokens': 'tokens_total',
+        'retries': 'retries_total',
+        'cache_hits': 'cache_hits_total'
+    }
+
+    # 子 span 结束时累加到父 span 的属性
+    ROLLUP_ATTRIBUTES = ('retries', 'cache_hits', 'llm_calls')
+
+    def __init__(self, enabled: bool = True, export_path: Optional[str] = None):
+        self.enabled = enabled
+        self.export_path = export_path
+        self.metrics = MetricsRegistry()
+
+        self._export_lock = threading.Lock()
+        self._export_file = None
+        self._atexit_registered = False
+        self._stats_lock = threading.Lock()
+        self._stats = {'spans': 0, 'exported': 0, 'export_errors': 0}
+
+    def init_app(self, app):
+        """读取配置并注册请求级 span 的钩子"""
+        self.enabled = app.config.get('TRACING_ENABLED', True)
+        self.export_path = app.config.get('TRACE_EXPORT_PATH') or None
+        if not self.enabled:
+            return
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        if not self._atexit_registered:
+            atexit.register(self.close)
+            self._atexit_registered = True
+
+    # 请求钩子：流式响应在响应体发送完毕（响应关闭）时才结束 span
+    def _before_request(self):
+        from flask import g, request
+
+        match = _TRACEPARENT.match(request.headers.get('traceparent', ''))
+        span = self.start_span('http.request', trace_id=match.group(1) if match else None,
+                               method=request.method, route=request.path)
+        g.trace_span = span
+        g.trace_token = self.activate(span)
+
+    def _after_request(self, response):
+        from flask import g, request
+
+        span = g.pop('trace_span', None)
+        if span is None:
+            return response
+        token = g.pop('trace_token', None)
+        span.set(route=request.url_rule.rule if request.url_rule else 'unmatched',
+                 code=response.status_code)
+        if response.status_code >= 500:
+            span.fail(f'HTTP {response.status_code}')
+        response.headers['X-Trace-Id'] = span.trace_id
+
+        def finish():
+            span.end()
+            self.deactivate(token, span.parent)
+
+        if response.is_streamed:
+            response.call_on_close(finish)
+        else:
+            finish()
+        return response
+
+    def _teardown_request(self, exc):
+        from flask import g
+
+        # 视图抛出未处理的异常时不会执行 after_request
+        span = g.pop('trace_span', None)
+        if span is None:
+            return
+        span.fail(exc or 'HTTP 500')
+        span.end()
+        self.deactivate(g.pop('trace_token', None), span.parent)
+
+    def current_span(self) -> Optional[Span]:
+        return _current_span.get()
+
+    def start_span(self, name: str, parent: Optional[Span] = None, trace_id: str = None,
+                   **attributes) -> Optional[Span]:
+        """
+        开始一个 span（不设为当前 span）
+
+        parent 默认取当前 span；未启用追踪时返回 None
+        """
+        if not self.enabled:
+            return None
+        parent = parent or _current_span.get()
+        trace_id = trace_id or (parent.trace_id if parent else uuid.uuid4().hex)
+        return Span(self, name, trace_id, parent, attributes)
+
+    def activate(self, span: Optional[Span]):
+        """设为当前 span，返回用于恢复的令牌"""
+        if span is None:
+            return None
+        return _current_span.set(span)
+
+    @staticmethod
+    def deactivate(token, fallback: Optional[Span] = None):
+        """恢复到 activate 之前的 span（令牌在其他上下文中创建时直接设为 fallback）"""
+        if token is None:
+            return
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            _current_span.set(fallback)
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Optional[Span]]:
+        """在 with 代码块期间记录一个 span，抛出异常时标记为失败"""
+        span = self.start_span(name, **attributes)
+        token = self.activate(span)
+        try:
+            yield span
+        except Exception as e:
+            if span is not None:
+                span.fail(e)
+            raise
+        finally:
+            if span is not None:
+                span.end()
+                self.deactivate(token, span.parent)
+
+    def record(self, name: str, duration: float, error: str = None, **attributes):
+        """记录一个已经结束、由调用方自行计时的操作（如数据库提交）"""
+        span = self.start_span(name, **attributes)
+        if span is None:
+            return
+        if error:
+            span.fail(error)
+        span.end(duration)
+
+    def _finish(self, span: Span):
+        attributes = span.attributes
+        parent = span.parent
+        if parent is not None:
+            for key in self.ROLLUP_ATTRIBUTES:
+                if attributes.get(key):
+                    parent.add(key, attributes[key])
+
+        prefix = f"{self.METRIC_PREFIX}_{span.name.replace('.', '_')}"
+        labels = {key: attributes.get(key) or '' for key in self.METRIC_LABELS.get(span.name, ())}
+        self.metrics.observe(f'{prefix}_duration_seconds', {**labels, 'status': span.status},
+                             span.duration, f'{span.name} 耗时（秒）')
+        for key, suffix in self.COUNTED_ATTRIBUTES.items():
+            if attributes.get(key):
+                self.metrics.inc(f'{prefix}_{suffix}', labels, attributes[key], f'{span.name} {key} 累计')
+        if attributes.get('first_token_ms') is not None:
+            self.metrics.observe(f'{prefix}_first_token_seconds', labels, attributes['first_token_ms'] / 1000,
+                                 f'{span.name} 首个token耗时（秒）')
+
+        with self._stats_lock:
+            self._stats['spans'] += 1
+        if self.export_path:
+            self._export(span)
+
+    def _export(self, span: Span):
+        try:
+            line = json.dumps(span.to_dict(), ensure_ascii=False, default=str)
+            with self._export_lock:
+                if self._export_file is None:
+                    directory = os.path.dirname(self.export_path)
+                    if directory:
+                        os.makedirs(directory, exist_ok=True)
+                    self._export_file = open(self.export_path, 'a', encoding='utf-8', buffering=1)
+                self._export_file.write(line + '\n')
+            with self._stats_lock:
+                self._stats['exported'] += 1
+        except (OSError, TypeError, ValueError) as e:
+            with self._stats_lock:
+                self._stats['export_errors'] += 1
+            print(f"导出追踪数据失败: {str(e)}")
+
+    def close(self):
+        with self._export_lock:
+            if self._export_file is not None:
+                self._export_file.close()
+                self._export_file = None
+
+    def render_metrics(self) -> str:
+        return self.metrics.render()
+
+    def get_stats(self) -> Dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['enabled'] = self.enabled
+        stats['export_path'] = self.export_path
+        return stats
+
+
+tracer = Tracer()
+
+
+def trace_workflow_events(events: Iterator[Dict], engine: str) -> Iterator[Dict]:
+    """
+    为工作流事件流记录 span：整个工作流一个 workflow.run，每个步骤一个 workflow.step
+
+    步骤 span 在 step_started 时开始并设为当前 span，步骤内的模型调用与提示词构建成为其子 span；
+    首个 token 事件记为该步骤的首 token 耗时，step_finished 中的 token 用量、模型与复用情况写入属性。
+    """
+    run = tracer.start_span('workflow.run', engine=engine)
+    if run is None:
+        yield from events
+        return
+
+    run_token = tracer.activate(run)
+    # 进行中的步骤 span（按步骤ID）：DSL 引擎并发执行的节点不一定按开始顺序结束
+    steps: Dict[str, Span] = {}
+
+    def end_step(step, error=None, **attributes):
+        span = steps.pop(step, None)
+        if span is None:
+            return
+        span.set(**attributes)
+        if error:
+            span.fail(error)
+        span.end()
+        # 当前 span 回到最近开始且仍在进行的步骤，没有时回到 workflow.run
+        tracer.activate(next(reversed(steps.values()), run))
+
+    try:
+        for event in events:
+            kind = event.get('event')
+            step = event.get('step')
+            if kind == 'step_started':
+                end_step(step, error='未完成')
+                steps[step] = tracer.start_span('workflow.step', parent=run, step=step)
+                tracer.activate(steps[step])
+            elif kind == 'token' and steps:
+                # token 事件以 workflow_step 标识步骤
+                span = steps.get(event.get('workflow_step')) or next(reversed(steps.values()))
+                if 'first_token_ms' not in span.attributes:
+                    span.set(first_token_ms=round(span.elapsed_ms, 2))
+            elif kind == 'step_finished':
+                end_step(step, tokens=event.get('tokens_used', 0), model=event.get('model_used'),
+                         memoized=event.get('memoized', False), degraded=event.get('degraded', False),
+                         cached=event.get('cached', False))
+            elif kind == 'step_failed':
+                end_step(step, error=event.get('error') or '步骤失败')
+            elif kind == 'workflow_finished':
+                result = event.get('result') or {}
+                run.set(tokens=result.get('total_tokens_used', 0),
+                        steps_completed=len(result.get('steps_completed') or []),
+                        steps_reused=len(result.get('steps_reused') or []))
+                if not result.get('success'):
+                    run.fail(result.get('error') or '工作流失败')
+            yield event
+    except GeneratorExit:
+        run.fail('cancelled')
+        raise
+    except Exception as e:
+        run.fail(e)
+        raise
+    finally:
+        for step in list(steps):
+            end_step(step, error='未完成')
+        run.end()
+        tracer.deactivate(run_token, run.parent)
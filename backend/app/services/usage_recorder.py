@@ -0,0 +1,224 @@
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+
+class UsageRecorder:
+    """
+    APIUsage 异步批量写入器
+
+    用量记录先进入进程内队列，由后台线程按批量大小或时间间隔批量插入数据库，
+    使用量统计不占用请求路径上的写事务。队列已满或写库失败时追加到磁盘文件，
+    下次写入时重新导入；进程退出时将剩余记录全部写入。
+    """
+
+    def __init__(self, batch_size: int = 50, flush_interval: float = 1.0,
+                 max_queue_size: int = 10000, spill_path: Optional[str] = None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.spill_path = spill_path
+
+        self.app = None
+        self._queue: 'queue.Queue[Dict]' = queue.Queue(maxsize=max_queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+        self._atexit_registered = False
+        self._write_lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'queued': 0,
+            'written': 0,
+            'batches': 0,
+            'spilled': 0,
+            'replayed': 0,
+            'errors': 0,
+            'last_batch_ms': 0.0
+        }
+
+    def init_app(self, app):
+        """绑定Flask应用并启动后台写入线程"""
+        self.app = app
+        self.batch_size = app.config.get('USAGE_BATCH_SIZE', self.batch_size)
+        self.flush_interval = app.config.get('USAGE_FLUSH_INTERVAL', self.flush_interval)
+        self.spill_path = app.config.get('USAGE_SPILL_PATH') or os.path.join(app.instance_path, 'usage_spill.jsonl')
+
+        max_queue_size = app.config.get('USAGE_QUEUE_MAX', self.max_queue_size)
+        if max_queue_size != self.max_queue_size and self._queue.empty():
+            self.max_queue_size = max_queue_size
+            self._queue = queue.Queue(maxsize=max_queue_size)
+
+        if not app.config.get('USAGE_ASYNC_WRITE', True) or self.is_running():
+            return
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='usage-recorder', daemon=True)
+        self._thread.start()
+        if not self._atexit_registered:
+            atexit.register(self.stop)
+            self._atexit_registered = True
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def record(self, **fields) -> bool:
+        """
+        提交一条用量记录（字段同 APIUsage 构造参数）
+
+        Returns:
+            是否已异步提交；后台线程未运行时返回 False，调用方应同步写入
+        """
+        if not self.is_running():
+            return False
+
+        fields.setdefault('created_at', datetime.utcnow())
+        try:
+            self._queue.put_nowait(fields)
+        except queue.Full:
+            # 队列已满时直接落盘，保证内存占用有上限
+            self._spill([fields])
+            return True
+
+        with self._stats_lock:
+            self._stats['queued'] += 1
+        return True
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            batch = self._take_batch()
+            if batch:
+                self._write(batch)
+            elif self._has_spill():
+                self._replay_spill()
+
+    def _take_batch(self) -> List[Dict]:
+        """等待凑满一批或达到时间间隔"""
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _drain(self) -> List[Dict]:
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                return batch
+
+    def _write(self, batch: List[Dict]) -> bool:
+        """批量插入一批记录，失败时落盘"""
+        from sqlalchemy import insert
+        from .. import db
+        from ..models import APIUsage
+
+        start_time = time.time()
+        with self._write_lock:
+            with self.app.app_context():
+                try:
+                    db.session.execute(insert(APIUsage), batch)
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"批量写入API使用记录失败，已暂存到磁盘: {str(e)}")
+                    with self._stats_lock:
+                        self._stats['errors'] += 1
+                    self._spill(batch)
+                    return False
+                finally:
+                    db.session.remove()
+
+        with self._stats_lock:
+            self._stats['written'] += len(batch)
+            self._stats['batches'] += 1
+            self._stats['last_batch_ms'] = round((time.time() - start_time) * 1000, 2)
+        return True
+
+    def _spill(self, batch: List[Dict]):
+        """将记录追加到磁盘文件（JSON Lines）"""
+        try:
+            directory = os.path.dirname(self.spill_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with self._spill_lock, open(self.spill_path, 'a', encoding='utf-8') as f:
+                for fields in batch:
+                    row = dict(fields)
+                    if isinstance(row.get('created_at'), datetime):
+                        row['created_at'] = row['created_at'].isoformat()
+                    f.write(json.dumps(row, ensure_ascii=False) + '\n')
+            with self._stats_lock:
+                self._stats['spilled'] += len(batch)
+        except Exception as e:
+            print(f"暂存API使用记录失败: {str(e)}")
+
+    def _has_spill(self) -> bool:
+        return bool(self.spill_path) and os.path.exists(self.spill_path) and os.path.getsize(self.spill_path) > 0
+
+    def _replay_spill(self):
+        """重新导入磁盘上暂存的记录"""
+        replay_path = f"{self.spill_path}.replay"
+        try:
+            with self._spill_lock:
+                os.replace(self.spill_path, replay_path)
+            with open(replay_path, 'r', encoding='utf-8') as f:
+                rows = [json.loads(line) for line in f if line.strip()]
+        except (OSError, ValueError) as e:
+            print(f"读取暂存的API使用记录失败: {str(e)}")
+            return
+
+        for row in rows:
+            if row.get('created_at'):
+                row['created_at'] = datetime.fromisoformat(row['created_at'])
+
+        written = True
+        for start in range(0, len(rows), self.batch_size):
+            # 写入失败的批次会重新落盘
+            written = self._write(rows[start:start + self.batch_size]) and written
+        os.remove(replay_path)
+
+        with self._stats_lock:
+            self._stats['replayed'] += len(rows)
+        if not written:
+            # 数据库仍不可用，稍后再试
+            self._stop_event.wait(self.flush_interval)
+
+    def flush(self):
+        """同步写入队列中的全部记录"""
+        if self.app is None:
+            return
+        batch = self._drain()
+        for start in range(0, len(batch), self.batch_size):
+            self._write(batch[start:start + self.batch_size])
+
+    def stop(self, timeout: float = 5.0):
+        """停止后台线程并写入剩余记录"""
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join(timeout=timeout)
+        self._thread = None
+        self.flush()
+
+    def get_stats(self) -> Dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['pending'] = self._queue.qsize()
+        stats['running'] = self.is_running()
+        stats['spill_bytes'] = os.path.getsize(self.spill_path) if self._has_spill() else 0
+        return stats
+
+
+usage_recorder = UsageRecorder()
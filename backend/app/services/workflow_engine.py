@@ -1,14 +1,91 @@
+import hashlib
+import json
+import time
 import yaml
 import re
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Iterator, Generator, Tuple
+from flask import current_app
 from .openrouter_service import OpenRouterService
+from .async_openrouter_service import AsyncOpenRouterService
+from .token_budget import PromptTooLargeError
+from .search import search_service
+from .case_index import case_index
+from .tracing import tracer, trace_workflow_events
 
 class WorkflowEngine:
     """工作流引擎 - 执行案例改编业务逻辑"""
     
+    # 提示词变量及其在前缀布局中的名称，按跨请求变化由少到多排列
+    PROMPT_FIELDS = [
+        ('knowledge_points', '知识点'),
+        ('case_scenario', '案例场景'),
+        ('learning_objectives', '考核目标'),
+        ('question_type', '题目类型与数量'),
+        ('search_context', '搜索材料'),
+        ('case_materials', '参考案例材料'),
+        ('case_content', '案例内容')
+    ]
+    
+    # 按难度等级优化题目的要求
+    DIFFICULTY_INSTRUCTIONS = {
+        '初级': '题目太复杂了，请简化部分题目，降低题目难度，使其更适合初学者。保证题目类型和数量不变。',
+        '高级': '题目太简单了，请替换部分题目，提升题目复杂度和难度，要求选项之间具有混淆度，不能是一眼就能看出答案的。保证题目类型和数量不变。'
+    }
+    
+    # 题目类型及数量，如 "单选题 3 道"、"多项选择题两道"
+    QUESTION_TYPE_PATTERN = re.compile(
+        r'(单项选择题|多项选择题|单选题|多选题|判断题|思考题|简答题|填空题|案例分析题|论述题)\s*[:：]?\s*'
+        r'(\d+|[一二两三四五六七八九十]+)\s*道'
+    )
+    QUESTION_TYPE_ALIASES = {'单项选择题': '单选题', '多项选择题': '多选题'}
+    
+    # 题号行，如 "1. "、"**2、**"、"### 第3题"
+    QUESTION_NUMBER_PATTERN = re.compile(
+        r'^(\s*(?:#+\s*)?(?:\*\*)?\s*(?:第\s*)?)(\d+)(\s*(?:题|[.、．]))', re.MULTILINE
+    )
+    
+    # 单次生成时直接按难度等级出题的要求（中级无额外要求）
+    DIFFICULTY_GENERATION_INSTRUCTIONS = {
+        '初级': '题目面向初学者：题干简洁，考查基础概念的识别与理解，干扰项与正确答案区分明显，避免多步推理。',
+        '高级': '题目面向高阶学习者：题干结合复杂情境，考查分析、综合与应用能力，选项之间具有较强混淆度，不能是一眼就能看出答案的。'
+    }
+    
+    # 各步骤依赖的用户输入字段（上游步骤的输出另行计入输入哈希）
+    STEP_INPUT_FIELDS = {
+        'case_generation': ('knowledgePoints', 'caseScenario', 'learningObjectives', 'caseMaterials'),
+        'question_generation': ('knowledgePoints', 'learningObjectives', 'questionType', 'difficultyLevel'),
+        'question_optimization': ('difficultyLevel',)
+    }
+    
     def __init__(self, openrouter_service: OpenRouterService):
         self.openrouter = openrouter_service
+        self.async_openrouter = AsyncOpenRouterService(openrouter_service)
         self.prompts = self._load_prompts()
+        self.prefix_prompts = self._load_prefix_prompts()
+        self._dsl_engine = None
+    
+    @property
+    def dsl_engine(self):
+        """按 案例改编.yml 执行的DSL引擎，首次使用时创建"""
+        if self._dsl_engine is None:
+            from .dsl_workflow import DSLWorkflowEngine
+            self._dsl_engine = DSLWorkflowEngine.from_config(self, current_app.config)
+        return self._dsl_engine
+    
+    def get_dsl_stats(self) -> Optional[Dict[str, Any]]:
+        """DSL引擎运行指标，尚未使用时返回 None"""
+        return self._dsl_engine.get_stats() if self._dsl_engine else None
+    
+    @staticmethod
+    def get_engine_name(workflow_input: Dict[str, Any]) -> str:
+        """工作流引擎：请求中的 engine 优先，其次为配置 WORKFLOW_ENGINE"""
+        engine = workflow_input.get('engine')
+        if engine not in ('builtin', 'dsl'):
+            try:
+                engine = current_app.config.get('WORKFLOW_ENGINE', 'builtin')
+            except RuntimeError:
+                engine = 'builtin'
+        return engine if engine in ('builtin', 'dsl') else 'builtin'
     
     def _load_prompts(self) -> Dict[str, str]:
         """加载提示词模板"""
@@ -83,6 +160,49 @@ class WorkflowEngine:
 - 提供**简明的答案解析**，帮助学生更好地理解每个选择的背景和原因。"""
         }
     
+    def _load_prefix_prompts(self) -> Dict[str, str]:
+        """
+        生成前缀布局的静态提示词
+        
+        模板中的变量替换为「名称」引用，实际取值放在后续的用户消息中，
+        使同一步骤所有请求的系统消息完全相同，可以命中服务端的提示词前缀缓存。
+        """
+        references = {field: f'「{label}」' for field, label in self.PROMPT_FIELDS}
+        return {
+            name: template.format(**references) + '\n\n以上用「」标注的内容见用户消息中的输入。'
+            for name, template in self.prompts.items()
+        }
+    
+    @staticmethod
+    def get_prompt_layout(workflow_input: Dict[str, Any]) -> str:
+        """
+        获取提示词布局：prefix(静态指令在前、变量输入在后) 或 legacy(变量填入模板的单条系统消息)
+        
+        请求参数 prompt_layout 优先，其次为配置 PROMPT_LAYOUT
+        """
+        layout = workflow_input.get('prompt_layout')
+        if layout not in ('prefix', 'legacy'):
+            try:
+                layout = current_app.config.get('PROMPT_LAYOUT', 'prefix')
+            except RuntimeError:
+                layout = 'prefix'
+        return layout
+    
+    def _build_messages(self, prompt_name: str, workflow_input: Dict[str, Any], **variables) -> List[Dict]:
+        """按提示词布局构建消息列表"""
+        layout = self.get_prompt_layout(workflow_input)
+        with tracer.span('prompt.build', template=prompt_name, layout=layout):
+            if layout == 'legacy':
+                return [{"role": "system", "content": self.prompts[prompt_name].format(**variables)}]
+            
+            inputs = '\n\n'.join(
+                f'「{label}」：\n{variables[field]}' for field, label in self.PROMPT_FIELDS if field in variables
+            )
+            return [
+                {"role": "system", "content": self.prefix_prompts[prompt_name]},
+                {"role": "user", "content": inputs}
+            ]
+    
     def execute_workflow(self, workflow_input: Dict[str, Any]) -> Dict[str, Any]:
         """
         执行完整的工作流程
@@ -93,99 +213,383 @@ class WorkflowEngine:
         Returns:
             工作流执行结果
         """
+        return self._collect_result(self.iter_workflow_events(workflow_input, stream=False))
+    
+    def iter_workflow_events(self, workflow_input: Dict[str, Any], stream: bool = True,
+                             memo: Dict[str, Dict[str, Any]] = None,
+                             force_steps: Tuple[str, ...] = ()) -> Iterator[Dict[str, Any]]:
+        """
+        执行工作流程并逐步产出事件
+        
+        事件类型：
+            step_started: 步骤开始
+            token: 模型输出的增量文本（仅 stream=True 时产生）
+            step_finished: 步骤完成，包含内容、token用量与输入哈希
+            step_failed: 步骤失败
+            workflow_finished: 工作流结束，result 与 execute_workflow 返回值一致
+        
+        Args:
+            workflow_input: 工作流输入参数
+            stream: 是否以流式方式调用模型
+            memo: 已保存的步骤输出 {步骤: {'input_hash', 'content', 'model_used'}}，
+                  输入哈希一致的步骤直接复用，不再调用模型
+            force_steps: 必须重新执行的步骤（不复用已保存的输出，也不读取响应缓存）
+        """
+        engine = self.get_engine_name(workflow_input)
+        if engine == 'dsl':
+            events = self.dsl_engine.iter_workflow_events(workflow_input, stream)
+        else:
+            events = self._iter_builtin_events(workflow_input, stream, memo, force_steps)
+        # 整个工作流与每个步骤分别记录追踪 span
+        yield from trace_workflow_events(events, engine)
+    
+    def _iter_builtin_events(self, workflow_input: Dict[str, Any], stream: bool,
+                             memo: Optional[Dict[str, Dict[str, Any]]],
+                             force_steps: Tuple[str, ...]) -> Iterator[Dict[str, Any]]:
+        """内置流程：生成案例，按需生成题目并按难度优化"""
+        memo = memo or {}
         result = {
             'success': False,
             'case_content': None,
             'questions': None,
             'total_tokens_used': 0,
-            'steps_completed': []
+            'steps_completed': [],
+            'steps_reused': [],
+            'models_used': {},
+            'prompt_layout': self.get_prompt_layout(workflow_input),
+            'difficulty_mode': self.get_difficulty_mode(workflow_input)
         }
         
+        def record(step, step_result):
+            result['steps_completed'].append(step)
+            if step_result.get('memoized'):
+                result['steps_reused'].append(step)
+        
         try:
             # 步骤1: 判断是否有参考材料
             has_materials = bool(workflow_input.get('caseMaterials', '').strip())
             
-            if has_materials:
-                # 路径A: 基于材料改编案例
-                case_result = self._adapt_case_with_materials(workflow_input)
-            else:
-                # 路径B: 无材料生成案例（这里简化处理，实际应该包含搜索步骤）
-                case_result = self._generate_case_without_materials(workflow_input)
+            yield {'event': 'step_started', 'step': 'case_generation'}
+            case_hash = self.step_input_hash('case_generation', workflow_input)
+            case_result = self._memoized_step('case_generation', case_hash, memo, force_steps)
+            if case_result is None:
+                step_input = self._step_input(workflow_input, 'case_generation', force_steps)
+                if has_materials:
+                    # 路径A: 基于材料改编案例
+                    case_result = yield from self._adapt_case_with_materials(step_input, stream)
+                else:
+                    # 路径B: 无材料时检索案例库中的相似案例并联网搜索背景资料，据此生成案例
+                    case_result = yield from self._generate_case_without_materials(step_input, stream)
             
             if not case_result['success']:
                 result['error'] = case_result.get('error', '案例生成失败')
-                return result
+                yield self._step_failed_event('case_generation', result['error'])
+                yield {'event': 'workflow_finished', 'result': result}
+                return
             
+            case_result['input_hash'] = case_hash
             result['case_content'] = case_result['content']
             result['total_tokens_used'] += case_result.get('tokens_used', 0)
-            result['steps_completed'].append('case_generation')
+            result['models_used']['case_generation'] = case_result.get('model_used')
+            record('case_generation', case_result)
+            yield self._step_finished_event('case_generation', case_result)
             
             # 步骤2: 判断是否生成题目
             if workflow_input.get('yes_or_no') == '是':
-                questions_result = self._generate_questions(workflow_input, case_result['content'])
+                yield {'event': 'step_started', 'step': 'question_generation'}
+                questions_hash = self.step_input_hash('question_generation', workflow_input, case_result['content'])
+                questions_result = self._memoized_step('question_generation', questions_hash, memo, force_steps)
+                if questions_result is None:
+                    questions_result = yield from self._generate_questions(
+                        self._step_input(workflow_input, 'question_generation', force_steps),
+                        case_result['content'], stream
+                    )
                 
                 if questions_result['success']:
+                    questions_result['input_hash'] = questions_hash
                     result['questions'] = questions_result['content']
                     result['total_tokens_used'] += questions_result.get('tokens_used', 0)
-                    result['steps_completed'].append('question_generation')
+                    result['models_used']['question_generation'] = questions_result.get('model_used')
+                    record('question_generation', questions_result)
+                    yield self._step_finished_event('question_generation', questions_result)
                     
-                    # 步骤3: 根据难度等级优化题目
-                    if workflow_input.get('difficultyLevel'):
-                        optimization_result = self._optimize_questions_by_difficulty(
-                            workflow_input, questions_result['content']
+                    # 步骤3: 根据难度等级优化题目（single_pass 模式下已在出题时按难度生成）
+                    if workflow_input.get('difficultyLevel') and self.get_difficulty_mode(workflow_input) == 'two_pass':
+                        yield {'event': 'step_started', 'step': 'question_optimization'}
+                        optimization_hash = self.step_input_hash(
+                            'question_optimization', workflow_input, questions_result['content']
+                        )
+                        optimization_result = self._memoized_step(
+                            'question_optimization', optimization_hash, memo, force_steps
                         )
+                        if optimization_result is None:
+                            optimization_result = yield from self._optimize_questions_by_difficulty(
+                                self._step_input(workflow_input, 'question_optimization', force_steps),
+                                questions_result['content'], stream
+                            )
+                        optimization_result['input_hash'] = optimization_hash
                         if optimization_result['success']:
                             result['questions'] = optimization_result['content']
                             result['total_tokens_used'] += optimization_result.get('tokens_used', 0)
-                            result['steps_completed'].append('question_optimization')
+                            record('question_optimization', optimization_result)
+                            if optimization_result.get('model_used'):
+                                result['models_used']['question_generation'] = optimization_result['model_used']
+                        yield self._step_finished_event('question_optimization', optimization_result)
+                else:
+                    yield self._step_failed_event(
+                        'question_generation', questions_result.get('error', '题目生成失败')
+                    )
             
             result['success'] = True
-            return result
             
         except Exception as e:
             result['error'] = f'工作流执行异常: {str(e)}'
-            return result
+        
+        yield {'event': 'workflow_finished', 'result': result}
+    
+    def step_input_hash(self, step: str, workflow_input: Dict[str, Any], upstream: str = None) -> str:
+        """
+        计算步骤输入的哈希
+        
+        包含步骤依赖的用户输入、上游步骤的输出、模型与影响提示词的执行方式，
+        任一变化都会使已保存的步骤输出失效
+        """
+        payload = {
+            'step': step,
+            'model_name': workflow_input.get('model_name'),
+            'prompt_layout': self.get_prompt_layout(workflow_input),
+            'fields': {field: workflow_input.get(field) or '' for field in self.STEP_INPUT_FIELDS[step]},
+            'upstream': upstream
+        }
+        if step == 'question_generation':
+            payload['question_mode'] = self.get_question_mode(workflow_input)
+            payload['difficulty_mode'] = self.get_difficulty_mode(workflow_input)
+        encoded = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+    
+    @staticmethod
+    def _memoized_step(step: str, input_hash: str, memo: Dict[str, Dict[str, Any]],
+                       force_steps: Tuple[str, ...]) -> Optional[Dict[str, Any]]:
+        """输入哈希与已保存的步骤输出一致时返回复用的步骤结果（不计token消耗）"""
+        saved = memo.get(step)
+        if step in force_steps or not saved or saved.get('input_hash') != input_hash:
+            return None
+        return {
+            'success': True,
+            'content': saved['content'],
+            'tokens_used': 0,
+            'model_used': saved.get('model_used'),
+            'memoized': True
+        }
+    
+    @staticmethod
+    def _step_input(workflow_input: Dict[str, Any], step: str, force_steps: Tuple[str, ...]) -> Dict[str, Any]:
+        """强制重新执行的步骤不读取响应缓存，确保生成新的内容"""
+        if step in force_steps:
+            return {**workflow_input, 'use_cache': False}
+        return workflow_input
+    
+    @staticmethod
+    def _step_finished_event(step: str, step_result: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'event': 'step_finished',
+            'step': step,
+            'content': step_result.get('content'),
+            'tokens_used': step_result.get('tokens_used', 0),
+            'usage': step_result.get('usage', {}),
+            'cached': step_result.get('cached', False),
+            'cached_tokens': step_result.get('cached_tokens', 0),
+            'model_used': step_result.get('model_used'),
+            'input_hash': step_result.get('input_hash'),
+            'memoized': step_result.get('memoized', False),
+            'degraded': step_result.get('degraded', False)
+        }
+    
+    @staticmethod
+    def _step_failed_event(step: str, error: str) -> Dict[str, Any]:
+        return {'event': 'step_failed', 'step': step, 'error': error}
     
-    def _adapt_case_with_materials(self, workflow_input: Dict[str, Any]) -> Dict[str, Any]:
+    def _call_llm(self, messages: List[Dict], workflow_input: Dict[str, Any], request_type: str,
+                  workflow_step: str, stream: bool = False,
+                  params: Dict[str, Any] = None) -> Generator[Dict[str, Any], None, Dict[str, Any]]:
+        """
+        调用模型完成一个工作流步骤
+        
+        生成器：流式模式下逐个产出 token 事件，结束时返回步骤结果
+        {'success', 'content', 'tokens_used', 'usage'} 或 {'success': False, 'error'}；
+        params 为额外的采样参数（如 temperature）
+        """
+        try:
+            plan = self.openrouter.token_budget.plan(messages, workflow_input['model_name'])
+        except PromptTooLargeError as e:
+            return {'success': False, 'error': str(e)}
+        
+        call_kwargs = dict(
+            messages=messages,
+            model_name=workflow_input['model_name'],
+            api_key=workflow_input['api_key'],
+            user_uuid=workflow_input['user_uuid'],
+            session_id=workflow_input['session_id'],
+            request_type=request_type,
+            workflow_step=workflow_step,
+            # 相同输入的工作流步骤复用缓存结果，调用方可传入 use_cache=False 强制重新生成
+            use_cache=workflow_input.get('use_cache', True),
+            routing_policy=workflow_input.get('routing_policy'),
+            # 交互请求优先于批量/后台任务占用API密钥的并发名额
+            priority=workflow_input.get('priority', 'interactive'),
+            # 输出上限取剩余上下文预算，估算值随用量记录用于校准
+            max_tokens=plan['max_tokens'],
+            estimated_prompt_tokens=plan['estimated_prompt_tokens'],
+            **(params or {})
+        )
+        
+        if stream:
+            api_result = {'success': False, 'error': 'API流式响应意外结束'}
+            for chunk in self.openrouter.stream_chat_completion(**call_kwargs):
+                if chunk['type'] == 'delta':
+                    yield {'event': 'token', 'workflow_step': workflow_step, 'delta': chunk['content']}
+                elif chunk['type'] == 'done':
+                    api_result = {
+                        'success': True,
+                        'data': chunk['data'],
+                        'cached': chunk.get('cached', False),
+                        'model_used': chunk.get('model_used')
+                    }
+                elif chunk['type'] == 'error':
+                    api_result = {'success': False, 'error': chunk['error']}
+        else:
+            api_result = self.openrouter.chat_completion(**call_kwargs)
+        
+        return self._to_step_result(api_result)
+    
+    @staticmethod
+    def _to_step_result(api_result: Dict[str, Any]) -> Dict[str, Any]:
+        """将模型调用结果转换为步骤结果，命中缓存的步骤不计token消耗"""
+        if api_result['success']:
+            usage = api_result['data'].get('usage') or {}
+            cached = api_result.get('cached', False)
+            return {
+                'success': True,
+                'content': api_result['data']['choices'][0]['message']['content'],
+                'tokens_used': 0 if cached else usage.get('total_tokens', 0),
+                'usage': usage,
+                'cached': cached,
+                'cached_tokens': 0 if cached else OpenRouterService.get_cached_tokens(usage),
+                'model_used': api_result.get('model_used')
+            }
+        
+        return {
+            'success': False,
+            'error': api_result.get('error', 'API调用失败')
+        }
+    
+    def _call_llm_many(self, calls: List[Dict[str, Any]], workflow_input: Dict[str, Any],
+                       max_concurrency: int = None) -> List[Dict[str, Any]]:
+        """
+        并发执行多个互不依赖的模型调用
+        
+        Args:
+            calls: 每项包含 messages、request_type、workflow_step 及可选的采样参数
+            workflow_input: 工作流输入参数
+            max_concurrency: 最大并发数
+        
+        Returns:
+            与 calls 顺序一致的步骤结果列表，格式同 _call_llm
+        """
+        budget = self.openrouter.token_budget
+        results: List[Optional[Dict[str, Any]]] = [None] * len(calls)
+        requests = []
+        indexes = []
+        for index, call in enumerate(calls):
+            try:
+                plan = budget.plan(call['messages'], workflow_input['model_name'])
+            except PromptTooLargeError as e:
+                results[index] = {'success': False, 'error': str(e)}
+                continue
+            requests.append({
+                'model_name': workflow_input['model_name'],
+                'api_key': workflow_input['api_key'],
+                'user_uuid': workflow_input['user_uuid'],
+                'session_id': workflow_input['session_id'],
+                'use_cache': workflow_input.get('use_cache', True),
+                'priority': workflow_input.get('priority', 'interactive'),
+                'max_tokens': plan['max_tokens'],
+                'estimated_prompt_tokens': plan['estimated_prompt_tokens'],
+                **call
+            })
+            indexes.append(index)
+        
+        if requests:
+            api_results = self.async_openrouter.run_many(requests, max_concurrency=max_concurrency)
+            for index, api_result in zip(indexes, api_results):
+                results[index] = self._to_step_result(api_result)
+        
+        return results
+    
+    def _fit_case_materials(self, workflow_input: Dict[str, Any], trim: bool = True) -> str:
+        """
+        按模型上下文窗口适配参考材料
+        
+        材料超出预算时按 PROMPT_OVERFLOW_POLICY 处理：trim 保留开头部分，reject 抛出 PromptTooLargeError；
+        trim=False 时只做检查，不裁剪
+        """
+        budget = self.openrouter.token_budget
+        model_name = workflow_input['model_name']
+        materials = workflow_input.get('caseMaterials', '')
+        
+        template_messages = self._build_messages(
+            'case_adaptation_with_materials', workflow_input,
+            knowledge_points=workflow_input['knowledgePoints'],
+            case_scenario=workflow_input['caseScenario'],
+            learning_objectives=workflow_input['learningObjectives'],
+            case_materials=''
+        )
+        template_tokens = budget.estimate_messages(template_messages, model_name)
+        available = budget.available_prompt_tokens(model_name) - template_tokens
+        materials_tokens = budget.estimate_text(materials, model_name)
+        
+        if materials_tokens <= available:
+            return materials
+        if budget.overflow_policy == 'reject' or available <= 0:
+            raise PromptTooLargeError(
+                model_name, template_tokens + materials_tokens, budget.get_context_window(model_name)
+            )
+        return budget.trim_text(materials, available, model_name) if trim else materials
+    
+    def check_prompt_budget(self, workflow_input: Dict[str, Any]) -> Optional[str]:
+        """
+        调用模型前检查输入是否能放入上下文窗口
+        
+        Returns:
+            错误信息；输入可以处理（必要时会被裁剪）时返回 None
+        """
+        if not workflow_input.get('caseMaterials', '').strip():
+            return None
+        try:
+            self._fit_case_materials(workflow_input, trim=False)
+        except PromptTooLargeError as e:
+            return str(e)
+        return None
+    
+    def _adapt_case_with_materials(self, workflow_input: Dict[str, Any], stream: bool = False):
         """基于参考材料改编案例"""
         try:
-            # 构建提示词
-            prompt = self.prompts['case_adaptation_with_materials'].format(
+            # 构建提示词（参考材料超出上下文预算时裁剪）
+            messages = self._build_messages(
+                'case_adaptation_with_materials', workflow_input,
                 knowledge_points=workflow_input['knowledgePoints'],
                 case_scenario=workflow_input['caseScenario'],
                 learning_objectives=workflow_input['learningObjectives'],
-                case_materials=workflow_input['caseMaterials']
+                case_materials=self._fit_case_materials(workflow_input)
             )
             
-            messages = [{"role": "system", "content": prompt}]
-            
             # 调用AI API
-            api_result = self.openrouter.chat_completion(
-                messages=messages,
-                model_name=workflow_input['model_name'],
-                api_key=workflow_input['api_key'],
-                user_uuid=workflow_input['user_uuid'],
-                session_id=workflow_input['session_id'],
+            return (yield from self._call_llm(
+                messages, workflow_input,
                 request_type='案例改编',
-                workflow_step='case_adaptation_with_materials'
-            )
-            
-            print(f"DEBUG: API调用结果: {api_result}")  # 添加调试日志
-            
-            if api_result['success']:
-                content = api_result['data']['choices'][0]['message']['content']
-                tokens_used = api_result['data'].get('usage', {}).get('total_tokens', 0)
-                
-                return {
-                    'success': True,
-                    'content': content,
-                    'tokens_used': tokens_used
-                }
-            else:
-                return {
-                    'success': False,
-                    'error': api_result.get('error', 'API调用失败')
-                }
+                workflow_step='case_adaptation_with_materials',
+                stream=stream
+            ))
                 
         except Exception as e:
             return {
@@ -193,45 +597,44 @@ class WorkflowEngine:
                 'error': f'案例改编失败: {str(e)}'
             }
     
-    def _generate_case_without_materials(self, workflow_input: Dict[str, Any]) -> Dict[str, Any]:
+    def _generate_case_without_materials(self, workflow_input: Dict[str, Any], stream: bool = False):
         """无参考材料时生成案例"""
         try:
-            # 这里应该包含搜索步骤，暂时简化处理
-            search_context = f"基于{workflow_input['caseScenario']}场景和{workflow_input['knowledgePoints']}知识点的相关案例材料"
+            library_cases, retrieval_ms = self._retrieve_library_cases(workflow_input)
+            if library_cases is not None:
+                yield {
+                    'event': 'retrieval_finished',
+                    'step': 'case_generation',
+                    'case_ids': [item['id'] for item in library_cases],
+                    'elapsed_ms': retrieval_ms
+                }
             
-            prompt = self.prompts['case_generation_from_search'].format(
+            search = self._search_case_materials(workflow_input)
+            if search is not None:
+                yield {
+                    'event': 'search_finished',
+                    'step': 'case_generation',
+                    'query': search['query'],
+                    'result_count': len(search['results']),
+                    'providers': search['providers'],
+                    'cached': search['cached'],
+                    'elapsed_ms': search['elapsed_ms']
+                }
+            
+            messages = self._build_messages(
+                'case_generation_from_search', workflow_input,
                 knowledge_points=workflow_input['knowledgePoints'],
                 case_scenario=workflow_input['caseScenario'],
                 learning_objectives=workflow_input['learningObjectives'],
-                search_context=search_context
+                search_context=self._compose_search_context(workflow_input, library_cases, search)
             )
             
-            messages = [{"role": "system", "content": prompt}]
-            
-            api_result = self.openrouter.chat_completion(
-                messages=messages,
-                model_name=workflow_input['model_name'],
-                api_key=workflow_input['api_key'],
-                user_uuid=workflow_input['user_uuid'],
-                session_id=workflow_input['session_id'],
+            return (yield from self._call_llm(
+                messages, workflow_input,
                 request_type='案例生成',
-                workflow_step='case_generation_from_search'
-            )
-            
-            if api_result['success']:
-                content = api_result['data']['choices'][0]['message']['content']
-                tokens_used = api_result['data'].get('usage', {}).get('total_tokens', 0)
-                
-                return {
-                    'success': True,
-                    'content': content,
-                    'tokens_used': tokens_used
-                }
-            else:
-                return {
-                    'success': False,
-                    'error': api_result.get('error', 'API调用失败')
-                }
+                workflow_step='case_generation_from_search',
+                stream=stream
+            ))
                 
         except Exception as e:
             return {
@@ -239,42 +642,86 @@ class WorkflowEngine:
                 'error': f'案例生成失败: {str(e)}'
             }
     
-    def _generate_questions(self, workflow_input: Dict[str, Any], case_content: str) -> Dict[str, Any]:
+    @staticmethod
+    def _retrieve_library_cases(workflow_input: Dict[str, Any]) -> Tuple[Optional[List[Dict[str, Any]]], float]:
+        """
+        从案例库BM25索引中检索与知识点、场景和考核目标相关的案例（只含公开案例与本人的案例）
+        
+        Returns:
+            (检索到的案例, 耗时毫秒)；未启用案例库索引时案例为 None
+        """
+        try:
+            config = current_app.config
+        except RuntimeError:
+            config = {}
+        if not case_index.enabled:
+            return None, 0.0
+        
+        started = time.perf_counter()
+        query = ' '.join(
+            workflow_input.get(field) or '' for field in ('knowledgePoints', 'caseScenario', 'learningObjectives')
+        )
+        with tracer.span('case.retrieval') as span:
+            cases = case_index.search(
+                query,
+                top_k=config.get('CASE_INDEX_TOP_K', 3),
+                user_uuid=workflow_input.get('user_uuid'),
+                min_score=config.get('CASE_INDEX_MIN_SCORE', 0.0)
+            )
+            if span is not None:
+                span.set(results=len(cases))
+        return cases, round((time.perf_counter() - started) * 1000, 3)
+    
+    @staticmethod
+    def _search_case_materials(workflow_input: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """搜索与知识点和场景相关的案例材料（查询与 案例改编.yml 的搜索节点一致），未配置搜索服务时返回 None"""
+        if not search_service.enabled:
+            return None
+        with tracer.span('case.search') as span:
+            search = search_service.search(
+                f"{workflow_input['knowledgePoints']}{workflow_input['caseScenario']}最新案例"
+            )
+            if span is not None:
+                span.set(results=len(search['results']), cached=search['cached'])
+            return search
+    
+    @staticmethod
+    def _compose_search_context(workflow_input: Dict[str, Any], library_cases: Optional[List[Dict[str, Any]]],
+                                search: Optional[Dict[str, Any]]) -> str:
+        """合并案例库检索与网络搜索结果；都没有结果时以场景与知识点说明代替"""
+        sections = []
+        if library_cases:
+            sections.append(f"案例库中的相关案例：\n{case_index.format_context(library_cases)}")
+        if search and search['results']:
+            sections.append(f"网络搜索结果：\n{search_service.format_context(search['results'])}")
+        if sections:
+            return '\n\n'.join(sections)
+        return f"基于{workflow_input['caseScenario']}场景和{workflow_input['knowledgePoints']}知识点的相关案例材料"
+    
+    def _generate_questions(self, workflow_input: Dict[str, Any], case_content: str, stream: bool = False):
         """生成题目"""
         try:
-            prompt = self.prompts['question_generation'].format(
+            parts = self.parse_question_types(workflow_input.get('questionType', ''))
+            if self.get_question_mode(workflow_input) == 'parallel' and len(parts) > 1:
+                return self._generate_questions_parallel(workflow_input, case_content, parts)
+            
+            messages = self._build_messages(
+                'question_generation', workflow_input,
                 case_content=case_content,
                 knowledge_points=workflow_input['knowledgePoints'],
                 question_type=workflow_input['questionType'],
                 learning_objectives=workflow_input['learningObjectives']
             )
+            difficulty_requirement = self._get_difficulty_requirement(workflow_input)
+            if difficulty_requirement:
+                messages.append({"role": "user", "content": difficulty_requirement})
             
-            messages = [{"role": "system", "content": prompt}]
-            
-            api_result = self.openrouter.chat_completion(
-                messages=messages,
-                model_name=workflow_input['model_name'],
-                api_key=workflow_input['api_key'],
-                user_uuid=workflow_input['user_uuid'],
-                session_id=workflow_input['session_id'],
+            return (yield from self._call_llm(
+                messages, workflow_input,
                 request_type='题目生成',
-                workflow_step='question_generation'
-            )
-            
-            if api_result['success']:
-                content = api_result['data']['choices'][0]['message']['content']
-                tokens_used = api_result['data'].get('usage', {}).get('total_tokens', 0)
-                
-                return {
-                    'success': True,
-                    'content': content,
-                    'tokens_used': tokens_used
-                }
-            else:
-                return {
-                    'success': False,
-                    'error': api_result.get('error', 'API调用失败')
-                }
+                workflow_step='question_generation',
+                stream=stream
+            ))
                 
         except Exception as e:
             return {
@@ -282,16 +729,161 @@ class WorkflowEngine:
                 'error': f'题目生成失败: {str(e)}'
             }
     
-    def _optimize_questions_by_difficulty(self, workflow_input: Dict[str, Any], questions: str) -> Dict[str, Any]:
+    @classmethod
+    def parse_question_types(cls, spec: str) -> List[Tuple[str, int]]:
+        """
+        解析题目类型及数量，如 "单选题 3 道 多选题 2 道" -> [('单选题', 3), ('多选题', 2)]
+        
+        同一题型出现多次时合并数量，顺序按首次出现的位置
+        """
+        parts: Dict[str, int] = {}
+        for match in cls.QUESTION_TYPE_PATTERN.finditer(spec or ''):
+            question_type = cls.QUESTION_TYPE_ALIASES.get(match.group(1), match.group(1))
+            count = match.group(2)
+            count = int(count) if count.isdigit() else cls._parse_chinese_number(count)
+            if count > 0:
+                parts[question_type] = parts.get(question_type, 0) + count
+        return list(parts.items())
+    
+    @staticmethod
+    def _parse_chinese_number(text: str) -> int:
+        digits = {'一': 1, '两': 2, '二': 2, '三': 3, '四': 4, '五': 5, '六': 6, '七': 7, '八': 8, '九': 9}
+        if text == '十':
+            return 10
+        if '十' in text:
+            tens, _, ones = text.partition('十')
+            return digits.get(tens, 1) * 10 + digits.get(ones, 0)
+        return digits.get(text, 0)
+    
+    @staticmethod
+    def get_question_mode(workflow_input: Dict[str, Any]) -> str:
+        """
+        题目生成方式：single(一次调用生成全部题目) 或 parallel(按题型拆分并发生成后合并)
+        
+        请求参数 question_generation_mode 优先，其次为配置 QUESTION_GENERATION_MODE
+        """
+        mode = workflow_input.get('question_generation_mode')
+        if mode not in ('single', 'parallel'):
+            try:
+                mode = current_app.config.get('QUESTION_GENERATION_MODE', 'single')
+            except RuntimeError:
+                mode = 'single'
+        return mode
+    
+    @staticmethod
+    def get_difficulty_mode(workflow_input: Dict[str, Any]) -> str:
+        """
+        难度处理方式：single_pass(出题时直接按难度生成) 或 two_pass(先出题，再整套改写为目标难度)
+        
+        请求参数 difficulty_mode 优先，其次为配置 DIFFICULTY_MODE
+        """
+        mode = workflow_input.get('difficulty_mode')
+        if mode not in ('single_pass', 'two_pass'):
+            try:
+                mode = current_app.config.get('DIFFICULTY_MODE', 'single_pass')
+            except RuntimeError:
+                mode = 'single_pass'
+        return mode
+    
+    def _get_difficulty_requirement(self, workflow_input: Dict[str, Any]) -> str:
+        """single_pass 模式下附加在出题请求最后的难度要求，放在最后一条消息中以保留静态前缀"""
+        if self.get_difficulty_mode(workflow_input) != 'single_pass':
+            return ''
+        level = workflow_input.get('difficultyLevel')
+        instruction = self.DIFFICULTY_GENERATION_INSTRUCTIONS.get(level)
+        return f"难度等级：{level}。{instruction}" if instruction else ''
+    
+    def _generate_questions_parallel(self, workflow_input: Dict[str, Any], case_content: str,
+                                     parts: List[Tuple[str, int]]) -> Dict[str, Any]:
+        """
+        按题型拆分并发生成题目，再按要求的题型顺序合并
+        
+        每个题型一次模型调用，输出长度与耗时只取决于最多的一组题目；合并时题号连续，
+        各部分按顺序分配由浅入深的难度。任一部分失败时整体失败。
+        """
+        calls = []
+        start = 1
+        levels = ('基础', '中等', '较高')
+        difficulty_requirement = self._get_difficulty_requirement(workflow_input)
+        for index, (question_type, count) in enumerate(parts):
+            messages = self._build_messages(
+                'question_generation', workflow_input,
+                case_content=case_content,
+                knowledge_points=workflow_input['knowledgePoints'],
+                question_type=f'{question_type}{count}道',
+                learning_objectives=workflow_input['learningObjectives']
+            )
+            level = levels[min(index * len(levels) // len(parts), len(levels) - 1)]
+            # 分片说明放在最后一条消息中，不影响前面静态前缀的缓存命中
+            messages.append({
+                "role": "user",
+                "content": (
+                    f"本次只生成{count}道{question_type}，题号从{start}到{start + count - 1}。"
+                    f"这是整套题目的第{index + 1}部分（共{len(parts)}部分），整套题目难度由浅入深，本部分在整套题目中的相对难度{level}，"
+                    f"本部分内部同样由简单到复杂。{difficulty_requirement}"
+                )
+            })
+            calls.append({
+                'messages': messages,
+                'request_type': '题目生成',
+                'workflow_step': 'question_generation'
+            })
+            start += count
+        
+        results = self._call_llm_many(calls, workflow_input)
+        for (question_type, _), part_result in zip(parts, results):
+            if not part_result['success']:
+                return {'success': False, 'error': f"{question_type}生成失败: {part_result.get('error')}"}
+        
+        contents = []
+        start = 1
+        for (question_type, count), part_result in zip(parts, results):
+            contents.append(self._renumber_questions(part_result['content'], start, count))
+            start += count
+        
+        usage: Dict[str, int] = {}
+        for part_result in results:
+            for key, value in (part_result.get('usage') or {}).items():
+                if isinstance(value, (int, float)):
+                    usage[key] = usage.get(key, 0) + value
+        
+        return {
+            'success': True,
+            'content': '\n\n'.join(content.strip() for content in contents),
+            'tokens_used': sum(part_result.get('tokens_used', 0) for part_result in results),
+            'usage': usage,
+            'cached': all(part_result.get('cached') for part_result in results),
+            'cached_tokens': sum(part_result.get('cached_tokens', 0) for part_result in results),
+            'model_used': results[0].get('model_used'),
+            'parts': [
+                {'question_type': question_type, 'count': count, 'tokens_used': part_result.get('tokens_used', 0)}
+                for (question_type, count), part_result in zip(parts, results)
+            ]
+        }
+    
+    @classmethod
+    def _renumber_questions(cls, content: str, start: int, count: int) -> str:
+        """
+        将一部分题目的题号改为从 start 开始连续编号
+        
+        只有识别出的题号行数量与该部分题目数一致时才改写，否则保留模型输出的题号
+        """
+        matches = list(cls.QUESTION_NUMBER_PATTERN.finditer(content))
+        if len(matches) != count:
+            return content
+        
+        numbers = iter(range(start, start + count))
+        return cls.QUESTION_NUMBER_PATTERN.sub(
+            lambda match: f"{match.group(1)}{next(numbers)}{match.group(3)}", content
+        )
+    
+    def _optimize_questions_by_difficulty(self, workflow_input: Dict[str, Any], questions: str, stream: bool = False):
         """根据难度等级优化题目"""
         try:
             difficulty_level = workflow_input.get('difficultyLevel')
+            instruction = self.DIFFICULTY_INSTRUCTIONS.get(difficulty_level)
             
-            if difficulty_level == '初级':
-                optimization_prompt = f"{questions}\n\n题目太复杂了，请简化部分题目，降低题目难度，使其更适合初学者。保证题目类型和数量不变。"
-            elif difficulty_level == '高级':
-                optimization_prompt = f"{questions}\n\n题目太简单了，请替换部分题目，提升题目复杂度和难度，要求选项之间具有混淆度，不能是一眼就能看出答案的。保证题目类型和数量不变。"
-            else:
+            if instruction is None:
                 # 中级或无特殊要求，返回原题目
                 return {
                     'success': True,
@@ -299,33 +891,31 @@ class WorkflowEngine:
                     'tokens_used': 0
                 }
             
-            messages = [{"role": "user", "content": optimization_prompt}]
+            if self.get_prompt_layout(workflow_input) == 'legacy':
+                messages = [{"role": "user", "content": f"{questions}\n\n{instruction}"}]
+            else:
+                # 优化要求作为固定前缀，题目放在其后
+                messages = [
+                    {"role": "system", "content": instruction},
+                    {"role": "user", "content": questions}
+                ]
             
-            api_result = self.openrouter.chat_completion(
-                messages=messages,
-                model_name=workflow_input['model_name'],
-                api_key=workflow_input['api_key'],
-                user_uuid=workflow_input['user_uuid'],
-                session_id=workflow_input['session_id'],
+            api_result = yield from self._call_llm(
+                messages, workflow_input,
                 request_type='题目优化',
-                workflow_step=f'question_optimization_{difficulty_level}'
+                workflow_step=f'question_optimization_{difficulty_level}',
+                stream=stream
             )
             
             if api_result['success']:
-                content = api_result['data']['choices'][0]['message']['content']
-                tokens_used = api_result['data'].get('usage', {}).get('total_tokens', 0)
-                
-                return {
-                    'success': True,
-                    'content': content,
-                    'tokens_used': tokens_used
-                }
+                return api_result
             else:
-                # 如果优化失败，返回原题目
+                # 如果优化失败，返回原题目（不保存为步骤输出，下次重新优化）
                 return {
                     'success': True,
                     'content': questions,
-                    'tokens_used': 0
+                    'tokens_used': 0,
+                    'degraded': True
                 }
                 
         except Exception as e:
@@ -333,23 +923,63 @@ class WorkflowEngine:
             return {
                 'success': True,
                 'content': questions,
-                'tokens_used': 0
+                'tokens_used': 0,
+                'degraded': True
             }
     
-    def regenerate_case(self, data: Dict[str, Any], user) -> Dict[str, Any]:
-        """重新生成案例"""
-        # 这里可以实现重新生成的逻辑
-        # 暂时返回占位符
-        return {
-            'content': '重新生成的案例内容',
-            'tokens_used': 0
-        }
+    # 可重新生成的步骤：请求中的名称 -> (工作流步骤, 结果字段)
+    REGENERATION_STEPS = {
+        'case': ('case_generation', 'case_content'),
+        'questions': ('question_generation', 'questions')
+    }
     
-    def regenerate_questions(self, data: Dict[str, Any], user) -> Dict[str, Any]:
-        """重新生成题目"""
-        # 这里可以实现重新生成的逻辑
-        # 暂时返回占位符
-        return {
-            'content': '重新生成的题目内容',
-            'tokens_used': 0
-        } 
\ No newline at end of file
+    def regenerate_case(self, workflow_input: Dict[str, Any],
+                        memo: Dict[str, Dict[str, Any]] = None) -> Dict[str, Any]:
+        """重新生成案例，依赖案例内容的题目随之重新生成"""
+        return self._collect_result(self.iter_regeneration_events(workflow_input, 'case', memo))
+    
+    def regenerate_questions(self, workflow_input: Dict[str, Any],
+                             memo: Dict[str, Dict[str, Any]] = None) -> Dict[str, Any]:
+        """重新生成题目，输入未变化时复用已保存的案例内容"""
+        return self._collect_result(self.iter_regeneration_events(workflow_input, 'questions', memo))
+    
+    @staticmethod
+    def _collect_result(events: Iterator[Dict[str, Any]]) -> Dict[str, Any]:
+        result = None
+        for event in events:
+            if event['event'] == 'workflow_finished':
+                result = event['result']
+        return result
+    
+    def iter_regeneration_events(self, workflow_input: Dict[str, Any], target: str,
+                                 memo: Dict[str, Dict[str, Any]] = None,
+                                 stream: bool = False) -> Iterator[Dict[str, Any]]:
+        """
+        重新执行指定步骤及其下游步骤并逐步产出事件
+        
+        上游步骤的输入哈希与已保存的输出一致时直接复用，不再调用模型；
+        重新生成按内置流程的步骤执行（DSL工作流的节点不参与复用）。
+        workflow_finished 事件的 result 中 content 为目标步骤的输出。
+        """
+        step, output_field = self.REGENERATION_STEPS[target]
+        if target == 'questions':
+            if not workflow_input.get('questionType'):
+                yield {'event': 'workflow_finished',
+                       'result': {'success': False, 'error': '缺少题目类型，无法生成题目', 'content': None}}
+                return
+            workflow_input = {**workflow_input, 'yes_or_no': '是'}
+        
+        step_error = None
+        events = self.iter_workflow_events(
+            {**workflow_input, 'engine': 'builtin'}, stream=stream, memo=memo, force_steps=(step,)
+        )
+        for event in events:
+            if event['event'] == 'step_failed' and event['step'] == step:
+                step_error = event['error']
+            elif event['event'] == 'workflow_finished':
+                result = event['result']
+                result['content'] = result.get(output_field)
+                if result['success'] and result['content'] is None:
+                    result['success'] = False
+                    result['error'] = step_error or '重新生成失败'
+            yield event
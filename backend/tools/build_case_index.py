@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+案例库BM25索引构建工具
+
+离线为 cases 表建立索引快照（默认 instance/case_index.json），服务启动时加载快照后
+只需补充索引新增或修改过的案例。也可用 --query 检查检索效果。
+
+用法:
+    # 增量更新快照（只索引新增或修改过的案例）
+    python tools/build_case_index.py
+
+    # 清空后全量重建
+    python tools/build_case_index.py --rebuild
+
+    # 查看检索结果
+    python tools/build_case_index.py --query "供应链管理 制造企业" --top-k 5
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='构建案例库BM25索引快照')
+    parser.add_argument('--path', default=None, help='索引快照路径（默认读取 CASE_INDEX_PATH 配置）')
+    parser.add_argument('--rebuild', action='store_true', help='清空后全量重建')
+    parser.add_argument('--query', default=None, help='构建后执行一次检索')
+    parser.add_argument('--top-k', type=int, default=3, help='检索返回的案例数')
+    parser.add_argument('--user-uuid', default=None, help='检索时可见的私有案例所属用户')
+    args = parser.parse_args()
+
+    if args.path:
+        os.environ['CASE_INDEX_PATH'] = args.path
+    # 构建索引不需要后台任务线程
+    os.environ.setdefault('JOB_WORKERS', '0')
+
+    from app import create_app
+    from app.services.case_index import case_index
+
+    started = time.time()
+    app = create_app()
+    with app.app_context():
+        if args.rebuild:
+            case_index.rebuild()
+        case_index.save_snapshot()
+    stats = case_index.get_stats()
+    print(f"✅ 索引案例 {stats['documents']} 个，词项 {stats['terms']} 个，"
+          f"本次更新 {stats['synced']} 个，用时 {time.time() - started:.2f}s")
+    print(f"📄 快照: {stats['snapshot_path']}")
+
+    if args.query:
+        for item in case_index.search(args.query, top_k=args.top_k, user_uuid=args.user_uuid):
+            print(f"  [{item['score']:.3f}] #{item['id']} {item['title']}（{item['case_scenario'] or '-'}）")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+题目难度处理方式对比工具
+
+对同一组输入分别以 two_pass（出题后再改写难度）和 single_pass（出题时直接按难度生成）
+执行工作流，报告端到端延迟、token用量和题目格式合规率（题目数量、选项、答案、解析）。
+
+用法:
+    # 使用本地模拟服务（模拟服务按题目数量回复格式化题目，合规率只验证流程本身）
+    python tools/compare_difficulty.py --spawn --runs 5
+
+    # 对比真实模型的输出质量（消耗真实token）
+    python tools/compare_difficulty.py --target http://127.0.0.1:8865 --user-uuid <用户UUID> --runs 5
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+import requests
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, TOOLS_DIR)
+sys.path.insert(0, os.path.dirname(TOOLS_DIR))
+from loadtest import SpawnedBackend, free_port, percentile  # noqa: E402
+from mock_openrouter import add_mock_arguments, mock_options, start_server  # noqa: E402
+from app.services.workflow_engine import WorkflowEngine  # noqa: E402
+
+MODES = ('two_pass', 'single_pass')
+CHOICE_TYPES = ('单选题', '多选题')
+
+
+def check_format(questions: str, spec: List[Tuple[str, int]]) -> Dict[str, bool]:
+    """检查题目数量、单选/多选题的选项、每题的答案与解析"""
+    expected = sum(count for _, count in spec)
+    choice_count = sum(count for question_type, count in spec if question_type in CHOICE_TYPES)
+    numbered = len(WorkflowEngine.QUESTION_NUMBER_PATTERN.findall(questions))
+    options = len(re.findall(r'^\s*(?:\*\*)?\s*[A-D]\s*[.、．:：)）]', questions, re.MULTILINE))
+    answers = len(re.findall(r'答案\s*(?:\*\*)?\s*[:：]', questions))
+    explanations = len(re.findall(r'解析\s*(?:\*\*)?\s*[:：]', questions))
+    return {
+        'count': numbered == expected,
+        'options': options >= 4 * choice_count,
+        'answers': answers >= expected,
+        'explanations': explanations >= expected
+    }
+
+
+def run_once(target: str, user_uuid: str, mode: str, level: str, question_type: str,
+             timeout: float) -> Dict:
+    payload = {
+        'user_uuid': user_uuid,
+        'knowledgePoints': '供应链管理',
+        'learningObjectives': '掌握核心概念并能够分析实际问题',
+        'caseScenario': f"制造企业 #{uuid.uuid4().hex[:8]}",
+        'caseMaterials': '',
+        'yes_or_no': '是',
+        'questionType': question_type,
+        'difficultyLevel': level,
+        'difficulty_mode': mode,
+        'use_cache': False
+    }
+    started = time.time()
+    try:
+        response = requests.post(f"{target.rstrip('/')}/api/workflow/execute", json=payload, timeout=timeout)
+        data = response.json()
+    except (requests.RequestException, ValueError) as e:
+        return {'ok': False, 'latency': time.time() - started, 'error': str(e)}
+
+    latency = time.time() - started
+    questions = data.get('questions') or ''
+    if response.status_code != 200 or not questions:
+        return {'ok': False, 'latency': latency, 'error': data.get('error') or f'HTTP {response.status_code}'}
+    return {
+        'ok': True,
+        'latency': latency,
+        'tokens': data.get('tokens_used', 0),
+        'checks': check_format(questions, WorkflowEngine.parse_question_types(question_type))
+    }
+
+
+def summarize(results: List[Dict]) -> Dict:
+    succeeded = [item for item in results if item['ok']]
+    latencies = [item['latency'] for item in succeeded]
+    summary = {
+        'runs': len(results),
+        'errors': len(results) - len(succeeded),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1) if latencies else None,
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1) if latencies else None,
+        'mean_tokens': round(sum(item['tokens'] for item in succeeded) / len(succeeded), 1) if succeeded else None,
+        'compliance': round(sum(all(item['checks'].values()) for item in succeeded) / len(succeeded), 3)
+        if succeeded else None
+    }
+    for check in ('count', 'options', 'answers', 'explanations'):
+        summary[f'{check}_rate'] = (
+            round(sum(item['checks'][check] for item in succeeded) / len(succeeded), 3) if succeeded else None
+        )
+    return summary
+
+
+def print_report(report: Dict[str, Dict[str, Dict]]):
+    header = (f"{'方式':<13}{'难度':<6}{'次数':>6}{'失败':>6}{'p50(ms)':>10}{'p95(ms)':>10}"
+              f"{'平均token':>11}{'合规率':>9}{'数量':>7}{'选项':>7}{'答案':>7}{'解析':>7}")
+    print('\n' + header)
+    print('-' * 100)
+    for mode, levels in report.items():
+        for level, item in levels.items():
+            print(f"{mode:<13}{level:<6}{item['runs']:>6}{item['errors']:>6}{item['p50_ms'] or '-':>10}"
+                  f"{item['p95_ms'] or '-':>10}{item['mean_tokens'] or '-':>11}{item['compliance'] or 0:>9.1%}"
+                  f"{item['count_rate'] or 0:>7.0%}{item['options_rate'] or 0:>7.0%}"
+                  f"{item['answers_rate'] or 0:>7.0%}{item['explanations_rate'] or 0:>7.0%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='对比题目难度处理方式（two_pass / single_pass）')
+    parser.add_argument('--target', default='http://127.0.0.1:8865', help='后端地址（--spawn 时忽略）')
+    parser.add_argument('--spawn', action='store_true', help='自动启动模拟服务和临时后端进程')
+    parser.add_argument('--user-uuid', default=None, help='已配置API密钥的用户UUID（--spawn 时自动创建）')
+    parser.add_argument('--runs', type=int, default=5, help='每种方式、每个难度的执行次数')
+    parser.add_argument('--levels', default='初级,高级', help='对比的难度等级，逗号分隔')
+    parser.add_argument('--question-type', default='单选题 3 道 多选题 2 道 判断题 3 道', help='题目类型及数量')
+    parser.add_argument('--timeout', type=float, default=300.0, help='单次请求超时(秒)')
+    parser.add_argument('--output', default=None, help='将结果写入JSON文件')
+    add_mock_arguments(parser)
+    parser.set_defaults(question_chars=150, decode_interval=0.004, latency='fixed:300')
+    args = parser.parse_args()
+
+    mock_server = None
+    backend = None
+    target = args.target
+    user_uuid: Optional[str] = args.user_uuid
+
+    try:
+        if args.spawn:
+            mock_port = free_port()
+            mock_server = start_server('127.0.0.1', mock_port, **mock_options(args))
+            backend = SpawnedBackend(f"http://127.0.0.1:{mock_port}/api/v1")
+            backend.start()
+            target = backend.url
+            user_uuid = backend.create_users(1)[0]
+            print(f"🧪 模拟服务: 127.0.0.1:{mock_port}  后端: {target}  工作目录: {backend.workdir}")
+        elif not user_uuid:
+            parser.error('未使用 --spawn 时需要 --user-uuid')
+
+        levels = [level.strip() for level in args.levels.split(',') if level.strip()]
+        report: Dict[str, Dict[str, Dict]] = {}
+        for mode in MODES:
+            report[mode] = {}
+            for level in levels:
+                results = [
+                    run_once(target, user_uuid, mode, level, args.question_type, args.timeout)
+                    for _ in range(args.runs)
+                ]
+                report[mode][level] = summarize(results)
+                print(f"✅ {mode} / {level}: {report[mode][level]}")
+
+        print_report(report)
+        if mock_server is not None:
+            print(f"模拟服务: {dict(mock_server.RequestHandlerClass.state.stats)}")
+
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump({'config': vars(args), 'report': report}, f, ensure_ascii=False, indent=2)
+            print(f"📄 结果已写入 {args.output}")
+    finally:
+        if backend is not None:
+            backend.stop()
+        if mock_server is not None:
+            mock_server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
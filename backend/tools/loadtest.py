@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""
+后端端到端压测工具
+
+以指定并发驱动工作流执行接口和只读接口，统计吞吐量、p50/p95/p99 延迟、错误率，
+并从 /api/admin/stats/runtime 读取 SQLite 提交耗时与锁等待。
+
+用法:
+    # 自动启动模拟服务和一个使用临时数据库的后端进程（推荐，不消耗真实token）
+    python tools/loadtest.py --spawn --concurrency 16 --duration 60
+
+    # 压测已在运行的后端（后端需配置 OPENROUTER_BASE_URL 指向模拟服务）
+    python tools/loadtest.py --target http://127.0.0.1:8865 --admin-uuid <管理员UUID>
+
+    # 调整请求构成：场景名:权重
+    python tools/loadtest.py --spawn --mix execute:1,cases:3,status:1
+"""
+
+import argparse
+import json
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import requests
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+from mock_openrouter import add_mock_arguments, mock_options, start_server  # noqa: E402
+from app.services.stats import percentile  # noqa: E402
+
+KNOWLEDGE_POINTS = ['供应链管理', '市场营销', '财务分析', '人力资源管理', '项目管理', '数字化转型']
+SCENARIOS = ['制造企业', '连锁零售', '互联网平台', '跨境电商', '医疗机构', '物流公司']
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class LoadTest:
+    """按权重随机选择场景、以固定并发发送请求并记录每个请求的结果"""
+
+    def __init__(self, target: str, users: List[str], mix: Dict[str, int], use_cache: bool = False,
+                 timeout: float = 120.0, prompt_layout: str = None, question_mode: str = None,
+                 question_type: str = '单选题 3 道 判断题 2 道'):
+        self.target = target.rstrip('/')
+        self.users = users
+        self.mix = mix
+        self.use_cache = use_cache
+        self.prompt_layout = prompt_layout
+        self.question_mode = question_mode
+        self.question_type = question_type
+        self.timeout = timeout
+
+        self.results: List[tuple] = []  # (场景, 开始时间, 耗时, 是否成功, 状态码)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _session(self) -> requests.Session:
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _workflow_payload(self) -> Dict:
+        payload = {
+            'user_uuid': random.choice(self.users),
+            'knowledgePoints': random.choice(KNOWLEDGE_POINTS),
+            'learningObjectives': '掌握核心概念并能够分析实际问题',
+            'caseScenario': random.choice(SCENARIOS),
+            'caseMaterials': '',
+            'yes_or_no': random.choice(['是', '否']),
+            'questionType': self.question_type,
+            'difficultyLevel': random.choice(['初级', '中级', '高级'])
+        }
+        if not self.use_cache:
+            # 每次请求使用不同输入并跳过响应缓存（题目生成等步骤的提示词不含案例场景）
+            payload['caseScenario'] += f" #{uuid.uuid4().hex[:8]}"
+            payload['use_cache'] = False
+        if self.prompt_layout:
+            payload['prompt_layout'] = self.prompt_layout
+        if self.question_mode:
+            # 对比题目生成方式时每个请求都生成题目
+            payload['question_generation_mode'] = self.question_mode
+            payload['yes_or_no'] = '是'
+        return payload
+
+    def _run_scenario(self, scenario: str) -> requests.Response:
+        session = self._session()
+        user_uuid = random.choice(self.users)
+
+        if scenario == 'execute':
+            return session.post(f"{self.target}/api/workflow/execute",
+                                json=self._workflow_payload(), timeout=self.timeout)
+        if scenario == 'stream':
+            response = session.post(f"{self.target}/api/workflow/execute/stream",
+                                    json=self._workflow_payload(), timeout=self.timeout, stream=True)
+            for _ in response.iter_content(chunk_size=None):
+                pass
+            return response
+        if scenario == 'cases':
+            return session.get(f"{self.target}/api/cases/public", params={'per_page': 10}, timeout=self.timeout)
+        if scenario == 'search':
+            return session.get(f"{self.target}/api/cases/search",
+                               params={'q': random.choice(KNOWLEDGE_POINTS)}, timeout=self.timeout)
+        if scenario == 'user_cases':
+            return session.get(f"{self.target}/api/cases/user/{user_uuid}", timeout=self.timeout)
+        if scenario == 'profile':
+            return session.get(f"{self.target}/api/auth/profile/{user_uuid}", timeout=self.timeout)
+        if scenario == 'status':
+            return session.get(f"{self.target}/api/workflow/status", timeout=self.timeout)
+        raise ValueError(f'未知场景: {scenario}')
+
+    def _worker(self, deadline: float, remaining: Optional[List[int]]):
+        scenarios = list(self.mix.keys())
+        weights = list(self.mix.values())
+        while time.time() < deadline:
+            if remaining is not None:
+                with self._lock:
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+
+            scenario = random.choices(scenarios, weights)[0]
+            start = time.time()
+            try:
+                response = self._run_scenario(scenario)
+                status = response.status_code
+                ok = status < 400
+            except requests.RequestException:
+                status = None
+                ok = False
+
+            with self._lock:
+                self.results.append((scenario, start, time.time() - start, ok, status))
+
+    def run(self, concurrency: int, duration: float, total_requests: Optional[int] = None) -> float:
+        """执行压测，返回实际耗时（秒）"""
+        deadline = time.time() + duration
+        remaining = [total_requests] if total_requests else None
+        threads = [
+            threading.Thread(target=self._worker, args=(deadline, remaining), daemon=True)
+            for _ in range(concurrency)
+        ]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.time() - start
+
+
+def summarize(results: List[tuple], elapsed: float) -> Dict:
+    groups = defaultdict(list)
+    for result in results:
+        groups[result[0]].append(result)
+    groups['total'] = list(results)
+
+    summary = {}
+    for scenario, items in groups.items():
+        latencies = [item[2] for item in items]
+        errors = [item for item in items if not item[3]]
+        status_codes = defaultdict(int)
+        for item in errors:
+            status_codes[str(item[4] or 'exception')] += 1
+        summary[scenario] = {
+            'requests': len(items),
+            'errors': len(errors),
+            'error_rate': round(len(errors) / len(items), 4) if items else 0.0,
+            'throughput_rps': round(len(items) / elapsed, 2) if elapsed else 0.0,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 1) if latencies else None,
+            'p95_ms': round(percentile(latencies, 95) * 1000, 1) if latencies else None,
+            'p99_ms': round(percentile(latencies, 99) * 1000, 1) if latencies else None,
+            'error_status': dict(status_codes)
+        }
+    return summary
+
+
+def fetch_runtime_stats(target: str, admin_uuid: Optional[str]) -> Optional[Dict]:
+    if not admin_uuid:
+        return None
+    try:
+        response = requests.get(f"{target.rstrip('/')}/api/admin/stats/runtime",
+                                headers={'X-Admin-UUID': admin_uuid}, timeout=10)
+        return response.json() if response.status_code == 200 else None
+    except requests.RequestException:
+        return None
+
+
+def database_delta(before: Optional[Dict], after: Optional[Dict]) -> Optional[Dict]:
+    """压测期间的数据库提交与锁等待统计"""
+    if not after or 'database' not in after:
+        return None
+    start = (before or {}).get('database', {})
+    end = after['database']
+    return {
+        'commits': end['commits'] - start.get('commits', 0),
+        'lock_waits': end['lock_waits'] - start.get('lock_waits', 0),
+        'lock_errors': end['lock_errors'] - start.get('lock_errors', 0),
+        'commit_p50_ms': end.get('commit_p50_ms'),
+        'commit_p95_ms': end.get('commit_p95_ms'),
+        'max_commit_ms': end.get('max_commit_ms'),
+        'slow_commit_ms': end.get('slow_commit_ms')
+    }
+
+
+def print_report(summary: Dict, database: Optional[Dict], mock_stats: Optional[Dict]):
+    header = f"{'场景':<12}{'请求数':>8}{'错误率':>9}{'吞吐(rps)':>11}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}"
+    print('\n' + header)
+    print('-' * 72)
+    for scenario in sorted(summary, key=lambda name: (name == 'total', name)):
+        item = summary[scenario]
+        print(f"{scenario:<14}{item['requests']:>8}{item['error_rate'] * 100:>8.2f}%{item['throughput_rps']:>11}"
+              f"{item['p50_ms'] or '-':>10}{item['p95_ms'] or '-':>10}{item['p99_ms'] or '-':>10}")
+        if item['error_status']:
+            print(f"{'':<14}错误状态: {item['error_status']}")
+
+    if database:
+        print(f"\nSQLite: 提交 {database['commits']} 次，锁等待(>{database['slow_commit_ms']}ms) "
+              f"{database['lock_waits']} 次，锁错误 {database['lock_errors']} 次，"
+              f"提交 p50 {database['commit_p50_ms']}ms / p95 {database['commit_p95_ms']}ms / "
+              f"最大 {database['max_commit_ms']}ms")
+    else:
+        print('\nSQLite: 未获取到运行时指标（需要 --admin-uuid 或 --spawn）')
+
+    if mock_stats:
+        print(f"模拟服务: {mock_stats}")
+
+
+class SpawnedBackend:
+    """使用临时数据库启动后端子进程，OpenRouter 请求发送到本地模拟服务"""
+
+    def __init__(self, mock_url: str, env_overrides: Dict[str, str] = None):
+        self.workdir = tempfile.mkdtemp(prefix='case-creator-loadtest-')
+        self.db_path = os.path.join(self.workdir, 'loadtest.db')
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.env = dict(
+            os.environ,
+            BACKEND_PORT=str(self.port),
+            FLASK_DEBUG='false',
+            DATABASE_URL=f"sqlite:///{self.db_path}",
+            OPENROUTER_BASE_URL=mock_url,
+            OPENROUTER_API_KEY='mock-key',
+            LLM_CACHE_PATH=os.path.join(self.workdir, 'llm_cache.db'),
+            USAGE_SPILL_PATH=os.path.join(self.workdir, 'usage_spill.jsonl'),
+            MODEL_CATALOG_SNAPSHOT=os.path.join(self.workdir, 'model_catalog.json'),
+            # 压测少量用户的大量请求会触发用户配额，默认关闭
+            QUOTA_ENABLED='false',
+            **(env_overrides or {})
+        )
+        self.process = None
+
+    def start(self, timeout: float = 30.0):
+        log = open(os.path.join(self.workdir, 'backend.log'), 'w')
+        self.process = subprocess.Popen(
+            [sys.executable, 'run.py'], cwd=BACKEND_DIR, env=self.env, stdout=log, stderr=subprocess.STDOUT
+        )
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"后端启动失败，日志: {log.name}")
+            try:
+                requests.get(f"{self.url}/api/workflow/status", timeout=1)
+                return
+            except requests.RequestException:
+                time.sleep(0.2)
+        raise RuntimeError(f"后端启动超时，日志: {log.name}")
+
+    def create_users(self, count: int) -> List[str]:
+        users = []
+        for _ in range(count):
+            user_uuid = str(uuid.uuid4())
+            requests.post(f"{self.url}/api/auth/register",
+                          json={'uuid': user_uuid, 'api_key': 'mock-key'}, timeout=10)
+            users.append(user_uuid)
+        return users
+
+    def make_admin(self, user_uuid: str):
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute('UPDATE users SET is_admin = 1 WHERE uuid = ?', (user_uuid,))
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+def parse_mix(value: str) -> Dict[str, int]:
+    mix = {}
+    for item in value.split(','):
+        name, _, weight = item.partition(':')
+        mix[name.strip()] = int(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description='案例改编专家后端压测')
+    parser.add_argument('--target', default='http://127.0.0.1:8865', help='后端地址（--spawn 时忽略）')
+    parser.add_argument('--spawn', action='store_true', help='自动启动模拟服务和临时后端进程')
+    parser.add_argument('--concurrency', type=int, default=8, help='并发数')
+    parser.add_argument('--duration', type=float, default=30.0, help='压测时长(秒)')
+    parser.add_argument('--requests', type=int, default=None, help='总请求数（达到后提前结束）')
+    parser.add_argument('--mix', default='execute:2,cases:3,search:2,user_cases:2,profile:1,status:1',
+                        help='场景权重: execute/stream/cases/search/user_cases/profile/status')
+    parser.add_argument('--users', type=int, default=20, help='模拟用户数')
+    parser.add_argument('--use-cache', action='store_true', help='允许重复输入命中响应缓存')
+    parser.add_argument('--prompt-layout', choices=['prefix', 'legacy'], default=None,
+                        help='工作流请求使用的提示词布局（默认使用后端配置）')
+    parser.add_argument('--question-mode', choices=['single', 'parallel'], default=None,
+                        help='题目生成方式（默认使用后端配置）')
+    parser.add_argument('--question-type', default='单选题 3 道 判断题 2 道', help='工作流请求的题目类型及数量')
+    parser.add_argument('--admin-uuid', default=None, help='管理员UUID，用于读取运行时指标')
+    parser.add_argument('--mock-port', type=int, default=None, help='模拟服务端口（--spawn 时默认随机）')
+    parser.add_argument('--output', default=None, help='将结果写入JSON文件')
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    mock_server = None
+    backend = None
+    target = args.target
+    admin_uuid = args.admin_uuid
+    users = [str(uuid.uuid4()) for _ in range(args.users)]
+
+    try:
+        if args.spawn:
+            mock_port = args.mock_port or free_port()
+            mock_server = start_server('127.0.0.1', mock_port, **mock_options(args))
+            backend = SpawnedBackend(f"http://127.0.0.1:{mock_port}/api/v1")
+            backend.start()
+            target = backend.url
+            users = backend.create_users(args.users)
+            admin_uuid = users[0]
+            backend.make_admin(admin_uuid)
+            print(f"🧪 模拟服务: 127.0.0.1:{mock_port}  后端: {target}  工作目录: {backend.workdir}")
+
+        print(f"🚀 压测开始: 并发 {args.concurrency}，时长 {args.duration}s，场景 {args.mix}")
+        before = fetch_runtime_stats(target, admin_uuid)
+        load_test = LoadTest(target, users, parse_mix(args.mix), use_cache=args.use_cache,
+                             prompt_layout=args.prompt_layout, question_mode=args.question_mode,
+                             question_type=args.question_type)
+        elapsed = load_test.run(args.concurrency, args.duration, args.requests)
+        after = fetch_runtime_stats(target, admin_uuid)
+
+        summary = summarize(load_test.results, elapsed)
+        database = database_delta(before, after)
+        mock_stats = None
+        if mock_server is not None:
+            mock_stats = dict(mock_server.RequestHandlerClass.state.stats)
+
+        print_report(summary, database, mock_stats)
+
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'config': vars(args),
+                    'elapsed_seconds': round(elapsed, 2),
+                    'summary': summary,
+                    'database': database,
+                    'runtime_stats': after,
+                    'mock_stats': mock_stats
+                }, f, ensure_ascii=False, indent=2)
+            print(f"📄 结果已写入 {args.output}")
+    finally:
+        if backend is not None:
+            backend.stop()
+        if mock_server is not None:
+            mock_server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+"""
+OpenRouter 本地模拟服务
+
+兼容 OpenAI/OpenRouter 的 /chat/completions（含SSE流式）、/models 和 /auth/key 接口，
+用于压测和本地联调，不消耗真实token。
+
+用法:
+    python tools/mock_openrouter.py --port 18080 --latency lognormal:800:0.5 --error-429 0.05
+
+后端指向模拟服务:
+    OPENROUTER_BASE_URL=http://127.0.0.1:18080/api/v1 python run.py
+
+运行时可通过 POST /__config 修改故障注入参数，GET /__stats 查看请求统计。
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+
+MOCK_MODELS = [
+    ('openai/gpt-4o', 'OpenAI: GPT-4o', 128000, '0.0000025', '0.00001'),
+    ('openai/gpt-4o-mini', 'OpenAI: GPT-4o-mini', 128000, '0.00000015', '0.0000006'),
+    ('anthropic/claude-3-opus', 'Anthropic: Claude 3 Opus', 200000, '0.000015', '0.000075'),
+    ('anthropic/claude-3-sonnet', 'Anthropic: Claude 3 Sonnet', 200000, '0.000003', '0.000015'),
+    ('anthropic/claude-3-haiku', 'Anthropic: Claude 3 Haiku', 200000, '0.00000025', '0.00000125')
+]
+
+SAMPLE_TEXT = (
+    '案例主题：智慧仓储的转型之路\n\n'
+    '某制造企业在业务扩张过程中面临库存周转缓慢、订单交付延迟等问题。'
+    '管理层需要在自建智能仓储系统与外包第三方物流之间作出选择，'
+    '并权衡投资回报、实施风险与组织变革成本。'
+)
+
+
+def parse_latency(spec: str):
+    """
+    解析延迟分布，单位毫秒
+
+    fixed:500 / uniform:200:800 / normal:500:100 / lognormal:500:0.5（中位数, sigma）
+    """
+    parts = spec.split(':')
+    kind = parts[0]
+    values = [float(value) for value in parts[1:]]
+
+    if kind == 'fixed':
+        return lambda: values[0] / 1000
+    if kind == 'uniform':
+        return lambda: random.uniform(values[0], values[1]) / 1000
+    if kind == 'normal':
+        return lambda: max(random.gauss(values[0], values[1]), 0) / 1000
+    if kind == 'lognormal':
+        return lambda: random.lognormvariate(math.log(values[0]), values[1]) / 1000
+    raise ValueError(f'未知的延迟分布: {spec}')
+
+
+class MockState:
+    """模拟服务的配置与统计（线程安全）"""
+
+    def __init__(self, latency: str = 'fixed:0', token_interval: float = 0.0,
+                 error_429: float = 0.0, error_5xx: float = 0.0, timeout_rate: float = 0.0,
+                 timeout_seconds: float = 60.0, retry_after: Optional[float] = 1.0,
+                 completion_chars: int = 400, prefix_cache_min_tokens: int = 0,
+                 question_chars: int = 0, decode_interval: float = 0.0):
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'streams': 0, 'errors_429': 0, 'errors_5xx': 0, 'timeouts': 0,
+                      'cached_prompt_tokens': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+        self._seen_prefixes = set()
+        self.configure(
+            latency=latency, token_interval=token_interval, error_429=error_429,
+            error_5xx=error_5xx, timeout_rate=timeout_rate, timeout_seconds=timeout_seconds,
+            retry_after=retry_after, completion_chars=completion_chars,
+            prefix_cache_min_tokens=prefix_cache_min_tokens, question_chars=question_chars,
+            decode_interval=decode_interval
+        )
+
+    def configure(self, **options):
+        with self.lock:
+            for key, value in options.items():
+                if key == 'latency':
+                    self.latency_spec = value
+                    self.sample_latency = parse_latency(value)
+                else:
+                    setattr(self, key, value)
+
+    def get_config(self) -> Dict:
+        with self.lock:
+            return {
+                'latency': self.latency_spec,
+                'token_interval': self.token_interval,
+                'error_429': self.error_429,
+                'error_5xx': self.error_5xx,
+                'timeout_rate': self.timeout_rate,
+                'timeout_seconds': self.timeout_seconds,
+                'retry_after': self.retry_after,
+                'completion_chars': self.completion_chars,
+                'prefix_cache_min_tokens': self.prefix_cache_min_tokens,
+                'question_chars': self.question_chars,
+                'decode_interval': self.decode_interval
+            }
+
+    def count(self, key: str):
+        with self.lock:
+            self.stats[key] += 1
+
+    def cached_prefix_tokens(self, messages: list) -> int:
+        """
+        模拟服务端提示词前缀缓存：返回与之前请求相同的最长消息前缀的token数
+
+        以消息为边界匹配前缀，不足 prefix_cache_min_tokens 时不命中，命中部分按128 token取整。
+        """
+        if not self.prefix_cache_min_tokens:
+            return 0
+
+        digest = hashlib.sha256()
+        prefixes = []
+        tokens = 0
+        for message in messages:
+            text = str(message.get('content', ''))
+            digest.update(f"{message.get('role')}\x00{text}\x00".encode('utf-8'))
+            tokens += estimate_tokens(text)
+            prefixes.append((digest.hexdigest(), tokens))
+
+        with self.lock:
+            cached = max((tokens for key, tokens in prefixes if key in self._seen_prefixes), default=0)
+            if len(self._seen_prefixes) > 100000:
+                self._seen_prefixes.clear()
+            self._seen_prefixes.update(key for key, _ in prefixes)
+            if cached < self.prefix_cache_min_tokens:
+                return 0
+            cached = cached // 128 * 128
+            self.stats['cached_prompt_tokens'] += cached
+        return cached
+
+    def question_count(self, messages: list) -> int:
+        """
+        启用 question_chars 时识别出题请求的题目数量
+
+        从最后一条非系统消息向前查找"N道"；改写题目的请求按其中的题号行计数
+        """
+        if not self.question_chars:
+            return 0
+        for message in reversed(messages):
+            if message.get('role') == 'system':
+                continue
+            content = str(message.get('content', ''))
+            counts = re.findall(r'(\d+)\s*道', content)
+            if counts:
+                return sum(int(count) for count in counts)
+            numbered = re.findall(r'^\s*\d+\s*[.、．]', content, re.MULTILINE)
+            if numbered:
+                return len(numbered)
+        return 0
+
+    def question_text(self, count: int) -> str:
+        """按题目数量生成带选项、答案与解析的题目，每道题约 question_chars 个字符"""
+        items = []
+        for number in range(1, count + 1):
+            item = (f"{number}. 在智慧仓储转型中，企业应优先考虑的因素是（）。\n"
+                    f"A. 投资回报\nB. 实施风险\nC. 组织变革成本\nD. 以上都是\n答案：D\n解析：")
+            padding = max(self.question_chars - len(item), 0)
+            items.append(item + (SAMPLE_TEXT.replace('\n', '') * (padding // len(SAMPLE_TEXT) + 1))[:padding])
+        return '\n\n'.join(items)
+
+    def pick_fault(self) -> Optional[str]:
+        """按配置的概率选择本次请求注入的故障"""
+        roll = random.random()
+        with self.lock:
+            for fault, rate in (('timeout', self.timeout_rate), ('429', self.error_429), ('5xx', self.error_5xx)):
+                if roll < rate:
+                    return fault
+                roll -= rate
+        return None
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算token数：中文字符按1个，其余按4个字符1个"""
+    cjk = sum(1 for char in text if '\u2e80' <= char <= '\u9fff')
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state: MockState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, payload: Dict, headers: Dict = None):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self) -> Dict:
+        length = int(self.headers.get('Content-Length', 0))
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def _path(self) -> str:
+        return self.path.split('?')[0].rstrip('/')
+
+    def do_GET(self):
+        path = self._path()
+        if path.endswith('/models'):
+            self._send_json(200, {'data': [
+                {
+                    'id': model_id,
+                    'name': name,
+                    'context_length': context_length,
+                    'pricing': {'prompt': prompt_price, 'completion': completion_price},
+                    'top_provider': {'context_length': context_length, 'max_completion_tokens': 4096}
+                }
+                for model_id, name, context_length, prompt_price, completion_price in MOCK_MODELS
+            ]})
+        elif path.endswith('/auth/key'):
+            if not self.headers.get('Authorization', '').startswith('Bearer '):
+                self._send_json(401, {'error': {'message': 'No auth credentials found', 'code': 401}})
+            else:
+                self._send_json(200, {'data': {'label': 'mock-key', 'usage': 0, 'limit': None, 'is_free_tier': False}})
+        elif path == '/__stats':
+            with self.state.lock:
+                stats = dict(self.state.stats)
+            self._send_json(200, {'stats': stats, 'config': self.state.get_config()})
+        else:
+            self._send_json(404, {'error': {'message': 'Not Found', 'code': 404}})
+
+    def do_POST(self):
+        path = self._path()
+        if path == '/__config':
+            self.state.configure(**self._read_json())
+            self._send_json(200, {'config': self.state.get_config()})
+        elif path.endswith('/chat/completions'):
+            self._chat_completions()
+        else:
+            self._send_json(404, {'error': {'message': 'Not Found', 'code': 404}})
+
+    def _chat_completions(self):
+        state = self.state
+        request = self._read_json()
+        state.count('requests')
+
+        fault = state.pick_fault()
+        if fault == 'timeout':
+            state.count('timeouts')
+            time.sleep(state.timeout_seconds)
+            self.close_connection = True
+            return
+
+        time.sleep(state.sample_latency())
+
+        if fault == '429':
+            state.count('errors_429')
+            headers = {'Retry-After': str(state.retry_after)} if state.retry_after is not None else {}
+            self._send_json(429, {'error': {'message': 'Rate limit exceeded', 'code': 429}}, headers)
+            return
+        if fault == '5xx':
+            state.count('errors_5xx')
+            self._send_json(random.choice([500, 502, 503]), {'error': {'message': 'Upstream error', 'code': 502}})
+            return
+
+        model = request.get('model', 'mock-model')
+        prompt_text = ''.join(str(message.get('content', '')) for message in request.get('messages', []))
+        max_tokens = request.get('max_tokens') or 2000
+        question_count = state.question_count(request.get('messages', []))
+        if question_count:
+            content = state.question_text(question_count)[:max_tokens]
+        else:
+            repeat = state.completion_chars // len(SAMPLE_TEXT) + 1
+            content = (SAMPLE_TEXT * repeat)[:min(state.completion_chars, max_tokens)]
+        usage = {
+            'prompt_tokens': estimate_tokens(prompt_text),
+            'completion_tokens': estimate_tokens(content)
+        }
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        with state.lock:
+            state.stats['prompt_tokens'] += usage['prompt_tokens']
+            state.stats['completion_tokens'] += usage['completion_tokens']
+        cached_tokens = state.cached_prefix_tokens(request.get('messages', []))
+        if state.prefix_cache_min_tokens:
+            usage['prompt_tokens_details'] = {'cached_tokens': min(cached_tokens, usage['prompt_tokens'])}
+        completion_id = f'gen-mock-{random.randint(0, 10 ** 12)}'
+
+        if not request.get('stream'):
+            if state.decode_interval:
+                # 非流式响应同样按输出长度计入生成耗时
+                time.sleep(state.decode_interval * math.ceil(len(content) / 4))
+            self._send_json(200, {
+                'id': completion_id,
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': content},
+                    'finish_reason': 'stop'
+                }],
+                'usage': usage
+            })
+            return
+
+        state.count('streams')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def write(text: str):
+            data = text.encode('utf-8')
+            self.wfile.write(b'%x\r\n' % len(data) + data + b'\r\n')
+            self.wfile.flush()
+
+        def event(payload: Dict):
+            write(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n")
+
+        write(': OPENROUTER PROCESSING\n\n')
+        for index in range(0, len(content), 4):
+            event({
+                'id': completion_id,
+                'model': model,
+                'choices': [{'index': 0, 'delta': {'content': content[index:index + 4]}, 'finish_reason': None}]
+            })
+            if state.token_interval:
+                time.sleep(state.token_interval)
+        event({
+            'id': completion_id,
+            'model': model,
+            'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}],
+            'usage': usage
+        })
+        write('data: [DONE]\n\n')
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 客户端超时断开属于预期情况，不打印堆栈
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+
+def start_server(host: str = '127.0.0.1', port: int = 18080, **options) -> ThreadingHTTPServer:
+    """在后台线程启动模拟服务，返回服务器对象（调用 shutdown() 停止）"""
+    handler = type('ConfiguredMockHandler', (MockHandler,), {'state': MockState(**options)})
+    server = MockServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name='mock-openrouter', daemon=True).start()
+    return server
+
+
+def add_mock_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--latency', default='lognormal:800:0.4',
+                        help='响应延迟分布(毫秒): fixed:500 / uniform:200:800 / normal:500:100 / lognormal:中位数:sigma')
+    parser.add_argument('--token-interval', type=float, default=0.005, help='流式输出每个数据块间隔(秒)')
+    parser.add_argument('--error-429', type=float, default=0.0, help='返回429的概率')
+    parser.add_argument('--error-5xx', type=float, default=0.0, help='返回5xx的概率')
+    parser.add_argument('--timeout-rate', type=float, default=0.0, help='请求挂起(模拟超时)的概率')
+    parser.add_argument('--timeout-seconds', type=float, default=60.0, help='模拟超时的挂起时长(秒)')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='429响应的Retry-After(秒)')
+    parser.add_argument('--completion-chars', type=int, default=400, help='每次回复的字符数')
+    parser.add_argument('--question-chars', type=int, default=0,
+                        help='出题请求按请求的题目数量回复带选项与答案的题目，每道题的字符数（0 表示回复固定长度的案例文本）')
+    parser.add_argument('--decode-interval', type=float, default=0.0,
+                        help='非流式响应每4个字符的生成耗时(秒)，用于对比输出长度对延迟的影响')
+    parser.add_argument('--prefix-cache', type=int, default=0, dest='prefix_cache_min_tokens',
+                        help='模拟提示词前缀缓存的最小命中token数（0 表示不模拟，OpenAI 为1024）')
+
+
+def mock_options(args) -> Dict:
+    return {
+        'latency': args.latency,
+        'token_interval': args.token_interval,
+        'error_429': args.error_429,
+        'error_5xx': args.error_5xx,
+        'timeout_rate': args.timeout_rate,
+        'timeout_seconds': args.timeout_seconds,
+        'retry_after': args.retry_after,
+        'completion_chars': args.completion_chars,
+        'prefix_cache_min_tokens': args.prefix_cache_min_tokens,
+        'question_chars': args.question_chars,
+        'decode_interval': args.decode_interval
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='OpenRouter 本地模拟服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18080)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    server = start_server(args.host, args.port, **mock_options(args))
+    print(f"🧪 OpenRouter 模拟服务: http://{args.host}:{args.port}/api/v1")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print("\n👋 模拟服务已停止")
+
+
+if __name__ == '__main__':
+    main()